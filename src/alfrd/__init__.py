@@ -1,30 +1,32 @@
 from pathlib import Path
-import shutil, sys, os
+import shutil, sys
 import typer
 from typing import Optional
-from typing_extensions import Annotated
-from alfrd.util import padded_output
 
-if sys.version_info >= (3, 8):
-    from importlib.metadata import version
-else:
-    from importlib_metadata import version  # For Python < 3.8 (requires `importlib-metadata` package)
+def _version():
+    """version of the installed package, importlib.metadata is only imported when the version is needed"""
+    if sys.version_info >= (3, 8):
+        from importlib.metadata import version
+    else:
+        from importlib_metadata import version  # For Python < 3.8 (requires `importlib-metadata` package)
+    return version("alfrd")
 
-__version__ = version("alfrd")
+def __getattr__(name):
+    if name == '__version__':
+        return _version()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 from alfrd.util import read_inputfile
-from alfrd.plugins import load_projects, List, REGISTERED_STEPS, VALIDATE_BEFORE, VALIDATE_AFTER, VALIDATORS, PipelineRun
+from alfrd.plugins import load_projects, List, REGISTERED_STEPS, VALIDATE_BEFORE, VALIDATE_AFTER, VALIDATORS, PipelineRun, project_manifest, manifest_files, project_steps
+from alfrd.logsink import LOG_SINK
 
 
 alfrd_cli = typer.Typer()
 Pipeline = PipelineRun()
 
 try:
-    if hasattr(sys.stdout, 'reconfigure'):
-        sys.stdout.reconfigure(line_buffering=True)
-        sys.stderr.reconfigure(line_buffering=True)
-    else:
-        sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    if hasattr(sys.stderr, 'reconfigure'):
+        sys.stderr.reconfigure(line_buffering=True)                                     # stdout of `alfrd run` is flushed by the LOG_SINK
 except:
     pass
 
@@ -69,19 +71,23 @@ X = "\033[0m"
 # The project/plugin directory
 ALFRD_DIR = Path("~/.alfrd").expanduser()
 PROJ_DIR = Path(f"{ALFRD_DIR}/projects")
+LOG_DIR = Path(f"{ALFRD_DIR}/logs")
+DB_SUFFIXES = (".db", ".sqlite", ".sqlite3")                                   # --over-rows files opened as LogFrame(db=...)
 
-def load_steps(prefix=""):
-    for i, (name, info) in enumerate(REGISTERED_STEPS.items()):
+def load_steps(prefix="", steps=None):
+    steps = REGISTERED_STEPS if steps is None else steps
+    for i, (name, info) in enumerate(steps.items()):
         print(f"{prefix}- {i}\t {c['bc']}{name.ljust(20)}{c['x']}: {info['desc']}")
 
-def list_steps(proj):
+def list_steps(proj, steps=None):
     """List all registered steps."""
-    print(f"\n\t\t{c['c']}ALFRD ({__version__}){c['x']}\n")
+    steps = REGISTERED_STEPS if steps is None else steps
+    print(f"\n\t\t{c['c']}ALFRD ({_version()}){c['x']}\n")
     print(f"  Run following pipeline steps for {c['bc']}{proj.upper()}{c['x']}")
-    if not REGISTERED_STEPS:
+    if not steps:
         print("No pipeline steps registered.")
     else:
-        load_steps()
+        load_steps(steps=steps)
 
 def proj_dir(proj, create=False):
     
@@ -110,8 +116,7 @@ def ls(proj: str):
     """List all available pipeline steps for a project."""
     project_dir = proj_dir(proj)
     
-    load_projects(project_dir)
-    list_steps(proj)
+    list_steps(proj, project_steps(project_dir))                                        # plugins are only imported if they have to
     
 @alfrd_cli.command()
 def lsp():
@@ -123,8 +128,7 @@ def lsp():
         for proj in project_dirs:
             print(f"\t\t{proj.name}")
             try:
-                load_projects(proj)
-                load_steps(prefix="\t\t\t")
+                load_steps(prefix="\t\t\t", steps=project_steps(proj))
             except:
                 print("\t\t\tsteps not configured properly!")
     else:
@@ -139,9 +143,30 @@ def run(
     params: List[str]               =   typer.Argument(None, help="Key-value pairs of parameters or parameter file path (e.g., id=123 name=Test)"),
     steps : Optional[List[str]]     =   typer.Option(None, help="list of steps e.g., --steps=step1 --steps=step2 | supersedes values and sequence of the steps", 
                                                      show_default=False),
+    jobs: int                       =   typer.Option(1, "--jobs", "-j", help="number of independent steps to run at the same time, see `@register(desc, after=[...])`"),
+    over_rows: Optional[str]        =   typer.Option(None, "--over-rows", help="csv file, sqlite database (.db) or google sheet url, run the steps once for every row", show_default=False),
+    where: Optional[str]            =   typer.Option(None, help="select the rows for --over-rows e.g., 'STATUS==\"\"'", show_default=False),
+    workers: int                    =   typer.Option(4, help="number of processes for --over-rows"),
+    worksheet: str                  =   typer.Option('', help="worksheet name when --over-rows is a google sheet"),
+    key: str                        =   typer.Option(f"{Path().home()}/.alfred/credentials.json", help="google credentials when --over-rows is a google sheet"),
+    primary_col: str                =   typer.Option('FILE_NAME', help="primary column name of the --over-rows table"),
+    cache: bool                     =   typer.Option(True, help="reuse cached results of steps registered with cache=True"),
+    profile: Optional[Path]         =   typer.Option(None, help="write wall/cpu time, peak memory and i/o of every step and validator as a chrome trace (json)", show_default=False),
+    profile_sample: bool            =   typer.Option(False, help="with --profile, also sample the python stacks of the steps into <profile>.folded"),
+    resume: Optional[str]           =   typer.Option(None, help="run id of an interrupted run, its params are restored and the finished steps are skipped", show_default=False),
+    log_dir: Optional[Path]         =   typer.Option(None, help="folder for the log file of every step [default: ~/.alfrd/logs/PROJ]", show_default=False),
+    log_compress: bool              =   typer.Option(False, help="gzip the step log files"),
+    log_max_mb: float               =   typer.Option(0, help="rotate a step log file when it is larger (0: never)"),
+    quiet: bool                     =   typer.Option(False, help="write the output of the steps only to their log files"),
+    max_commands: Optional[int]     =   typer.Option(None, help="external programs (steps registered with register_command) running at the same time [default: number of cpus]", show_default=False),
     ):
     """Run a specific pipeline step for a project."""    
     _params_found           =   {}
+    if max_commands:
+        from alfrd.commands import set_command_limit
+        set_command_limit(max_commands)
+    LOG_SINK.configure(log_dir=log_dir or LOG_DIR / proj, compress=log_compress, max_bytes=int(log_max_mb*1024**2),
+                       terminal=not quiet)
     
     art = f"""
     ╔══════════════════════════════════════════════════════════════════╗
@@ -150,28 +175,47 @@ def run(
     """
     print(art)
     
+    state                   =   None
+    if resume:
+        from alfrd.journal import RunJournal
+        try:
+            journal         =   RunJournal.load(resume)
+        except FileNotFoundError as e:
+            print(e)
+            raise typer.Exit()
+        state               =   journal.state()
+        if state['proj'] != proj:
+            print(f"Run '{resume}' is a run of {state['proj']}, not {proj}.")
+            raise typer.Exit()
+        Pipeline.update_params(state['params'])                                         # params given now take precedence
+
     if params and len(params):
         for param in params:
             if not '=' in param:
                 if Path(param).exists():
-                    _params_found, _, _ = read_inputfile(Path(param).absolute().parent,Path(param).name)
+                    _params_found, _, _ = read_inputfile(Path(param).absolute().parent,Path(param).name, lazy=True)
                     Pipeline.update_params(_params_found)
 
         _params_found = {param.split("=")[0]: param.split("=")[1] for param in params if '=' in param}
     Pipeline.update_params(_params_found)
+    Pipeline.use_cache      =   cache
     
     project_dir             =   proj_dir(proj)                                          # Ensure project directory exists
-    load_projects(project_dir)                                                          # Load all project steps
+    manifest                =   project_manifest(project_dir)
+    known_steps             =   project_steps(project_dir, manifest)                    # all plugins are imported for steps registered without decorators
+    if known_steps is not REGISTERED_STEPS and any(s not in known_steps for s in [step_name, step_to, *(steps or [])] if s):
+        load_projects(project_dir)                                                      # Load all project steps
+        known_steps         =   REGISTERED_STEPS
     
-    if step_name not in REGISTERED_STEPS:
+    if step_name not in known_steps:
         print(f"Step '{step_name}' not found! Use `ls` to view available steps.")
         raise typer.Exit()
-    allsteps    =   steps or list(REGISTERED_STEPS.keys())
+    allsteps    =   steps or list(known_steps.keys())
     idx_from    =   allsteps.index(step_name)
     idx_to      =   idx_from+1
     
     if step_to:
-        if step_to not in REGISTERED_STEPS:
+        if step_to not in known_steps:
             print(f"Step '{step_to}' not found! Use `ls` to view available steps.")
             raise typer.Exit()
         else:
@@ -179,42 +223,270 @@ def run(
             idx_to      =   allsteps.index(step_to)+1
             
     steps     =   allsteps[idx_from:idx_to]
+    if state:
+        steps       =   [s for s in state['steps'] if s not in state['finished']]
+        print(f"Resuming {resume}, finished: {', '.join(state['finished']) or '-'}")
+        if not steps:
+            print("All steps of the run are finished.")
+            return
+    plugin_files    =   None
+    if known_steps is not REGISTERED_STEPS:
+        plugin_files    =   manifest_files(manifest, steps)
+        load_projects(project_dir, only=plugin_files)                                   # only the plugins of these steps are imported
     # print(allsteps[idx_from:idx_to])
-    print("Following steps will be executed in the sequence:")
+    print("Following steps will be executed in the sequence:" if jobs <= 1 else f"Following steps will be executed using {jobs} jobs:")
     print( f"{c['bc']}", "-", f"\n - ".join(steps),f"{c['x']}\n")
     nsteps = len(steps)
-    for s,step_name in enumerate(steps):
-        if s==0: 
-            Pipeline.prev_step_success     =   True
-            Pipeline.validation_success    =   True
-        Pipeline.step_name                      =   step_name
-        
-        if Pipeline.prev_step_success and (step_name in VALIDATE_BEFORE) and VALIDATE_BEFORE[step_name]['functions']:      
-            print(f"\n>  {B}Pre-processing{X} ({Pipeline.step_name})")
-            print(f"""  ─────────────────────────────────────────────────────────────────""")
-            with padded_output(4):
-                Pipeline.validate_steps         =   VALIDATE_BEFORE
-                Pipeline.run_validations()
-
-        if Pipeline.prev_step_success and Pipeline.validation_success:
-            print(f"\n>  {B}Processing{X}: {proj.upper()} {step_name}")
-            print("""  ─────────────────────────────────────────────────────────────────""")
-            with padded_output(4):
-                Pipeline.run_step()
+    if state:
+        for name, run_count in state['run_counts'].items():
+            if name in VALIDATORS: VALIDATORS[name]['run_count'] = run_count
+        journal.write({'event': 'run', 'proj': proj, 'steps': steps, 'argv': sys.argv[1:], 'resumed': True}, sync=True)
+    elif not over_rows:
+        from alfrd.journal import RunJournal
+        journal     =   RunJournal.create(proj, steps)
+    if not over_rows:
+        Pipeline.journal    =   journal
+        print(f"run id : {journal.run_id} (continue an interrupted run with --resume {journal.run_id})\n")
+    if profile:
+        from alfrd.profiler import StepProfiler
+        Pipeline.profiler       =   StepProfiler(profile, sample=profile_sample)
+    Pipeline.project_name       =   proj
+    LOG_SINK.install()
+    try:
+        if over_rows:
+            with Pipeline.profiled(f"over-rows ({', '.join(steps)})", 'rows'):      # steps of the rows run in worker processes
+                run_over_rows(proj, steps, over_rows, where=where, workers=workers, worksheet=worksheet, key=key, primary_col=primary_col,
+                              plugin_files=plugin_files)
+            return
+        if jobs > 1:
+            done = Pipeline.run_dag(steps, lambda run, step_name: execute_step(run, step_name, proj), jobs=jobs, known=known_steps)
+            if any(success is None for success in done.values()):
+                print(f"{B} failed   : {c['br']}{', '.join(s for s, success in done.items() if success is None)}{X}")
+                raise typer.Exit()
+            return
+        for s,step_name in enumerate(steps):
+            if s==0: 
+                Pipeline.prev_step_success     =   True
+                Pipeline.validation_success    =   True
+            execute_step(Pipeline, step_name, proj)
+    finally:
+        if Pipeline.profiler:
+            print(f"\n>  {B}Profile{X}: {Pipeline.profiler.save()}")
+            Pipeline.profiler.summary()
+            Pipeline.profiler   =   None
+        LOG_SINK.uninstall()                                                            # e.g. run() called from a notebook
+
+def execute_step(run, step_name, proj):
+    """runs the pre-processing validators, the step and the post-processing validators
+    
+    returns True if the step finished
+    """
+    run.step_name                       =   step_name
+    with LOG_SINK.step(step_name, tag=run.params.get('primary_value', '')):            # rows of --over-rows get their own logs
+        return _journaled_step(run, step_name, proj)
+
+def _journaled_step(run, step_name, proj):
+    if run.journal:
+        run.journal.step_started(step_name)
+        try:
+            finished                    =   _execute_step(run, step_name, proj)
+        except BaseException:
+            finished                    =   False
+            raise
+        finally:
+            run.journal.step_finished(step_name, finished, run.params, {name: val['run_count'] for name, val in VALIDATORS.items()})
+        return finished
+    return _execute_step(run, step_name, proj)
+
+def _execute_step(run, step_name, proj):
+    if run.prev_step_success and (step_name in VALIDATE_BEFORE) and VALIDATE_BEFORE[step_name]['functions']:      
+        print(f"\n>  {B}Pre-processing{X} ({run.step_name})")
+        print(f"""  ─────────────────────────────────────────────────────────────────""")
+        with run.padded(4):
+            run.validate_steps          =   VALIDATE_BEFORE
+            run.run_validations()
+
+    if run.prev_step_success and run.validation_success:
+        print(f"\n>  {B}Processing{X}: {proj.upper()} {step_name}")
+        print("""  ─────────────────────────────────────────────────────────────────""")
+        with run.padded(4):
+            run.run_step()
+    
+    # Run validations post run
+    if run.validation_success and run.prev_step_success and (step_name in VALIDATE_AFTER) and VALIDATE_AFTER[step_name]['functions']:
+        print(f"\n>  {B}Post-processing{X} ({run.step_name})")
+        print("""  ─────────────────────────────────────────────────────────────────""")
+
+        with run.padded(4):
+            run.validate_steps          =   VALIDATE_AFTER
+            run.run_validations()
         
-        # Run validations post run
-        if Pipeline.validation_success and Pipeline.prev_step_success and (step_name in VALIDATE_AFTER) and VALIDATE_AFTER[step_name]['functions']:
-            print(f"\n>  {B}Post-processing{X} ({Pipeline.step_name})")
-            print("""  ─────────────────────────────────────────────────────────────────""")
-
-            with padded_output(4):
-                Pipeline.validate_steps         =   VALIDATE_AFTER
-                Pipeline.run_validations()
-            
-        if Pipeline.validation_success:
-            print(f"{B} finished : {c['bc']}{step_name}{X}")
-        else:
-            print(f"{B} skipped  : {c['bc']}{step_name}{X}")
+    if run.validation_success:
+        print(f"{B} finished : {c['bc']}{step_name}{X}{' (cached)' if run.cached else ''}")
+    else:
+        print(f"{B} skipped  : {c['bc']}{step_name}{X}")
+    return bool(run.validation_success and run.prev_step_success)
+
+def _init_row_worker(project_dir, plugin_files=None):
+    if not REGISTERED_STEPS:                                                            # spawned workers start without the project
+        load_projects(project_dir, only=plugin_files)
+
+def _run_row(proj, steps, params, row, primary_col):
+    """runs the steps for a single row in a worker process, returns (primary_value, success, changed cells)"""
+    import pandas as pd
+    from alfrd.lib import LogFrame
+
+    primary_value                   =   str(row[primary_col]).strip()
+    Pipeline.reset()                                                                    # every row starts from a clean run
+    for val in VALIDATORS.values(): val['run_count'] = 0
+    lf                              =   LogFrame(df=pd.DataFrame([row], dtype=object), primary_value=primary_value, primary_colname=primary_col)
+    Pipeline.update_params({**params, 'lf': lf, 'row': row, 'primary_value': primary_value})
+    success                         =   True
+    try:
+        Pipeline.prev_step_success  =   True
+        Pipeline.validation_success =   True
+        for step_name in steps:
+            execute_step(Pipeline, step_name, proj)
+        success                     =   bool(Pipeline.prev_step_success)
+    except (typer.Exit, Exception) as e:
+        print(f"{c['r']}failed{c['x']} : {primary_value} : {e}")
+        success                     =   False
+
+    changes                         =   []
+    for value in Pipeline.params.values():
+        if isinstance(value, LogFrame):
+            changes.extend(value.changed_cells())
+    return primary_value, success, changes
+
+def run_over_rows(proj, steps, over_rows, where=None, workers=4, worksheet='', key='', primary_col='FILE_NAME', plugin_files=None):
+    """runs the steps for every row of a csv file or google sheet in a process pool
+    
+    The changes made by each row are collected into one LogFrame and written back once.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from alfrd.lib import GSC, LogFrame
+
+    if Path(over_rows).suffix in DB_SUFFIXES:
+        lf                          =   LogFrame(db=over_rows, primary_colname=primary_col)          # the rows are updated as they finish
+    elif Path(over_rows).exists():
+        lf                          =   LogFrame(csv=over_rows, primary_colname=primary_col)
+    else:
+        gsc                         =   GSC(url=over_rows, wname=worksheet, key=key)
+        gsc.open()
+        lf                          =   LogFrame(gsc=gsc, primary_colname=primary_col)
+    df_rows                         =   lf.df_sheet.query(where) if where else lf.df_sheet
+    rows                            =   df_rows.to_dict('records')
+    print(f"Running {len(steps)} step(s) for {c['bc']}{len(rows)}{c['x']} rows using {workers} workers\n")
+
+    count, failed                   =   0, 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_row_worker, initargs=(str(proj_dir(proj)), plugin_files)) as pool:
+        futures                     =   [pool.submit(_run_row, proj, steps, dict(Pipeline.params), row, primary_col) for row in rows]
+        for future in as_completed(futures):
+            try:
+                primary_value, success, changes = future.result()
+            except Exception as e:
+                print(f"{c['r']}worker failed{c['x']} : {e}")
+                failed              +=  1
+                continue
+            lf.apply_changes(changes)
+            count, failed           =   (count+1, failed) if success else (count, failed+1)
+            print(f"{B} {'finished' if success else 'failed  '} : {c['bc']}{primary_value}{X} ({count+failed}/{len(rows)})")
+
+    if lf.csvmode:
+        lf.checkpoint(compact=True)                                                     # other tools read the csv, not the delta log
+    elif lf.db is None:
+        lf.update_sheet(count, failed)
+    print(f"\n{B}rows finished: {count}, failed: {failed}{X}")
+
+@alfrd_cli.command()
+def worker(
+    proj: str                       =   typer.Argument(help="name of the ALFRD project"),
+    db: Path                        =   typer.Argument(help="sqlite progress database (LogFrame(db=...)) with the rows to process"),
+    params: List[str]               =   typer.Argument(None, help="Key-value pairs of parameters (e.g., id=123 name=Test)"),
+    step_from: Optional[str]        =   typer.Option(None, help="first step [default: first step of the project]", show_default=False),
+    step_to: Optional[str]          =   typer.Option(None, help="last step [default: last step of the project]", show_default=False),
+    batch: int                      =   typer.Option(1, help="rows claimed at once"),
+    lease: float                    =   typer.Option(600, help="seconds a claimed row stays leased without a heartbeat, rows of crashed workers are claimed again after it"),
+    status_col: str                 =   typer.Option('STATUS', help="rows with an empty status are claimed, set to done/failed when finished"),
+    primary_col: str                =   typer.Option('FILE_NAME', help="primary column name"),
+    table: str                      =   typer.Option('progress', help="table of the progress in the database"),
+    poll: float                     =   typer.Option(0, help="seconds to wait for rows (e.g. expiring leases) when none are left, 0 exits"),
+    wal: bool                       =   typer.Option(True, help="--no-wal for a database on a shared filesystem used by several nodes"),
+    ):
+    """Claim rows of a progress database and run the steps for them, start more workers to scale out."""
+    import time
+    from alfrd.lib import LogFrame
+    from alfrd.progressdb import SQLiteStore, LeaseManager
+
+    LOG_SINK.configure(log_dir=LOG_DIR / proj)
+    store                           =   SQLiteStore(db, table=table, primary_colname=primary_col, wal=wal)
+    if not db.exists() or not store.exists():
+        print(f"No table '{table}' in '{db}', create it with LogFrame(db='{db}', csv=...).")
+        raise typer.Exit()
+    load_projects(proj_dir(proj))
+    allsteps                        =   list(REGISTERED_STEPS.keys())
+    for s in (step_from, step_to):
+        if s and s not in allsteps:
+            print(f"Step '{s}' not found! Use `ls` to view available steps.")
+            raise typer.Exit()
+    steps                           =   allsteps[allsteps.index(step_from) if step_from else 0:allsteps.index(step_to)+1 if step_to else None]
+    params                          =   {param.split("=")[0]: param.split("=")[1] for param in params or [] if '=' in param}
+    lf                              =   LogFrame(db=store, primary_colname=primary_col)
+    leases                          =   LeaseManager(store, status_col=status_col, ttl=lease)
+    print(f"worker {leases.host}:{leases.pid} running {', '.join(steps)} for the rows of {db}\n")
+
+    count, failed                   =   0, 0
+    LOG_SINK.install()
+    try:
+        with leases.heartbeat():
+            while True:
+                rows                =   leases.claim(batch)
+                if not len(rows):
+                    if poll:
+                        time.sleep(poll)
+                        continue
+                    break
+                for row_id, row in zip(rows.index, rows.to_dict('records')):
+                    primary_value, success, changes = _run_row(proj, steps, params, row, primary_col)
+                    lf.apply_changes(changes)
+                    leases.finish(row_id, 'done' if success else 'failed')
+                    count, failed   =   (count+1, failed) if success else (count, failed+1)
+                    print(f"{B} {'finished' if success else 'failed  '} : {c['bc']}{primary_value}{X}")
+    finally:
+        LOG_SINK.uninstall()
+    print(f"\n{B}No rows left. rows finished: {count}, failed: {failed}{X}")
+
+@alfrd_cli.command()
+def sync(
+    db: Path                        =   typer.Argument(help="sqlite progress database (LogFrame(db=...))"),
+    url: str                        =   typer.Argument(help="google sheet url"),
+    worksheet: str                  =   typer.Option('', help="worksheet name"),
+    key: str                        =   typer.Option(f"{Path().home()}/.alfred/credentials.json", help="google credentials"),
+    table: str                      =   typer.Option('progress', help="table of the progress in the database"),
+    primary_col: str                =   typer.Option('FILE_NAME', help="primary column name"),
+    interval: float                 =   typer.Option(60, help="seconds between the exports"),
+    once: bool                      =   typer.Option(False, help="export the changes once and exit"),
+    ):
+    """Export the progress recorded in a sqlite database to a google sheet in bulk."""
+    from alfrd.lib import GSC
+    from alfrd.progressdb import SQLiteStore, SheetExporter
+
+    if not db.exists():
+        print(f"Database '{db}' not found.")
+        raise typer.Exit()
+    store                           =   SQLiteStore(db, table=table, primary_colname=primary_col)
+    if not store.exists():
+        print(f"Database '{db}' has no table '{table}'.")
+        raise typer.Exit()
+    exporter                        =   SheetExporter(store, GSC(url=url, wname=worksheet, key=key))
+    if once:
+        print(f"exported {exporter.export() or 0} cells")
+        return
+    print(f"Exporting {db} to the sheet every {interval:g}s, stop with Ctrl-C")
+    try:
+        exporter.run(interval)
+    except KeyboardInterrupt:
+        print(f"exported {exporter.export() or 0} cells")
 
 @alfrd_cli.command()
 def add(script_path: str, proj: str,
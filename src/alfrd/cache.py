@@ -0,0 +1,133 @@
+from pathlib import Path
+import os, pickle, hashlib, inspect
+
+STEP_CACHE_DIR = Path("~/.alfrd/cache/steps").expanduser()
+
+class Uncacheable(TypeError):
+    """raised when a parameter of a step can not be fingerprinted"""
+
+def _path_stats(path, h):
+    """adds mtime and size of a file (or every file below a directory) to the hash"""
+    st = os.stat(path)
+    h.update(f"{st.st_mtime_ns}:{st.st_size}".encode())
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                h.update(f"{name}:{st.st_mtime_ns}:{st.st_size}".encode())
+
+def _fingerprint(value, h):
+    """adds the value to the hash, strings/paths naming a file or folder are added with its mtime and size"""
+    if value is None or isinstance(value, (bool, int, float, complex)):
+        h.update(repr(value).encode())
+    elif isinstance(value, (str, Path)):
+        h.update(repr(str(value)).encode())
+        if str(value) and os.path.exists(value):                            # also bare names e.g 'target.ms' in the cwd
+            if not os.path.isabs(value): h.update(os.path.abspath(value).encode())
+            _path_stats(value, h)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        h.update(type(value).__name__.encode())
+        for v in (sorted(value, key=repr) if isinstance(value, (set, frozenset)) else value):
+            _fingerprint(v, h)
+    elif isinstance(value, dict):
+        h.update(b'dict')
+        for k in sorted(value, key=repr):
+            _fingerprint(k, h)
+            _fingerprint(value[k], h)
+    else:
+        try:
+            h.update(pickle.dumps(value, protocol=4))
+        except Exception as e:
+            raise Uncacheable(f"{type(value).__name__}: {e}")
+
+def _source(func):
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        code = func.__code__
+        return f"{code.co_code!r}{code.co_consts!r}{code.co_names!r}"
+
+class StepCache:
+    """
+    Content addressed cache of step results.
+
+    The key is a hash of the step source, its bound parameters and the mtimes/sizes of the paths
+    found in the parameters. Results are pickled to `cache_dir`, the least recently used results
+    are removed once the cache is larger than `max_bytes`.
+    """
+    def __init__(self, cache_dir=STEP_CACHE_DIR, max_bytes=10*1024**3):
+        self.cache_dir      =   Path(cache_dir)
+        self.max_bytes      =   max_bytes
+
+    def key(self, func, params):
+        """
+        returns the cache key for calling func with params, raises Uncacheable
+        """
+        h = hashlib.sha256()
+        h.update(f"{func.__module__}.{func.__qualname__}\n{_source(func)}".encode())
+        _fingerprint(dict(params), h)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.pkl"
+
+    def get(self, key):
+        """
+        returns (hit, result)
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return False, None
+        os.utime(path)                              # mtime is used for the eviction order
+        return True, result
+
+    def put(self, key, result):
+        """
+        stores the result, returns False if the result can not be pickled
+        """
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f'.tmp{os.getpid()}')
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            if tmp.exists(): tmp.unlink()
+            print(f"result not cached: {e}")
+            return False
+        os.replace(tmp, path)
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        removes the least recently used results until the cache fits in max_bytes
+        """
+        entries = []
+        for path in self.cache_dir.glob('*/*.pkl'):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for path in self.cache_dir.glob('*/*.pkl'):
+            path.unlink()
+
+STEP_CACHE = StepCache()
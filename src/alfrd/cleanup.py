@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+import os, time, threading
+
+def human_size(nbytes):
+    """e.g 1.5 GB, as find_size"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(nbytes) < 1024: return f"{round(nbytes, 2)} {unit}"
+        nbytes /= 1024
+    return f"{round(nbytes, 2)} TB"
+
+def _freed(st):
+    """bytes freed by removing the file, a file with other hardlinks (e.g a provisioned template) frees nothing"""
+    return st.st_blocks * 512 if st.st_nlink <= 1 and hasattr(st, 'st_blocks') else (st.st_size if st.st_nlink <= 1 else 0)
+
+class _Dir:
+    """a directory being removed, rmdir'ed once its own files and all its subdirectories are gone"""
+    __slots__ = ('path', 'parent', 'target', 'pending')
+
+    def __init__(self, path, parent, target):
+        self.path           =   path
+        self.parent         =   parent
+        self.target         =   target
+        self.pending        =   1                   # its own scan
+
+class Cleanup:
+    """
+    Removes many files/folders (e.g MeasurementSets of several hundred GB) in parallel.
+
+    Every directory is scanned by a worker of the thread pool (os.scandir), its files are unlinked and its
+    subdirectories are handed to the other workers, so even a single large folder is removed by all workers.
+    `freed` keeps a running tally of the bytes freed per target, printed every `report_every` seconds.
+    With dry_run=True nothing is removed and `freed` tells how many bytes would be freed.
+
+        Cleanup(workers=16).run(glob.glob(f"{wd}/*ms*"))
+    """
+    def __init__(self, workers=8, dry_run=False, report_every=10):
+        self.workers        =   workers
+        self.dry_run        =   dry_run
+        self.report_every   =   report_every
+        self.freed          =   {}                  # target -> bytes freed (or to free)
+        self.errors         =   {}                  # target -> [OSError]
+        self._lock          =   threading.Lock()
+        self._done          =   threading.Condition(self._lock)
+        self._targets_left  =   0
+        self._pool          =   None
+
+    def _tally(self, target, nbytes):
+        with self._lock:
+            self.freed[target] += nbytes
+
+    def _error(self, target, e):
+        with self._lock:
+            self.errors.setdefault(target, []).append(e)
+
+    def _scan(self, node):
+        subdirs, nbytes     =   [], 0
+        try:
+            with os.scandir(node.path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                            continue
+                        nbytes  +=  _freed(entry.stat(follow_symlinks=False))
+                        if not self.dry_run: os.unlink(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    except OSError as e:
+                        self._error(node.target, e)
+        except OSError as e:
+            self._error(node.target, e)
+        self._tally(node.target, nbytes)
+        with self._lock:
+            node.pending    +=  len(subdirs)
+        for path in subdirs:
+            self._pool.submit(self._scan, _Dir(path, node, node.target))
+        self._finished(node)
+
+    def _finished(self, node):
+        """called when the scan or a subdirectory of node is done, removes the finished directories bottom-up"""
+        while node is not None:
+            with self._lock:
+                node.pending    -=  1
+                if node.pending: return
+            if not self.dry_run:
+                try:
+                    os.rmdir(node.path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self._error(node.target, e)
+            if node.parent is None:
+                with self._lock:
+                    self._targets_left  -=  1
+                    self._done.notify_all()
+            node            =   node.parent
+
+    def _start(self, target):
+        try:
+            st              =   os.lstat(target)
+        except FileNotFoundError:
+            return False
+        self.freed[target]  =   0
+        if not os.path.isdir(target) or os.path.islink(target):             # files and symlinks (never followed)
+            self.freed[target] = _freed(st)
+            if not self.dry_run:
+                try:
+                    os.unlink(target)
+                except OSError as e:
+                    self._error(target, e)
+            return False
+        return True
+
+    def run(self, targets):
+        """
+        removes the targets, returns {target: bytes freed}
+
+        (with dry_run: the bytes which would be freed), the errors are kept in self.errors
+        """
+        targets             =   [str(target) for target in targets]
+        t0, last            =   time.monotonic(), time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='alfrd-cleanup') as self._pool:
+            for target in targets:
+                if self._start(target):
+                    with self._lock:
+                        self._targets_left  +=  1
+                    self._pool.submit(self._scan, _Dir(target, None, target))
+            with self._lock:
+                while self._targets_left:
+                    self._done.wait(1)
+                    if self.report_every and time.monotonic() - last >= self.report_every:
+                        last        =   time.monotonic()
+                        print(f"{'would free' if self.dry_run else 'freed'} {human_size(sum(self.freed.values()))} so far")
+        self._pool          =   None
+        for target in targets:
+            if target in self.freed:
+                print(f"{'would free' if self.dry_run else 'removed   '} {human_size(self.freed[target]):>10} : {target}"
+                      + (f" ({len(self.errors[target])} errors, e.g {self.errors[target][0]})" if target in self.errors else ''))
+        print(f"{'would free' if self.dry_run else 'freed'} {human_size(sum(self.freed.values()))} in {time.monotonic() - t0:.1f}s")
+        return dict(self.freed)
+
+def remove_paths(paths, dry_run=False, workers=8, report_every=10):
+    """removes the files/folders in parallel (see Cleanup), returns {path: bytes freed}"""
+    return Cleanup(workers=workers, dry_run=dry_run, report_every=report_every).run(paths)
@@ -0,0 +1,100 @@
+import os, sys, shlex, codecs, asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+
+COMMAND_LIMIT   =   os.cpu_count() or 4
+COMMAND_SLOTS   =   threading.BoundedSemaphore(COMMAND_LIMIT)      # external programs running at the same time in this process
+STREAM_LIMIT    =   1024 * 1024                                     # bytes, longer lines are copied in pieces
+
+class CommandFailed(RuntimeError):
+    """raised when an external program exits with a code not in ok_codes or runs longer than its timeout"""
+    def __init__(self, command, returncode, message):
+        super().__init__(message)
+        self.command        =   command
+        self.returncode     =   returncode
+
+def set_command_limit(limit):
+    """sets the number of external programs which can run at the same time (alfrd run --max-commands)"""
+    global COMMAND_LIMIT, COMMAND_SLOTS
+    COMMAND_LIMIT   =   max(1, int(limit))
+    COMMAND_SLOTS   =   threading.BoundedSemaphore(COMMAND_LIMIT)
+
+async def _pump(stream, out):
+    """copies the lines of a subprocess pipe to out as they arrive, a line longer than STREAM_LIMIT is copied in pieces"""
+    decoder         =   codecs.getincrementaldecoder('utf-8')(errors='replace')  # a piece can end within a character
+    while True:
+        try:
+            data    =   await stream.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            data    =   e.partial                                       # the last line without a newline
+        except asyncio.LimitOverrunError as e:
+            data    =   await stream.read(e.consumed)
+        if not data:
+            break
+        out.write(decoder.decode(data))
+    out.write(decoder.decode(b'', final=True))
+
+async def _run(command, timeout, cwd, env, kill_after):
+    if isinstance(command, str):
+        proc        =   await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                              cwd=cwd, env=env, limit=STREAM_LIMIT)
+    else:
+        proc        =   await asyncio.create_subprocess_exec(*[str(arg) for arg in command], stdout=asyncio.subprocess.PIPE,
+                                                             stderr=asyncio.subprocess.PIPE, cwd=cwd, env=env, limit=STREAM_LIMIT)
+    try:
+        await asyncio.wait_for(asyncio.gather(_pump(proc.stdout, sys.stdout), _pump(proc.stderr, sys.stderr), proc.wait()), timeout)
+        return proc.returncode, False
+    except asyncio.TimeoutError:
+        return await _stop(proc, kill_after), True
+    except BaseException:
+        await _stop(proc, kill_after)
+        raise
+
+async def _stop(proc, kill_after):
+    """terminates the program, kills it if it is still running after kill_after seconds"""
+    if proc.returncode is None:
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), kill_after)
+        except asyncio.TimeoutError:
+            proc.kill()
+    return await proc.wait()
+
+def _run_sync(coro):
+    """runs the coroutine to completion, in a worker thread if this thread already runs an event loop (e.g. jupyter)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='alfrd-command') as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+def run_command(command, timeout=None, ok_codes=(0,), cwd=None, env=None, kill_after=10, name=''):
+    """
+    runs an external program and streams its stdout/stderr line by line to sys.stdout/sys.stderr
+    (so into the log file of the running step, see alfrd.logsink), waits for a free COMMAND_SLOTS slot first
+    it can also be called from a running event loop (e.g. a notebook), the program is then run from a worker thread
+
+    Input
+    ---
+
+    command:    list of arguments, or a string which is run by the shell
+    timeout:    seconds, the program is terminated (and killed after kill_after seconds) when it runs longer
+    ok_codes:   exit codes which count as success
+    env:        variables added to the environment of alfrd
+
+    Returns
+    ---
+
+    the exit code, raises CommandFailed for other exit codes or on timeout
+    """
+    text            =   command if isinstance(command, str) else ' '.join(shlex.quote(str(arg)) for arg in command)
+    env             =   {**os.environ, **{k: str(v) for k, v in env.items()}} if env else None
+    with COMMAND_SLOTS:
+        print(f"$ {text}")
+        sys.stdout.flush()
+        returncode, timed_out   =   _run_sync(_run(command, timeout, cwd, env, kill_after))
+    if timed_out:
+        raise CommandFailed(command, returncode, f"{name or text} timed out after {timeout}s")
+    if returncode not in ok_codes:
+        raise CommandFailed(command, returncode, f"{name or text} exited with code {returncode}")
+    return returncode
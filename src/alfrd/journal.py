@@ -0,0 +1,120 @@
+from pathlib import Path
+import os, sys, json, time, threading
+from alfrd.util import LazyGlob
+
+RUNS_DIR = Path("~/.alfrd/runs").expanduser()
+
+def _jsonable(params):
+    """
+    the parameters which can be written to the journal, glob patterns (LazyGlob) are kept as patterns
+
+    Returns
+    ---
+
+    (params, names of the skipped parameters)
+    """
+    kept, skipped = {}, []
+    for k, v in params.items():
+        if isinstance(v, LazyGlob):
+            kept[k] = {'__glob__': v.pattern}
+            continue
+        try:
+            json.dumps(v)
+        except (TypeError, ValueError):
+            skipped.append(k)
+            continue
+        kept[k] = v
+    return kept, skipped
+
+def _restore(params):
+    return {k: LazyGlob(v['__glob__']) if isinstance(v, dict) and set(v) == {'__glob__'} else v for k, v in params.items()}
+
+class RunJournal:
+    """
+    Append-only journal of an `alfrd run` in RUNS_DIR/<run id>.jsonl, one json record per line:
+
+        {"event": "run", "proj": .., "steps": [..], ...}        when the run starts (or is resumed)
+        {"event": "start", "step": ..}                          before the validators and the step
+        {"event": "finish", "step": .., "finished": bool, "params": {..}, "run_counts": {..}}
+
+    The file is fsynced at every step boundary, so after a crash `state()` tells which steps finished
+    and with which parameters, see `alfrd run ... --resume <run id>`.
+    """
+    def __init__(self, run_id, runs_dir=RUNS_DIR):
+        self.run_id         =   run_id
+        self.path           =   Path(runs_dir) / f"{run_id}.jsonl"
+        self.lock           =   threading.Lock()
+
+    @classmethod
+    def create(cls, proj, steps, runs_dir=RUNS_DIR):
+        """starts the journal of a new run"""
+        run_id              =   f"{proj}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        journal             =   cls(run_id, runs_dir)
+        journal.path.parent.mkdir(parents=True, exist_ok=True)
+        journal.write({'event': 'run', 'proj': proj, 'steps': list(steps), 'argv': sys.argv[1:]}, sync=True)
+        return journal
+
+    @classmethod
+    def load(cls, run_id, runs_dir=RUNS_DIR):
+        """the journal of an earlier run, raises FileNotFoundError"""
+        journal             =   cls(run_id, runs_dir)
+        if not journal.path.exists():
+            raise FileNotFoundError(f"No journal for run '{run_id}' in {runs_dir}")
+        return journal
+
+    def write(self, record, sync=False):
+        record              =   {'time': time.time(), **record}
+        line                =   json.dumps(record) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def step_started(self, step_name):
+        self.write({'event': 'start', 'step': step_name}, sync=True)
+
+    def step_finished(self, step_name, finished, params, run_counts):
+        """
+        finished:   True if the step (and its validators) finished, only those are skipped on resume
+        params:     the parameters after the step, the ones not json serializable are left out
+        run_counts: {validator name: run_count}
+        """
+        params, skipped     =   _jsonable(params)
+        self.write({'event': 'finish', 'step': step_name, 'finished': bool(finished), 'params': params,
+                    'skipped_params': skipped, 'run_counts': run_counts}, sync=True)
+
+    def records(self):
+        """the records of the journal, a line cut off by a crash is ignored"""
+        records             =   []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return records
+
+    def state(self):
+        """
+        replays the journal
+
+        Returns
+        ---
+
+        {'proj': .., 'steps': [..], 'finished': [steps in the order they finished], 'params': {..}, 'run_counts': {..}}
+        """
+        state               =   {'proj': '', 'steps': [], 'finished': [], 'params': {}, 'run_counts': {}}
+        for record in self.records():
+            if record['event'] == 'run':
+                state['proj']   =   record['proj']
+                state['steps']  =   state['steps'] or record['steps']           # a resumed run keeps the original steps
+            elif record['event'] == 'finish':
+                state['params'].update(_restore(record['params']))
+                state['run_counts'].update(record['run_counts'])
+                if record['finished'] and record['step'] not in state['finished']:
+                    state['finished'].append(record['step'])
+                elif not record['finished'] and record['step'] in state['finished']:
+                    state['finished'].remove(record['step'])
+        return state
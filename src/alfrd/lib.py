@@ -1,83 +1,578 @@
-import gspread
-from google.oauth2.service_account import Credentials
 import pandas as pd
-import re, time
+import re, time, ast, threading, atexit, random, pickle, os, json
 from pathlib import Path
-import warnings
+from functools import lru_cache
+from contextlib import nullcontext
 from alfrd import c
-from gspread_formatting import ConditionalFormatRule, GridRange, BooleanCondition, BooleanRule, CellFormat, Color, get_conditional_format_rules
+from alfrd.util import TokenBucket
 import numpy as np
 import traceback
+SHEETS_QUOTA    =   TokenBucket(rate=60, per=60.0)      # shared by all GSC instances of this process
+SHEETS_CACHE    =   Path("~/.alfrd/cache/sheets").expanduser()
+SHEETS_INFLIGHT =   4                                   # sheet requests running at the same time for the async methods
+_SHEETS_POOL    =   None
+_SHEETS_POOL_LOCK = threading.Lock()
+
+def _sheets_pool():
+    """thread pool running the blocking gspread calls of the async methods, its size bounds the in-flight requests"""
+    global _SHEETS_POOL
+    with _SHEETS_POOL_LOCK:
+        if _SHEETS_POOL is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _SHEETS_POOL = ThreadPoolExecutor(max_workers=SHEETS_INFLIGHT, thread_name_prefix='alfrd-sheets')
+        return _SHEETS_POOL
+
+async def _in_pool(func, *args):
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(_sheets_pool(), func, *args)
+
+class ClientPool:
+    """
+    Process-wide cache of the google credentials and authorized gspread clients (per key file),
+    and of the opened spreadsheets with their worksheets (per client and spreadsheet id).
+
+    Opening another worksheet of an already opened spreadsheet then needs no new authorization or
+    metadata request. The credentials are refreshed here, once for all GSC instances sharing them.
+    """
+    def __init__(self):
+        self.credentials    =   {}                  # (key file, scopes) -> Credentials
+        self.clients        =   {}                  # (key file, scopes) -> authorized client
+        self.spreadsheets   =   {}                  # (id(client), sid) -> (client, Spreadsheet, [Worksheet] or None)
+        self.lock           =   threading.RLock()
+
+    def creds(self, key, scopes):
+        """the credentials of the service account key file, read from disk once"""
+        k = (str(Path(key).expanduser().absolute()), tuple(scopes))
+        with self.lock:
+            if k not in self.credentials:
+                from google.oauth2.service_account import Credentials
+                self.credentials[k] = Credentials.from_service_account_file(k[0], scopes=list(scopes))
+            return self.credentials[k]
+
+    def refresh(self, creds):
+        """refreshes expired (or not yet fetched) credentials"""
+        with self.lock:
+            if not creds.valid:
+                from google.auth.transport.requests import Request
+                creds.refresh(Request())
+
+    def client(self, key, scopes):
+        """the authorized gspread client of the key file"""
+        k = (str(Path(key).expanduser().absolute()), tuple(scopes))
+        with self.lock:
+            creds = self.creds(key, scopes)
+            if k not in self.clients:
+                import gspread
+                self.clients[k] = gspread.authorize(creds)
+            self.refresh(creds)
+            return self.clients[k]
+
+    def spreadsheet(self, client, sid):
+        """the opened spreadsheet, open_by_key is only called the first time"""
+        k = (id(client), sid)
+        with self.lock:
+            if k not in self.spreadsheets:
+                self.spreadsheets[k] = (client, client.open_by_key(sid), None)
+            return self.spreadsheets[k][1]
+
+    def worksheet(self, client, sid, wid=0, wname=''):
+        """
+        the worksheet by name (or by its position wid), the worksheets of a spreadsheet are listed once
+        and listed again only if the worksheet is not found (e.g it was added after the listing)
+        """
+        k = (id(client), sid)
+        with self.lock:
+            spreadsheet = self.spreadsheet(client, sid)
+            for attempt in range(2):
+                worksheets = self.spreadsheets[k][2]
+                if worksheets is None or attempt:
+                    worksheets = spreadsheet.worksheets()
+                    self.spreadsheets[k] = (client, spreadsheet, worksheets)
+                found = [w for w in worksheets if w.title == wname] if wname else worksheets[wid:wid+1]
+                if found:
+                    return found[0]
+        import gspread
+        raise gspread.exceptions.WorksheetNotFound(wname or wid)
+
+    def forget(self, sid=None):
+        """drops the cached spreadsheets (of sid) e.g after worksheets were renamed or deleted"""
+        with self.lock:
+            for k in [k for k in self.spreadsheets if sid is None or k[1] == sid]:
+                del self.spreadsheets[k]
+
+SHEETS_CLIENTS  =   ClientPool()
+
+def _api_status(e):
+    return getattr(getattr(e, 'response', None), 'status_code', None)
+
+def cell_ranges(cells: dict):
+    """
+    merges {(sheet row, sheet col): value} into rectangular ranges,
+    contiguous rows of a column are merged first and then neighbouring columns with the same rows.
+
+    Returns
+    ---
+
+    list of (row0, col0, values) where values is a list of rows
+    """
+    columns         =   {}
+    for (row, col), value in cells.items():
+        columns.setdefault(col, {})[row] = value
+
+    runs            =   {}                          # (row0, row1) -> {col: [values]}
+    for col, rows in columns.items():
+        ordered     =   sorted(rows)
+        start       =   0
+        for k in range(1, len(ordered)+1):
+            if k == len(ordered) or ordered[k] != ordered[k-1]+1:
+                runs.setdefault((ordered[start], ordered[k-1]), {})[col] = [rows[r] for r in ordered[start:k]]
+                start = k
+
+    ranges          =   []
+    for (row0, row1), cols in sorted(runs.items()):
+        ordered     =   sorted(cols)
+        start       =   0
+        for k in range(1, len(ordered)+1):
+            if k == len(ordered) or ordered[k] != ordered[k-1]+1:
+                block   =   [cols[col] for col in ordered[start:k]]
+                ranges.append((row0, ordered[start], [list(row) for row in zip(*block)]))
+                start   =   k
+    return ranges
+
+def batch_ranges(ranges: list, max_cells=10000):
+    """
+    splits the ranges from cell_ranges into batches of at most max_cells cells (larger ranges are split by rows)
+
+    Returns
+    ---
+
+    list of batches, each a list of {'range': A1 notation, 'values': values} for batch_update
+    """
+    from gspread.utils import rowcol_to_a1
+    batches, batch, size    =   [], [], 0
+    for row0, col0, values in ranges:
+        width       =   len(values[0])
+        step        =   max(1, max_cells // width)
+        for k in range(0, len(values), step):
+            part    =   values[k:k+step]
+            if batch and size + len(part)*width > max_cells:
+                batches.append(batch)
+                batch, size = [], 0
+            a1      =   rowcol_to_a1(row0+k, col0)
+            a1_end  =   rowcol_to_a1(row0+k+len(part)-1, col0+width-1)
+            batch.append({'range': a1 if a1 == a1_end else f"{a1}:{a1_end}", 'values': part})
+            size    +=  len(part)*width
+    if batch: batches.append(batch)
+    return batches
+
 class GSC:
     """
     Creates instance of google Google Spreadsheet Credential to open and update a worksheet
+
+    All requests to the sheet take a token from `limiter` (default SHEETS_QUOTA: 60 requests/minute),
+    use `start_writer()` or `with GSC(...) as gsc:` to send cell updates from a background thread.
+
+    open() keeps a snapshot of the worksheet in `cache_dir` (default ~/.alfrd/cache/sheets), see GSC.open
+    credentials, clients and opened spreadsheets are shared by all instances through SHEETS_CLIENTS (ClientPool)
+
+    aopen(), aupdate() and aupdate_cell() are the asyncio versions, the requests run in a shared thread pool
+    of SHEETS_INFLIGHT threads so several sheets can be read/updated while the event loop keeps computing.
     """
-    def __init__(self, sid='', url='', key=f"{Path().home()}/.alfred/credentials.json", wid=0, wname=''):
+    def __init__(self, sid='', url='', key=f"{Path().home()}/.alfred/credentials.json", wid=0, wname='', limiter=None,
+                 client=None, cache_dir=None, pool=None):
         """
         if sid is empty, uses url to get the spreadsheet id
+
+        client:     an authorized gspread client (or a stand-in with the same methods), the key is then not read
+        cache_dir:  directory for the worksheet snapshots, False disables the snapshots
+        pool:       ClientPool sharing credentials, clients and spreadsheets (default SHEETS_CLIENTS)
         """
         self.sid            =   sid
         self.url            =   url
         self.key            =   key
         self.wid            =   wid
         self.wname          =   wname
-        self.authorized     =   False
+        self.authorized     =   client is not None
         self.scopes         =   ["https://www.googleapis.com/auth/spreadsheets"]
-        self.creds          =   Credentials.from_service_account_file(key, scopes=self.scopes)
+        self.creds          =   None
+        self.pool           =   pool or SHEETS_CLIENTS
+        if client is None:
+            self.creds      =   self.pool.creds(key, self.scopes)
+        self.client         =   client
+        self.cache_dir      =   Path(cache_dir) if cache_dir else (SHEETS_CACHE if cache_dir is None else None)
+        self.limiter        =   limiter or SHEETS_QUOTA
+        self.max_retries    =   5
+        self.max_cells      =   10000               # cells per batch_update request
+        self._pending       =   {}                  # (sheet row, sheet col) -> value waiting for the writer
+        self._inflight      =   False
+        self._writer        =   None
+        self._stopping      =   False
+        self._cond          =   threading.Condition()
         
     def auth(self):
-        self.client         =   gspread.authorize(self.creds)
+        self.client         =   self.pool.client(self.key, self.scopes)
         self.authorized     =   True
 
-    def open(self):
-        if not self.authorized: self.auth()
+    def open(self, max_age=None, offline=False):
+        """
+        opens the worksheet and returns it as a dataframe (also kept in self.df)
+
+        The worksheet is downloaded and kept as the local snapshot, the cells updated through this class are added
+        to the snapshot. The snapshot is only used instead of the sheet with max_age or offline, it does not see
+        the cells changed on the sheet by others.
+
+        max_age:    seconds, a younger snapshot is used without contacting the sheet
+        offline:    only use the snapshot (raises FileNotFoundError if there is none), updates are not possible
+        """
         if not self.sid: 
             regex = "([\w-]){44}"
             sid_match = re.search(regex,self.url)
             self.sid = str(sid_match.group())
 
-        self.spreadsheet    =   self.client.open_by_key(self.sid)
-        self.sheet          =   self.spreadsheet.get_worksheet(self.w) if not self.wname else self.spreadsheet.worksheet(self.wname)
+        snapshot            =   self.load_snapshot(max_age=None if offline else max_age) if (offline or max_age is not None) else None
+        if snapshot is None and offline:
+            raise FileNotFoundError(f"No snapshot of {self.sid} ({self.wname or self.wid}) in {self.cache_dir}")
+        if snapshot is not None:
+            self.df         =   snapshot
+            print(f"{c['g']}Success!{c['x']} (snapshot)")
+            return self.df
+
+        if not self.authorized: self.auth()
+        self.spreadsheet    =   self.pool.spreadsheet(self.client, self.sid)
+        self.sheet          =   self.pool.worksheet(self.client, self.sid, wid=self.wid, wname=self.wname)
         self.df             =   pd.DataFrame(self.sheet.get_all_records(numericise_ignore=['all']))
+        self.save_snapshot(self.df)
         print(f"{c['g']}Success!{c['x']}")
         return self.df
 
+    def snapshot_path(self):
+        return self.cache_dir / f"{self.sid}_{self.wname or self.wid}.pkl"
+
+    def load_snapshot(self, max_age=None):
+        """
+        returns the snapshot dataframe with the recorded cell updates applied, or None if there is no usable snapshot
+
+        max_age:    maximum age in seconds
+        """
+        if not self.cache_dir: return None
+        path                =   self.snapshot_path()
+        try:
+            if max_age is not None and time.time() - path.stat().st_mtime > max_age:
+                return None
+            with open(path, 'rb') as f:
+                snapshot    =   pickle.load(f)
+            df              =   snapshot['df']
+            cells_path      =   path.with_suffix('.cells')
+            if cells_path.exists():
+                with open(cells_path, 'rb') as f:
+                    while True:
+                        try:
+                            cells = pickle.load(f)
+                        except EOFError:
+                            break
+                        for (ci, cj), value in cells.items():
+                            df.iat[ci-2, cj-1] = value                  # sheet rows start at 1 and the first row is the header
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, IndexError, ValueError, TypeError):
+            return None
+        return df
+
+    def save_snapshot(self, df):
+        """
+        stores the dataframe as the snapshot of this worksheet (write to temp + rename)
+        """
+        if not self.cache_dir: return
+        path                =   self.snapshot_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp                 =   path.with_suffix(f'.tmp{os.getpid()}')
+        with open(tmp, 'wb') as f:
+            pickle.dump({'sid': self.sid, 'worksheet': self.wname or self.wid, 'time': time.time(), 'df': df}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        if path.with_suffix('.cells').exists(): path.with_suffix('.cells').unlink()
+
+    def _record_cells(self, cells):
+        """appends updated cells to the snapshot so that the next open() does not have to download the sheet"""
+        if not self.cache_dir or not self.snapshot_path().exists(): return
+        with open(self.snapshot_path().with_suffix('.cells'), 'ab') as f:
+            pickle.dump(dict(cells), f, protocol=pickle.HIGHEST_PROTOCOL)
+
     def update(self, dataframe):
+        self.flush()                                # queued cell updates go first
+        self.limiter.acquire()
         self.sheet.update([dataframe.columns.values.tolist()] + dataframe.values.tolist())
+        self.save_snapshot(dataframe.copy())
         print(f"{c['g']}Updated!{c['x']}")
 
     def update_cell(self, dataframe: pd.DataFrame, I: list, J: list):
-        
+        """
+        updates the cells at the row positions I and column positions J, returns False if the update failed
+
+        if the background writer is running the cells are queued and True is returned immediately
+        """
+        if not len(I) or not len(J):      # ensure non empty values
+            print(" skipped: Identical data - row or column indices for update are empty.")
+            return True
+
+        cells           =   self._cells(dataframe, I, J)
+        if self._writer is not None:
+            self.queue_cells(cells)
+            return True
+        return self.send_cells(cells)
+
+    @staticmethod
+    def _cells(dataframe, I, J):
+        """{(sheet row, sheet col): value} of the row positions I and column positions J"""
         # account for header as a row
         sheet_I_h = len(dataframe.columns.shape[1]) if len(dataframe.columns.shape) > 1 else 1 # checks if there are more than one row else use 1 as the no. of rows in header
-        
-        # Convert row and column indices to Excel-style (1-based index)
-        sheet_I = [i + 1 + sheet_I_h for i in I]  # Offset by sheet header length
-        sheet_J = [j + 1 for j in J]  # 1-based index for columns
+        cells           =   {}
+        for i,j in zip(I,J):
+            value   =   dataframe.iat[i,j]
+            # Convert row and column indices to Excel-style (1-based index), offset by sheet header length
+            cells[(i + 1 + sheet_I_h, j + 1)] = '' if _isna(value) else value   # avoid (NaN) errors: Out of range float values are not JSON compliant
+        return cells
 
-        if not sheet_I or not sheet_J:      # ensure non empty values
+    async def aopen(self, max_age=None, offline=False):
+        """awaitable open(), the worksheet is downloaded in the sheets thread pool"""
+        return await _in_pool(self.open, max_age, offline)
+
+    async def aupdate(self, dataframe):
+        """awaitable update(), a copy of the dataframe is sent so it can be changed while the request runs"""
+        return await _in_pool(self.update, dataframe.copy())
+
+    async def aupdate_cell(self, dataframe: pd.DataFrame, I: list, J: list):
+        """
+        awaitable update_cell(), the values are taken when it is called and sent in the sheets thread pool
+        returns False if the update failed
+        """
+        if not len(I) or not len(J):
             print(" skipped: Identical data - row or column indices for update are empty.")
-            # print("sheet_I :", sheet_I,"\nsheet_J :",sheet_J)
-            return
+            return True
+        cells           =   self._cells(dataframe, I, J)
+        if self._writer is not None:
+            self.queue_cells(cells)
+            return True
+        return await _in_pool(self.send_cells, cells)
 
-        # create a body for batch update
-        update_body     =   []
-        for ci,cj,i,j in zip(sheet_I,sheet_J,I,J):
-            cell    =   gspread.utils.rowcol_to_a1(ci,cj)
-            value   =   dataframe.iat[i,j]
-            update_body.append({
-            'range': cell,
-            'values': [[value]]
-        })
+    def send_cells(self, cells: dict):
+        """
+        sends {(sheet row, sheet col): value} merged into ranges, using one batch_update per max_cells cells
+        returns False if the update failed
+        """
+        batches         =   batch_ranges(cell_ranges(cells), max_cells=self.max_cells)
+        for update_body in batches:
+            if not self._batch_update(update_body):
+                return False
+        self._record_cells(cells)
+        print(f"{c['g']}Updated!{c['x']} {len(cells)} cells successfully.")
+        return True
 
-        try:
-            # Use batch_update for efficiency
-            self.sheet.batch_update(update_body)
-            print(f"{c['g']}Updated!{c['x']} {len(I)} cells successfully.")
-        except gspread.exceptions.APIError as e:
-            print(f"API Error: {e}")
-        except Exception as e:
-            print(f"Error updating the sheet: {e}")
+    def _batch_update(self, update_body):
+        """
+        one batch_update request, retries with backoff if the quota is exceeded (429)
+        """
+        import gspread
+        for attempt in range(self.max_retries+1):
+            self.limiter.acquire()
+            try:
+                # Use batch_update for efficiency
+                self.sheet.batch_update(update_body)
+                return True
+            except gspread.exceptions.APIError as e:
+                if _api_status(e) == 429 and attempt < self.max_retries:
+                    backoff = min(2**attempt, 64) + random.random()
+                    print(f"{c['y']}Quota exceeded,{c['x']} retrying in {backoff:.1f}s")
+                    self.limiter.pause(backoff)
+                    continue
+                print(f"API Error: {e}")
+            except Exception as e:
+                print(f"Error updating the sheet: {e}")
+            return False
+        return False
+
+    def start_writer(self):
+        """
+        starts a background thread sending the queued cell updates, repeated writes to the same cell are merged
+        """
+        if self._writer is None:
+            self._stopping  =   False
+            self._writer    =   threading.Thread(target=self._write_loop, name=f"gsc-writer-{self.sid or self.wname}", daemon=True)
+            self._writer.start()
+            atexit.register(self.stop_writer)
+        return self
+
+    def queue_cells(self, cells: dict):
+        """
+        queues {(sheet row, sheet col): value} for the background writer
+        """
+        with self._cond:
+            self._pending.update(cells)
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        waits until the background writer has sent all queued cells, returns False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not (self._pending or self._inflight) or self._writer is None, timeout)
+
+    def stop_writer(self):
+        """
+        sends the remaining queued cells and stops the background writer
+        """
+        if self._writer is None: return
+        self.flush()
+        with self._cond:
+            self._stopping  =   True
+            self._cond.notify_all()
+        self._writer.join()
+        self._writer        =   None
+        atexit.unregister(self.stop_writer)
+
+    def __enter__(self):
+        return self.start_writer()
+
+    def __exit__(self, *exc):
+        self.stop_writer()
+
+    def _write_loop(self):
+        failures            =   0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._stopping)
+                if self._stopping and not self._pending:
+                    return
+                cells, self._pending, self._inflight = self._pending, {}, True
+            ok              =   self.send_cells(cells)
+            failures        =   0 if ok else failures+1
+            with self._cond:
+                if not ok and failures <= self.max_retries:
+                    for cell, value in cells.items(): self._pending.setdefault(cell, value)     # keep newer values
+                elif not ok:
+                    print(f"{c['r']}Dropped{c['x']} {len(cells)} cells after {failures} failed updates.")
+                    failures    =   0
+                self._inflight  =   False
+                self._cond.notify_all()
+            if not ok: time.sleep(min(2**failures, 64))
+
+def _jsonable_value(value):
+    """cell value for the csv delta log, numpy scalars are converted and NA becomes null"""
+    if _isna(value): return None
+    return value.item() if hasattr(value, 'item') else value
+
+class CSVStore:
+    """
+    CSV backend of LogFrame(csv=...)
+
+    The csv is loaded in chunks of `chunksize` rows with the given dtypes. Checkpoints only append the changed
+    cells to `<csv>.delta` (json lines, fsynced), which are applied on the next load. Once the delta log has
+    `compact_every` cells (or rows/columns were added) the whole table is written to a temporary file which
+    replaces the csv (the csv is never half written) and the delta log is removed.
+
+    :dtype:     dtype or {column: dtype} for pd.read_csv, e.g. str to keep leading zeros
+    """
+    def __init__(self, path, dtype=None, chunksize=100000, compact_every=10000):
+        self.path           =   Path(path)
+        self.delta_path     =   Path(f"{path}.delta")
+        self.dtype          =   dtype
+        self.chunksize      =   chunksize
+        self.compact_every  =   compact_every
+        self.ndelta         =   0
+        self.shape          =   None                # (rows, columns) of the table the delta log applies to
+
+    def _stamp(self):
+        st = self.path.stat()
+        return [st.st_mtime_ns, st.st_size]
+
+    def load(self):
+        """reads the csv and applies the delta log"""
+        if self.path.stat().st_size:
+            df              =   pd.concat(pd.read_csv(self.path, dtype=self.dtype, chunksize=self.chunksize), ignore_index=True)
+        else:
+            df              =   pd.DataFrame()     # read_csv raises EmptyDataError
+        self.ndelta         =   0
+        if self.delta_path.exists():
+            with open(self.delta_path) as f:
+                header      =   f.readline()
+                try:
+                    valid   =   json.loads(header).get('snapshot') == self._stamp()
+                except ValueError:
+                    valid   =   False
+                if not valid:
+                    print(f"{c['y']}Ignoring{c['x']} {self.delta_path}, it was written for another version of {self.path}")
+                else:
+                    for line in f:
+                        try:
+                            i, colname, value = json.loads(line)
+                        except ValueError:
+                            break                   # the last line was cut off
+                        if colname not in df:
+                            df[colname] = pd.Series(np.nan, index=df.index, dtype=object)
+                        elif df[colname].dtype != object:
+                            df[colname] = df[colname].astype(object)
+                        df.iat[i, df.columns.get_loc(colname)] = value
+                        self.ndelta += 1
+        self.shape          =   df.shape
+        return df
+
+    def checkpoint(self, df, cells):
+        """
+        stores the (row position, colname) cells of df, returns the number of cells written
+
+        the whole table is written instead if the delta log is full or the shape of the table changed
+        """
+        if self.shape != df.shape or self.ndelta + len(cells) > self.compact_every:
+            self.compact(df)
+            return len(cells)
+        if not cells: return 0
+        lines               =   [json.dumps([int(i), colname, _jsonable_value(df.iat[i, df.columns.get_loc(colname)])], default=str) + '\n'
+                                 for i, colname in cells]
+        new                 =   not self.delta_path.exists()
+        with open(self.delta_path, 'a') as f:
+            if new: f.write(json.dumps({'snapshot': self._stamp()}) + '\n')
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.ndelta         +=  len(cells)
+        return len(cells)
+
+    def compact(self, df):
+        """writes the whole table to a temporary file, replaces the csv with it and removes the delta log"""
+        tmp                 =   self.path.with_name(f".{self.path.name}.tmp{os.getpid()}")
+        with open(tmp, 'w', newline='') as f:
+            df.to_csv(f, index=False, chunksize=self.chunksize)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self.delta_path.exists(): self.delta_path.unlink()
+        self.ndelta         =   0
+        self.shape          =   df.shape
+
+@lru_cache(maxsize=256)
+def _compile_where(expression):
+    """
+    compiles a where expression once, returns None if it has to be evaluated by `DataFrame.query`
+    e.g for `&`, `|` which have a different precedence in pandas.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        return None
+    if any(isinstance(node, (ast.BitAnd, ast.BitOr, ast.BitXor, ast.Invert)) for node in ast.walk(tree)):
+        return None
+    return compile(tree, '<where>', 'eval')
+
+_UNKNOWN = object()      # baseline of cells marked dirty from outside the LogFrame
+
+def _isna(value):
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+def _same_value(a, b):
+    return (_isna(a) and _isna(b)) or str(a) == str(b)
+
+def _primary_key(value):
+    return value.strip() if isinstance(value, str) else str(value).strip()
 
 class LogFrame:
     """
@@ -89,15 +584,39 @@ class LogFrame:
     :primary_value:     the unique identifier of the row corrosponding to the primary_colname
     :primary_colname:     primary column name for unique identifier
     :registered:        keeps count of success and failed script runs in a tuple (count_success, count_failed)
+    :df:                use this dataframe instead of the one from gsc/csv
+    :track_changes:     by default a copy of the sheet is kept in df_sheet0 and all differences (including cells changed
+                        directly in df_sheet) are updated. With track_changes=True only the cells changed by put_value/col_data
+                        are kept for update_sheet, cells changed directly in df_sheet then need lf.mark_dirty(index, colname).
+    :csv:               csv file used instead of a google sheet, stored through CSVStore (lf.store), update_sheet/checkpoint
+                        only append the changed cells to its delta log
+    :dtype:             dtypes for reading the csv e.g. {'FILE_NAME': str}
+    :db:                sqlite database (or SQLiteStore) shared by several processes (alfrd.progressdb, lf.db), put_value/get_value
+                        read and write the rows of the database directly. The table is created from gsc/csv/df if it does not exist.
+    :table:             table of the progress in db
 
 
     """
-    def __init__(self, gsc=None , primary_value='',  primary_colname='FILE_NAME', csv=''):
+    def __init__(self, gsc=None , primary_value='',  primary_colname='FILE_NAME', csv='', df=None, track_changes=False, dtype=None,
+                 db='', table='progress'):
         self.gsc                =   gsc
         # self.df_sheet0          =   self.gsc.df.copy(deep=True) if not gsc is None else pd.read_csv(csv)
-        self.csvmode            =   True if csv and not gsc else False
-        self.df_sheet           =   self.gsc.df if not gsc is None else pd.read_csv(csv)
-        self.df_sheet0          =   self.df_sheet.copy(deep=True)
+        self.csvmode            =   True if csv and not gsc and not db else False
+        self.store              =   CSVStore(csv, dtype=dtype) if self.csvmode else None
+        self.db                 =   None
+        if df is not None:
+            self.df_sheet       =   df
+        elif gsc is not None or csv:
+            self.df_sheet       =   self.gsc.df if not gsc is None else (self.store.load() if self.csvmode else CSVStore(csv, dtype=dtype).load())
+        if db:
+            from alfrd.progressdb import SQLiteStore
+            self.db             =   db if isinstance(db, SQLiteStore) else SQLiteStore(db, table=table, primary_colname=primary_colname)
+            if not self.db.exists():
+                self.db.create(getattr(self, 'df_sheet', None))
+            self.df_sheet       =   self.db.load()
+        self.track_changes      =   track_changes
+        self.df_sheet0          =   self.df_sheet.copy(deep=True) if not track_changes else None
+        self._dirty             =   {}          # track_changes: (row position, colname) -> value before the first change
         self.primary_value      =   primary_value
         self.primary_colname    =   primary_colname
         self.working_col        =   ''
@@ -105,14 +624,12 @@ class LogFrame:
         self.t0                 =   time.time()
         
 
+        self._pk_index          =   {}          # primary value -> row positions
+        self._pk_key            =   None
+
         self.registered         =   0,0         # (count_success, count_failed)
         self.update_cooldown_count   =   0
-        self.color ={'g': Color(red=0.56,green=0.77,blue=0.49),
-                'r': Color(red=0.8784314,green=0.4,blue=0.4),
-                'rh': Color(red=0.71,green=0.13,blue=0.0),
-                'rl': Color(red=0.98,green=0.63,blue=0.57),
-                'gl': Color(red=0.42,green=0.86,blue=0.31),
-                'gh': Color(red=0.42,green=0.60,blue=0.42)}
+        self._color             =   None
 
     # def col_d(self, colname='', data='', count=0, force=False, chk_colname=''):
     #     self.df_sheet
@@ -146,19 +663,16 @@ class LogFrame:
         """
         colname = self.working_col if not colname else colname
         if not self.primary_value : print(f"{c['y']}No primary value given{c['x']}")
-        primary_col_values      = self.df_sheet[self.primary_colname].str.strip()
-        # idxs_primary_val        =   primary_col_values==self.primary_value
-        def idx_where(exps):
-            
-            expression          =   f"{' & '.join(exps)}"
-            idxs_primary_val    =   self.df_sheet.query(expression).index
-            return idxs_primary_val
-        idx_pv = idx_where([f'{self.primary_colname}=="{self.primary_value}"']) if not expressions else idx_where([f'{self.primary_colname}=="{self.primary_value}"'] + expressions)
-        if (not force) or (primary_col_values.isin([self.primary_value]).any() and not self.df_sheet.loc[primary_col_values==self.primary_value,colname].count()):
+        if self.db is not None:
+            return self._in_db([self.primary_value], LogFrame.col_data, colname, data, count, force, chk_colname, expressions, write=not chk_colname)
+        rows                    =   self.pk_rows(self.primary_value)
+        pcol                    =   self.df_sheet.columns.get_loc(self.primary_colname)
+        idx_pv                  =   self.rows_where([i for i in rows if self.df_sheet.iat[i, pcol]==self.primary_value], expressions)
+        if (not force) or (len(rows) and not self._count(rows, colname)):
             
             if chk_colname :
-                if self.df_sheet.loc[primary_col_values==self.primary_value,chk_colname].count(): 
-                    located_val = self.df_sheet.loc[idx_pv,chk_colname].values 
+                if self._count(rows, chk_colname): 
+                    located_val = self.df_sheet.iloc[idx_pv, self.df_sheet.columns.get_loc(chk_colname)].values 
                     
                     val = str(located_val[0]).strip() if len(located_val) else None          # searching for the first occurance of the value.
                     count+=1
@@ -167,13 +681,87 @@ class LogFrame:
                     return count, ''
             else:
                 count+=1 
-                idxs        =   idx_pv#primary_col_values==self.primary_value
-                # if sum(idxs)>1:
+                # if len(idx_pv)>1:
                 #     print(f"{c['y']}Warning! Primary value used is not unique{c['x']}")
-                self.df_sheet.loc[idxs,colname] = data
+                self._set_cells(idx_pv, colname, data)
         else:
-            print("not updating", self.primary_value, f"{self.df_sheet.loc[idx_pv,colname].values}")
+            print("not updating", self.primary_value, f"{self.df_sheet.iloc[idx_pv, self.df_sheet.columns.get_loc(colname)].values}")
         return count
+
+    def _in_db(self, keys, method, *args, write=True, **kwargs):
+        """
+        db mode: runs the LogFrame method on the rows of the keys read from the database,
+        the cells it changed are written back in the same transaction
+        """
+        with self.db.transaction() if write else nullcontext():
+            rows                =   self.db.rows(keys)
+            sub                 =   LogFrame(df=rows, primary_value=self.primary_value, primary_colname=self.primary_colname,
+                                         track_changes=True)
+            sub.working_col     =   self.working_col
+            result              =   method(sub, *args, **kwargs)
+            if write:
+                self.db.write_cells([(rows.index[i], sub.df_sheet.columns[j], sub.df_sheet.iat[i, j]) for i, j in sub.dirty_cells()])
+        return result
+
+    def refresh(self):
+        """db mode: reloads df_sheet from the database, with the rows changed by the other processes"""
+        self.df_sheet           =   self.db.load()
+        return self.df_sheet
+
+    def pk_rows(self, primary_value):
+        """
+        returns the row positions for the primary_value using the primary value index,
+        the index is rebuilt when df_sheet is replaced or changes its length
+        """
+        key = (id(self.df_sheet), len(self.df_sheet), self.primary_colname)
+        if self._pk_key != key:
+            self.reindex()
+        return self._pk_index.get(_primary_key(primary_value), [])
+
+    def reindex(self):
+        """
+        rebuilds the primary value index, only needed if df_sheet[primary_colname] was modified directly
+        """
+        index = {}
+        for i, value in enumerate(self.df_sheet[self.primary_colname].values):
+            index.setdefault(_primary_key(value), []).append(i)
+        self._pk_index  =   index
+        self._pk_key    =   (id(self.df_sheet), len(self.df_sheet), self.primary_colname)
+
+    def rows_where(self, rows, expressions=[]):
+        """
+        filters the row positions with the where expressions (same syntax as `DataFrame.query`)
+        """
+        for expression in expressions:
+            if not rows: break
+            code = _compile_where(expression)
+            try:
+                if code is None or len(rows) > 32: raise ValueError(expression)               # many rows are filtered at once by query
+                columns = self.df_sheet.columns
+                rows = [i for i in rows if eval(code, {'__builtins__': {}}, dict(zip(columns, self.df_sheet.iloc[i].values)))]
+            except Exception:
+                sub = self.df_sheet.iloc[rows]
+                mask = sub.index.isin(sub.query(expression).index)
+                rows = [i for i, m in zip(rows, mask) if m]
+        return rows
+
+    def _count(self, rows, colname):
+        """count of non-empty (non NA) cells of colname in the given row positions"""
+        return self.df_sheet.iloc[rows, self.df_sheet.columns.get_loc(colname)].count() if rows else 0
+
+    def _set_cells(self, rows, colname, data):
+        """sets data in the given row positions of colname, the column is created if it does not exist"""
+        if colname not in self.df_sheet:
+            self.df_sheet[colname] = pd.Series(np.nan, index=self.df_sheet.index, dtype=object)
+        elif self.df_sheet[colname].dtype != object:
+            self.df_sheet[colname] = self.df_sheet[colname].astype(object)              # e.g empty csv columns are read as float
+        j = self.df_sheet.columns.get_loc(colname)
+        if self.track_changes:                      # otherwise the changes are found by comparing with df_sheet0
+            for i in rows:
+                if (i, colname) not in self._dirty: self._dirty[(i, colname)] = self.df_sheet.iat[i, j]
+        self.df_sheet.iloc[rows, j] = data
+        if colname == self.primary_colname:
+            self._pk_key = None
     
     def isval_unique(self, colname=''):
         """
@@ -181,6 +769,8 @@ class LogFrame:
         """
         colname = self.working_col if not colname else colname
         _, colv = self.col_data(colname='', data='', count=0, chk_colname=colname)
+        if colname == self.primary_colname:
+            return len(self.pk_rows(colv)) == 1
         c = self.df_sheet[colname].str.strip().value_counts()[colv]
         r = False if int(c)!=1 else True
         return r
@@ -220,23 +810,180 @@ class LogFrame:
         count = self.col_data(colname=colname, data=value, count=count, expressions=where)
         return count
     
+    def _key_rows(self, keys):
+        """row positions whose primary value is one of the keys (exact match as in col_data)"""
+        return np.flatnonzero(self.df_sheet[self.primary_colname].isin(keys).values).tolist()
+
+    def put_values(self, values, colname='', count=0, where=[], force=False):
+        """
+        puts many values at once, the bulk version of put_value
+
+        Input
+        ---
+
+        :values:    {primary_value: value} or a pd.Series indexed by the primary values
+        :colname:   column to change, working_col if not given
+        :where:     expressions (same syntax as `DataFrame.query`) the rows also have to match
+        :force:     as in col_data, only fills the rows of primary values whose colname cells are all empty
+
+        Returns
+        ---
+
+        count + number of primary values written, to use with update_sheet(count, failed)
+        """
+        colname                 =   self.working_col if not colname else colname
+        values                  =   values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+        values                  =   values[~values.index.duplicated(keep='last')]
+        if self.db is not None:
+            return self._in_db(values.index, LogFrame.put_values, values, colname, count, where, force)
+        pkeys                   =   self.df_sheet[self.primary_colname]
+        allrows                 =   self._key_rows(values.index)
+        rows                    =   self.rows_where(allrows, where)
+        if force and rows and colname in self.df_sheet:
+            filled              =   self.df_sheet[colname].iloc[allrows].notna().values
+            filled_keys         =   set(pkeys.iloc[allrows][filled])
+            if filled_keys:
+                print("not updating", len(filled_keys), f"{self.primary_colname} values with {colname} already filled")
+                rows            =   [i for i in rows if pkeys.iat[i] not in filled_keys]
+        if not rows:
+            return count
+        keys                    =   pkeys.iloc[rows]
+        self._set_cells(rows, colname, keys.map(values).tolist())
+        return count + keys.nunique()
+
+    def get_values(self, keys, colname='', where=[]):
+        """
+        gets the values of many primary values at once, the bulk version of get_value
+
+        Returns
+        ---
+
+        pd.Series indexed by the keys, with the stripped string value of the first matching row,
+        '' if the primary value is not found or its cells in colname are all empty
+        """
+        colname                 =   self.working_col if not colname else colname
+        keys                    =   pd.Index(keys)
+        if self.db is not None:
+            return self._in_db(keys, LogFrame.get_values, keys, colname, where, write=False)
+        pkeys                   =   self.df_sheet[self.primary_colname]
+        j                       =   self.df_sheet.columns.get_loc(colname)
+        allrows                 =   self._key_rows(keys)
+        rows                    =   self.rows_where(allrows, where)
+        filled                  =   self.df_sheet.iloc[allrows, j].notna().values
+        filled_keys             =   set(pkeys.iloc[allrows][filled])
+        found                   =   pd.Series(self.df_sheet.iloc[rows, j].values, index=pkeys.iloc[rows].values, dtype=object)
+        found                   =   found[~found.index.duplicated(keep='first')]
+        found                   =   found[found.index.isin(list(filled_keys))].map(lambda v: str(v).strip())
+        return found.reindex(keys, fill_value='')
+
+    def mark_dirty(self, index, colnames):
+        """
+        marks cells which were changed directly in df_sheet e.g lf.df_sheet.loc[0, 'TSYS'] = True
+        so that they are sent by update_sheet, index and colnames can be a single label or a list of labels
+        (only needed with track_changes=True, otherwise all differences to df_sheet0 are sent)
+        """
+        if not self.track_changes: return
+        index       =   [index] if not isinstance(index, (list, tuple, pd.Index)) else index
+        colnames    =   [colnames] if isinstance(colnames, str) else colnames
+        rows        =   [self.df_sheet.index.get_loc(label) for label in index]
+        for i in rows:
+            for colname in colnames:
+                self._dirty[(i, colname)] = _UNKNOWN
+
+    def dirty_cells(self):
+        """
+        returns sorted (row position, column position) of the changed cells
+        """
+        cells       =   []
+        for (i, colname), old in self._dirty.items():
+            j       =   self.df_sheet.columns.get_loc(colname)
+            if old is _UNKNOWN or not _same_value(old, self.df_sheet.iat[i, j]):
+                cells.append((i, j))
+        return sorted(cells)
+
+    def changed_cells(self):
+        """
+        returns the cells changed since the LogFrame was created (or last updated) as a list of (primary_value, colname, value)
+        """
+        pcol            =   self.df_sheet.columns.get_loc(self.primary_colname)
+        if self.track_changes:
+            return [(str(self.df_sheet.iat[i, pcol]).strip(), self.df_sheet.columns[j], self.df_sheet.iat[i, j]) for i, j in self.dirty_cells()]
+        df0             =   self.df_sheet0.reindex(index=self.df_sheet.index, columns=self.df_sheet.columns)
+        I, J            =   np.where(self.df_sheet.astype(str).ne(df0.astype(str)) & ~(self.df_sheet.isna() & df0.isna()))
+        return [(str(self.df_sheet.iat[i, pcol]).strip(), self.df_sheet.columns[j], self.df_sheet.iat[i, j]) for i, j in zip(I, J)]
+
+    def apply_changes(self, changes):
+        """
+        applies (primary_value, colname, value) changes e.g from changed_cells() of another LogFrame,
+        the values are written as they are, returns the number of cells changed
+        """
+        if self.db is not None:
+            return self._in_db({primary_value for primary_value, _, _ in changes}, LogFrame.apply_changes, changes)
+        n                       =   0
+        for primary_value, colname, value in changes:
+            rows                =   self.pk_rows(primary_value)
+            if rows:
+                self._set_cells(rows, colname, value)
+                n               +=  1
+        return n
+
+    def checkpoint(self, compact=False):
+        """
+        csv mode: appends the changed cells to the delta log of the csv (lf.store), compact=True rewrites the whole csv
+        returns the number of cells written
+        """
+        if self.track_changes:
+            dirty               =   list(self._dirty)
+            cells               =   [(i, self.df_sheet.columns[j]) for i, j in self.dirty_cells()]
+        else:
+            df0                 =   self.df_sheet0.reindex(index=self.df_sheet.index, columns=self.df_sheet.columns)
+            I, J                =   np.where(self.df_sheet.astype(str).ne(df0.astype(str)) & ~(self.df_sheet.isna() & df0.isna()))
+            cells               =   [(i, self.df_sheet.columns[j]) for i, j in zip(I, J)]
+        if compact:
+            self.store.compact(self.df_sheet)
+            n                   =   len(cells)
+        else:
+            n                   =   self.store.checkpoint(self.df_sheet, cells)
+        if self.track_changes:
+            for cell in dirty: self._dirty.pop(cell, None)
+        else:
+            self.df_sheet0      =   self.df_sheet.copy(deep=True)
+        return n
+
     def update_sheet(self, count, failed, by_cell=True, comment_col='Comment4', csvfile = 'df_sheet.csv'):
         """
         updates the google sheet if there is atleast one new count/failed count for the update
+        in csv mode the changed cells are checkpointed to the csv instead (see checkpoint)
+        in db mode the cells are already in the database, use alfrd.progressdb.SheetExporter (`alfrd sync`) for the sheet
         """
-        # -----  Cool down update to keep it below 60 request/minute
-        tf                          =   time.time()
-        td                          =   tf-self.t0
-        self.df_sheet.fillna('',inplace=True)       # avoid (NaN) errors: Out of range float values are not JSON compliant
-        if td<=1 and (self.update_cooldown_count >=  1) and (count - self.registered[0] or failed - self.registered[1]):
-            time.sleep(1)
-            self.update_cooldown_count   =   0
+        if self.db is not None:
+            self.registered          =   count, failed
+            self.t0                  =   time.time()
+            return
+        if self.csvmode:
+            if count - self.registered[0] or failed - self.registered[1]:
+                self.checkpoint(compact=not by_cell)
+                self.registered = count, failed
+            else:
+                print('skipped')
+            self.t0                  =   time.time()
+            return
+        # -----  requests are kept below 60 request/minute by the GSC limiter
+        if not (by_cell and self.track_changes):
+            self.df_sheet.fillna('',inplace=True)   # avoid (NaN) errors: Out of range float values are not JSON compliant
             
         try:
             if count - self.registered[0] or failed - self.registered[1]:
                 if not by_cell:
                     self.gsc.update(self.df_sheet)
                     self.update_cooldown_count       +=  1
+                    self._dirty.clear()
+                elif self.track_changes:
+                    dirty           =   list(self._dirty)
+                    cells           =   self.dirty_cells()
+                    if self.gsc.update_cell(self.df_sheet, [i for i, _ in cells], [j for _, j in cells]):
+                        for cell in dirty: self._dirty.pop(cell, None)                  # the sent values are the new baseline
+                    self.update_cooldown_count       +=  1
                 else:
                     I, J = np.where(self.df_sheet.astype(str).ne(self.df_sheet0.astype(str)))
                     self.gsc.update_cell(self.df_sheet, I, J)
@@ -251,7 +998,74 @@ class LogFrame:
             self.df_sheet.to_csv(csvfile)
         self.t0                      =   time.time()
 
+    async def aupdate_sheet(self, count, failed, by_cell=True, comment_col='Comment4', csvfile = 'df_sheet.csv'):
+        """
+        asyncio version of update_sheet e.g
+
+            await asyncio.gather(lf1.aupdate_sheet(count, failed), lf2.aupdate_sheet(count, failed))
+
+        the changed cells are taken when it is called, df_sheet can be changed while the request runs
+        (cells changed again in the meantime stay dirty for the next update)
+        in csv mode the changed cells are checkpointed to the csv instead and in db mode they are already
+        in the database, as in update_sheet
+        """
+        if self.db is not None:
+            self.registered          =   count, failed
+            self.t0                  =   time.time()
+            return
+        if self.csvmode:
+            if count - self.registered[0] or failed - self.registered[1]:
+                self.checkpoint(compact=not by_cell)
+                self.registered = count, failed
+            else:
+                print('skipped')
+            self.t0                  =   time.time()
+            return
+        try:
+            if count - self.registered[0] or failed - self.registered[1]:
+                if not by_cell:
+                    self.df_sheet.fillna('',inplace=True)
+                    self._dirty.clear()
+                    await self.gsc.aupdate(self.df_sheet)
+                elif self.track_changes:
+                    cells           =   self.dirty_cells()
+                    sent            =   {(i, self.df_sheet.columns[j]): self.df_sheet.iat[i, j] for i, j in cells}
+                    dirty           =   list(self._dirty)
+                    if await self.gsc.aupdate_cell(self.df_sheet, [i for i, _ in cells], [j for _, j in cells]):
+                        for cell in dirty:
+                            if cell in sent and not _same_value(sent[cell], self.df_sheet.at[self.df_sheet.index[cell[0]], cell[1]]):
+                                self._dirty[cell] = sent[cell]                          # changed again, the sent value is the baseline
+                            else:
+                                self._dirty.pop(cell, None)
+                else:
+                    self.df_sheet.fillna('',inplace=True)
+                    I, J = np.where(self.df_sheet.astype(str).ne(self.df_sheet0.astype(str)))
+                    await self.gsc.aupdate_cell(self.df_sheet, I, J)
+                self.update_cooldown_count       +=  1
+                self.registered = count, failed
+            else:
+                print('skipped')
+        except Exception as e:
+            traceback.print_exc()
+            print(f'failed to update on google sheet: {e}')
+            failed  =   self.col_data(colname=comment_col, data=f'failed:{e}', count=failed)
+            self.df_sheet.to_csv(csvfile)
+        self.t0                      =   time.time()
+
+    @property
+    def color(self):
+        if self._color is None:
+            from gspread_formatting import Color
+            self._color ={'g': Color(red=0.56,green=0.77,blue=0.49),
+                'r': Color(red=0.8784314,green=0.4,blue=0.4),
+                'rh': Color(red=0.71,green=0.13,blue=0.0),
+                'rl': Color(red=0.98,green=0.63,blue=0.57),
+                'gl': Color(red=0.42,green=0.86,blue=0.31),
+                'gh': Color(red=0.42,green=0.60,blue=0.42)}
+        return self._color
+
     def create_conditional_format(self, range, c='g', valtype='timeinmin', custom_clr=None):
+        from gspread_formatting import ConditionalFormatRule, GridRange, BooleanCondition, BooleanRule, CellFormat
         clr = self.color[c] if not custom_clr else custom_clr
         rule ={
                 'timeinmin' : ConditionalFormatRule(
@@ -286,6 +1100,7 @@ class LogFrame:
         return rule[valtype]
 
     def create_rule(self, range, type='TEXT_CONTAINS', value='True',  c='g', custom_clr=None):
+        from gspread_formatting import ConditionalFormatRule, GridRange, BooleanCondition, BooleanRule, CellFormat
         clr = self.color[c] if not custom_clr else custom_clr
         return ConditionalFormatRule(
             ranges=[GridRange.from_a1_range(f'{range}', self.gsc.sheet)],
@@ -296,15 +1111,18 @@ class LogFrame:
                 )))
     
     def create_color(self, r=0.56,g=0.77,b=0.49):
+        from gspread_formatting import Color
         return Color(red=r,green=g,blue=b)
     
     def add_conditional_format(self, *new_rules):
+        from gspread_formatting import get_conditional_format_rules
         rules = get_conditional_format_rules(self.gsc.sheet)
         for rule in new_rules:
             rules.append(rule)
         rules.save()
 
     def clear_conditional_format(self,):
+        from gspread_formatting import get_conditional_format_rules
         rules = get_conditional_format_rules(self.gsc.sheet)
         rules.clear()
         rules.save()
\ No newline at end of file
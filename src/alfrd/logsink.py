@@ -0,0 +1,284 @@
+from pathlib import Path
+from contextlib import contextmanager
+import io, os, re, sys, time, gzip, atexit, threading
+from collections import deque
+from alfrd.util import build_steplogpath
+
+_ANSI = re.compile(r'\x1b\[[0-9;]*m')
+_SAFE_NAME = re.compile(r'[^\w.-]+')
+
+class StepLog:
+    """
+    Buffered log file of one step, colour codes are removed.
+    Not thread-safe, the LogSink only uses it while holding the lock of the thread context.
+
+    :compress:  gzip the file (`.gz` is added to the name)
+    :max_bytes: rotate the file when it is larger on disk (0 never rotates, gzip: the compressed size), the rotated
+                files get .1, .2, .. up to `backups`
+    """
+    def __init__(self, path, compress=False, max_bytes=0, backups=3, bufsize=1024**2):
+        self.path           =   Path(f"{path}.gz" if compress else path)
+        self.compress       =   compress
+        self.max_bytes      =   max_bytes
+        self.backups        =   backups
+        self.bufsize        =   bufsize
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        if self.compress:
+            self._raw       =   open(self.path, 'ab')
+            self.f          =   io.TextIOWrapper(io.BufferedWriter(gzip.GzipFile(fileobj=self._raw, mode='ab'), self.bufsize), encoding='utf-8')
+        else:
+            self._raw       =   None
+            self.f          =   open(self.path, 'a', buffering=self.bufsize, encoding='utf-8')
+        self.size           =   self.path.stat().st_size if self.path.exists() else 0
+
+    def write(self, text):
+        if '\x1b' in text: text = _ANSI.sub('', text)
+        self.f.write(text)
+        if self.compress:
+            self.size       =   self._raw.tell()                     # compressed bytes, the buffered text is counted once compressed
+        else:
+            self.size       +=  len(text.encode('utf-8', 'replace'))
+        if self.max_bytes and self.size > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self.close()
+        for k in range(self.backups, 0, -1):
+            src             =   self.path if k == 1 else Path(f"{self.path}.{k-1}")
+            if src.exists(): os.replace(src, f"{self.path}.{k}")
+        if not self.backups: self.path.unlink()
+        self._open()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+        if self._raw is not None: self._raw.close()             # GzipFile does not close the file it was given
+
+class _Context:
+    """output state of one thread: padding, step log and the chunks written since the last drain"""
+    __slots__ = ('padding', 'log', 'line_start', 'chunks', 'lock', 'thread')
+
+    def __init__(self):
+        self.padding        =   0
+        self.log            =   None
+        self.line_start     =   True
+        self.chunks         =   deque()
+        self.lock           =   threading.Lock()
+        self.thread         =   threading.current_thread()
+
+class _RoutedStream(io.TextIOBase):
+    """sys.stdout/sys.stderr replacement handing the writes to the LogSink"""
+    def __init__(self, sink, stream, buffered=True):
+        self.sink           =   sink
+        self.stream         =   stream
+        self.buffered       =   buffered
+
+    def write(self, text):
+        # a write only appends to the chunks of the thread, padding and log files are handled per chunk batch
+        if type(text) is not str:
+            text            =   bytes(text).decode(errors='replace')    # e.g. click.echo of bytes
+        try:
+            ctx             =   self.sink._local.ctx
+        except AttributeError:
+            ctx             =   self.sink._context()
+        if not self.buffered:
+            self.sink._write_now(ctx, text, self.stream)
+            return len(text)
+        chunks              =   ctx.chunks
+        chunks.append(text)                                     # deque.append is atomic, no lock needed
+        if len(chunks) >= 4096: self.sink._drain(ctx)
+        return len(text)
+
+    def flush(self):
+        self.sink.flush()
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    @property
+    def encoding(self):
+        return self.stream.encoding
+
+class LogSink:
+    """
+    Thread-safe replacement of the stdout/stderr monkeypatch (util.padded_output) for pipeline runs.
+
+    Every thread has its own context: the padding of the terminal view and the log file of the step it runs,
+    so concurrent steps do not mix their padding or logs. A write only appends the text to the buffer of its
+    thread, the buffer is handled in batches (every `flush_interval` seconds, 4096 writes or at the end of a
+    step): the text goes unchanged (colour codes removed) to the buffered log file of the step, indentation is
+    only added for the terminal view.
+
+        LOG_SINK.configure(log_dir='logs/', compress=True, max_bytes=100*1024**2).install()
+        with LOG_SINK.step('flag_data'), LOG_SINK.padded(4):
+            print('...')            # logs/flag_data.log_2024-01-31-12_00_00.gz and the terminal (indented)
+    """
+    def __init__(self, log_dir=None, compress=False, max_bytes=0, backups=3, terminal=True, flush_interval=0.2):
+        self.configure(log_dir, compress, max_bytes, backups, terminal)
+        self.flush_interval =   flush_interval
+        self.installed      =   False
+        self.stdout         =   None
+        self.stderr         =   None
+        self._local         =   threading.local()
+        self._contexts      =   []
+        self._lock          =   threading.Lock()                # terminal writes and the list of contexts
+        self._flusher       =   None
+        self._pid           =   os.getpid()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def configure(self, log_dir=None, compress=False, max_bytes=0, backups=3, terminal=True):
+        """
+        log_dir:    folder of the step log files, None writes no files
+        terminal:   False only writes the output of the steps to their log files
+        """
+        self.log_dir        =   log_dir
+        self.compress       =   compress
+        self.max_bytes      =   max_bytes
+        self.backups        =   backups
+        self.terminal       =   terminal
+        return self
+
+    def install(self):
+        """routes sys.stdout and sys.stderr through the sink"""
+        if not self.installed:
+            self.stdout     =   _RoutedStream(self, sys.stdout)
+            self.stderr     =   _RoutedStream(self, sys.stderr, buffered=False)
+            sys.stdout, sys.stderr  =   self.stdout, self.stderr
+            self.installed  =   True
+            self._start_flusher()
+            atexit.register(self.uninstall)
+        return self
+
+    def uninstall(self):
+        if self.installed:
+            self.flush()
+            self.installed  =   False
+            sys.stdout, sys.stderr  =   self.stdout.stream, self.stderr.stream
+            atexit.unregister(self.uninstall)
+
+    def _context(self):
+        try:
+            return self._local.ctx
+        except AttributeError:
+            ctx             =   self._local.ctx =   _Context()
+            with self._lock:
+                self._contexts.append(ctx)
+            return ctx
+
+    @contextmanager
+    def padded(self, padding=4):
+        """indents the terminal output of this thread by `padding` more spaces while the block runs"""
+        ctx                 =   self._context()
+        self.flush()                                            # output of all threads so far goes first
+        with ctx.lock:
+            self._emit_chunks(ctx)
+            previous        =   ctx.padding
+            ctx.padding     =   previous + padding
+        try:
+            yield
+        finally:
+            with ctx.lock:
+                self._emit_chunks(ctx)
+                ctx.padding =   previous
+
+    @contextmanager
+    def step(self, step_name, tag=''):
+        """
+        writes the output of this thread to the log file of the step while the block runs
+
+        tag:    added to the name of the log file e.g the row of `alfrd run --over-rows`
+        """
+        ctx                 =   self._context()
+        if not (self.installed and self.log_dir):
+            yield None
+            return
+        name                =   f"{step_name}_{_SAFE_NAME.sub('_', str(tag))}" if tag else step_name
+        name                =   name if os.getpid() == self._pid else f"{name}_{os.getpid()}"
+        log                 =   StepLog(build_steplogpath(self.log_dir, name, ext='.gz' if self.compress else ''), compress=self.compress,
+                                        max_bytes=self.max_bytes, backups=self.backups)
+        self.flush()
+        with ctx.lock:
+            self._emit_chunks(ctx)
+            previous, ctx.log   =   ctx.log, log
+        try:
+            yield log
+        finally:
+            with ctx.lock:
+                self._emit_chunks(ctx)
+                ctx.log     =   previous
+                log.close()
+            self.flush()
+
+    def _emit(self, ctx, text, stream):
+        """writes a batch of text to the step log and (padded) to the terminal, called with ctx.lock held"""
+        if ctx.log is not None:
+            ctx.log.write(text)
+            if not self.terminal: return
+        out                 =   text
+        if ctx.padding:
+            pad             =   ' ' * ctx.padding
+            out             =   (pad if ctx.line_start and text[0] != '\n' else '') + text[:-1].replace('\n', '\n' + pad) + text[-1]
+        ctx.line_start      =   text[-1] == '\n'
+        with self._lock:
+            stream.write(out)
+
+    def _emit_chunks(self, ctx):
+        chunks              =   ctx.chunks
+        if chunks:
+            text            =   ''.join([chunks.popleft() for _ in range(len(chunks))])
+            if text: self._emit(ctx, text, self.stdout.stream)
+
+    def _drain(self, ctx, flush_log=False):
+        with ctx.lock:
+            self._emit_chunks(ctx)
+            if flush_log and ctx.log is not None: ctx.log.flush()
+
+    def _write_now(self, ctx, text, stream):
+        """unbuffered write (stderr), the buffered output of the thread goes first"""
+        with ctx.lock:
+            self._emit_chunks(ctx)
+            if text: self._emit(ctx, text, stream)
+        with self._lock:
+            self.stdout.stream.flush()
+            stream.flush()
+
+    def flush(self):
+        """writes the buffered output of all threads"""
+        if not self.installed: return
+        with self._lock:
+            contexts        =   list(self._contexts)
+        for ctx in contexts:
+            self._drain(ctx, flush_log=True)
+        with self._lock:
+            self.stdout.stream.flush()
+            self._contexts  =   [ctx for ctx in self._contexts if ctx.chunks or ctx.thread.is_alive()]
+
+    def _start_flusher(self):
+        def flush_loop():
+            while self.installed:
+                time.sleep(self.flush_interval)
+                self.flush()
+        self._flusher       =   threading.Thread(target=flush_loop, name='alfrd-logsink', daemon=True)
+        self._flusher.start()
+
+    def _after_fork(self):
+        """locks may have been held by other threads of the parent, worker processes start with new ones"""
+        self._lock          =   threading.Lock()
+        self._local         =   threading.local()
+        self._contexts      =   []
+        if self.installed:
+            self._start_flusher()
+
+LOG_SINK = LogSink()
@@ -1,19 +1,37 @@
 from pathlib import Path
 
-import inspect, io, sys
-from typing import Callable, Dict, List
+import inspect, io, sys, threading, ast, json, os, time
+from typing import Callable, Dict, List, Optional
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import typer
-from alfrd.util import update_existing_dict, padded_output
+from alfrd.util import update_existing_dict, padded_output, resolve_lazy
+from alfrd.cache import STEP_CACHE, Uncacheable
+from alfrd.resources import RESOURCE_GATE, ResourceGate
+from alfrd.logsink import LOG_SINK
 import traceback
+from collections import ChainMap
+from contextlib import contextmanager
 
 REGISTERED_STEPS: Dict[str, Dict[str, str]] = {}
 VALIDATE_BEFORE: Dict[str, Dict[str, List[str]]] = {}
 VALIDATE_AFTER: Dict[str, Dict[str, List[str]]] = {}
 VALIDATORS: Dict[str, Dict[str, str]] = {}
 
-def register(desc: str):
-    """Decorator to register a pipeline step with required parameters."""
+def register(desc: str, after: Optional[List[str]] = None, cache: bool = False,
+             mem_gb: float = 0, cpus: float = 0, scratch_gb: float = 0):
+    """Decorator to register a pipeline step with required parameters.
+
+    :after:     steps (names or functions) this step depends on, e.g. ``@register(desc, after=[step_a])``.
+                If not given the step depends on the step preceding it in the run order.
+    :cache:     reuse the result of an earlier run with the same source, parameters and input files (see alfrd.cache),
+                only the return value is restored, so use it for steps without other side effects.
+    :mem_gb:    expected memory, cpus and scratch disk of the step, the step waits until the machine has them free
+    :cpus:      (see alfrd.resources.ResourceGate)
+    :scratch_gb:
+    """
+    if after is not None:
+        after = [_after.__name__ if callable(_after) else _after for _after in after]
     def decorator(func: Callable):
         
         default_params, required_params = {},[]
@@ -29,10 +47,41 @@ def register(desc: str):
         if name in REGISTERED_STEPS:
             raise ValueError(f"Step with name '{name}' already registered!")
         REGISTERED_STEPS[name] = {"desc": desc, "function": func, "default_params": default_params,
-                                  "required_params": required_params}
+                                  "required_params": required_params, "after": after, "cache": cache,
+                                  "mem_gb": mem_gb, "cpus": cpus, "scratch_gb": scratch_gb}
         return func
     return decorator
 
+def register_command(desc: str, timeout: Optional[float] = None, ok_codes=(0,), cwd: Optional[str] = None,
+                     env: Optional[dict] = None, **kwargs):
+    """Decorator to register a step running an external program (CASA, rPicard, ...), the function returns the command.
+
+        @register_command("Run rPicard", timeout=6*3600)
+        def rpicard(wd_ifolder, nproc=4):
+            return ['mpirun', '-n', nproc, 'rPicard', '-i', wd_ifolder]
+
+    The program runs in an asyncio subprocess, its stdout/stderr lines are streamed into the step log as they
+    arrive. At most `alfrd run --max-commands` programs run at the same time (see alfrd.commands).
+
+    :timeout:   seconds, the program is terminated when it runs longer and the step fails
+    :ok_codes:  exit codes which count as success, other exit codes fail the step (prev_step_success=False)
+    :cwd:       working directory of the program, :env: variables added to the environment
+    :kwargs:    after, cache, mem_gb, cpus, scratch_gb as for ``register``
+    """
+    def decorator(func: Callable):
+        @wraps(func)                                # the parameters of the step are the ones of func
+        def step(*args, **params):
+            command         =   func(*args, **params)
+            if command is None:
+                print("nothing to run")
+                return None
+            from alfrd.commands import run_command      # asyncio is only imported when a program is run
+            return run_command(command, timeout=timeout, ok_codes=ok_codes, cwd=cwd, env=env, name=func.__name__)
+        register(desc, **kwargs)(step)
+        REGISTERED_STEPS[func.__name__]["command"] = True
+        return step
+    return decorator
+
 def validate(by: List[str]):
     """Decorator to validate a pipeline step."""
     by = [_by.__name__ if callable(_by) else _by for _by in by]    
@@ -79,8 +128,11 @@ def validator(desc: str, after: bool = False, run_once: bool = False):
         return func
     return decorator
 
-def load_projects(project_dir: str):
-    """Load projects from a specified directory."""
+def load_projects(project_dir: str, only: Optional[List[str]] = None):
+    """Load projects from a specified directory.
+
+    :only:      load only these plugin files in the given order (e.g. from `manifest_files`) instead of every *.py
+    """
     project_dir_path = Path(project_dir)
     import importlib.util
     # Check if the project directory exists, if not, create it
@@ -89,7 +141,7 @@ def load_projects(project_dir: str):
         project_dir_path.mkdir(parents=True)
     
     # Loop through all Python files in the project directory
-    for project_path in project_dir_path.glob("*.py"):
+    for project_path in (project_dir_path.glob("*.py") if only is None else [Path(path) for path in only]):
         module_name = project_path.stem
         
         spec = importlib.util.spec_from_file_location(module_name, project_path)
@@ -99,6 +151,192 @@ def load_projects(project_dir: str):
     if not REGISTERED_STEPS:
         print("No steps found. Add projects to the projects directory.")
 
+MANIFEST_CACHE = Path("~/.alfrd/cache/manifest.json").expanduser()
+_DECORATORS = {'register', 'register_command', 'validator', 'validate'}
+
+def _literal(node):
+    """value of a decorator argument, names of functions (e.g. in after=[step_a]) are returned as strings"""
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        pass
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [_literal(elt) for elt in node.elts]
+    return None
+
+def scan_plugin(path):
+    """_finds the steps and validators of a plugin file from its decorators without importing it_
+
+    Args:
+        path (_str_): _plugin file_
+
+    Returns:
+        _dict_: _{'steps': [...], 'validators': [...], 'dynamic': bool} in the order of the file,
+                dynamic if steps are also registered by calling register/register_command (not as decorator)_
+    """
+    tree                    =   ast.parse(Path(path).read_text(), filename=str(path))
+    steps, validators       =   [], []
+    decorators              =   set()
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        found               =   {}
+        for dec in node.decorator_list:
+            if not isinstance(dec, ast.Call):
+                continue
+            decorators.add(id(dec))
+            dec_name        =   dec.func.id if isinstance(dec.func, ast.Name) else getattr(dec.func, 'attr', '')
+            if dec_name in _DECORATORS:
+                kwargs      =   {kw.arg: _literal(kw.value) for kw in dec.keywords if kw.arg}
+                args        =   [_literal(arg) for arg in dec.args]
+                found[dec_name] = (args, kwargs)
+        if 'validator' in found:
+            args, kwargs    =   found['validator']
+            validators.append({"name": node.name, "desc": kwargs.get('desc', args[0] if args else ''),
+                               "after": bool(kwargs.get('after', args[1] if len(args) > 1 else False)),
+                               "run_once": bool(kwargs.get('run_once', args[2] if len(args) > 2 else False))})
+        for dec_name in found:
+            if dec_name == 'validator' or dec_name == 'validate':
+                continue
+            args, kwargs    =   found[dec_name]
+            by              =   found.get('validate', ([], {}))
+            by              =   by[1].get('by', by[0][0] if by[0] else []) or []
+            steps.append({"name": node.name, "desc": kwargs.get('desc', args[0] if args else ''),
+                          "after": kwargs.get('after'), "cache": bool(kwargs.get('cache', False)),
+                          **{k: kwargs[k] for k in ('mem_gb', 'cpus', 'scratch_gb') if kwargs.get(k)},
+                          "validate_by": [str(v) for v in by], "lineno": node.lineno})
+    dynamic                 =   any(isinstance(node, ast.Call) and id(node) not in decorators and
+                                    (node.func.id if isinstance(node.func, ast.Name) else getattr(node.func, 'attr', '')) in ('register', 'register_command')
+                                    for node in ast.walk(tree))
+    return {"steps": steps, "validators": validators, "dynamic": dynamic}
+
+def project_manifest(project_dir: str, cache_path=None):
+    """_steps and validators of all plugin files in a project, without importing them_
+
+    The scan of each file is cached in ~/.alfrd/cache/manifest.json by path, mtime and size.
+    A step (or validator) defined in several files is listed with the file scanned last and a warning is printed,
+    register() raises if the files are imported together.
+
+    Returns:
+        _dict_: _{'steps': {name: info}, 'validators': {name: info}, 'dynamic': [files]}, info['file'] is the plugin file,
+                the steps of the dynamic files are only known once they are imported (see project_steps)_
+    """
+    cache_path              =   Path(cache_path or MANIFEST_CACHE)
+    try:
+        cache               =   json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        cache               =   {}
+    changed                 =   False
+    manifest                =   {"steps": {}, "validators": {}, "dynamic": []}
+    for project_path in Path(project_dir).glob("*.py"):
+        try:
+            st              =   project_path.stat()
+        except OSError:
+            continue
+        key                 =   str(project_path)
+        stamp               =   [st.st_mtime_ns, st.st_size]
+        if key not in cache or cache[key]['stamp'] != stamp or 'dynamic' not in cache[key]:
+            try:
+                cache[key]  =   {"stamp": stamp, **scan_plugin(project_path)}
+            except (SyntaxError, ValueError, OSError) as e:
+                print(f"could not read {project_path}: {e}")
+                continue
+            changed         =   True
+        for kind in ("steps", "validators"):
+            for info in cache[key][kind]:
+                if info["name"] in manifest[kind] and manifest[kind][info["name"]]["file"] != key:
+                    print(f"{kind[:-1]} '{info['name']}' is defined in {Path(manifest[kind][info['name']]['file']).name} and {project_path.name}, "
+                          f"the one of {project_path.name} is listed (importing both fails)")
+                manifest[kind][info["name"]] = {**info, "file": key}
+        if cache[key]["dynamic"]: manifest["dynamic"].append(key)
+    if changed:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp                 =   cache_path.with_suffix(f'.tmp{os.getpid()}')
+        tmp.write_text(json.dumps(cache))
+        os.replace(tmp, cache_path)
+    return manifest
+
+def project_steps(project_dir: str, manifest=None):
+    """_the steps of a project in their order, from the manifest, or by importing the plugins if some steps are only
+    known then (registered without decorator)_
+    """
+    manifest                =   manifest or project_manifest(project_dir)
+    if not manifest["dynamic"]:
+        return manifest["steps"]
+    load_projects(project_dir)
+    return REGISTERED_STEPS
+
+def manifest_files(manifest, steps: List[str]):
+    """plugin files needed to run the steps, every file comes after the files of the validators used by its steps
+
+    A loaded file registers all of its steps, so the validators of its other steps (and in turn their files) are needed too.
+    """
+    validate_by             =   {}                  # file -> validators used by the steps of the file
+    for info in manifest["steps"].values():
+        validate_by.setdefault(info["file"], []).extend(info["validate_by"])
+    files, visiting         =   {}, set()
+    def add(path):
+        if path in files or path in visiting: return
+        visiting.add(path)
+        for val_name in validate_by.get(path, []):
+            if val_name in manifest["validators"]:
+                add(manifest["validators"][val_name]["file"])
+        visiting.discard(path)
+        files[path]         =   None
+    for step_name in steps:
+        add(manifest["steps"][step_name]["file"])
+    return list(files)
+
+def step_graph(steps: List[str], known=None):
+    """builds the dependency graph for the given sequence of steps
+
+    Steps registered with ``after`` depend on those steps (when they are part of this run),
+    all other steps depend on the step preceding them in the sequence.
+
+    Args:
+        steps (_list_): _step names in the run order_
+        known (_list_): _all step names of the project, default: the registered steps_
+
+    Raises:
+        ValueError: _if a dependency is not registered or the dependencies are cyclic_
+
+    Returns:
+        _dict_: _step name -> list of step names it waits for_
+    """
+    graph                   =   {}
+    for s, step_name in enumerate(steps):
+        after               =   REGISTERED_STEPS[step_name].get('after')
+        if after is None:
+            graph[step_name]    =   [steps[s-1]] if s else []
+        else:
+            for dep in after:
+                if dep not in (known if known is not None else REGISTERED_STEPS):
+                    raise ValueError(f"Step '{step_name}' depends on '{dep}' which is not registered!")
+            graph[step_name]    =   [dep for dep in after if dep in steps and dep != step_name]
+
+    # check for cycles by repeatedly removing steps without pending dependencies
+    pending                 =   {k: set(v) for k, v in graph.items()}
+    while pending:
+        ready               =   [k for k, v in pending.items() if not v]
+        if not ready:
+            raise ValueError(f"Cyclic step dependencies between: {', '.join(pending)}")
+        for k in ready: del pending[k]
+        for v in pending.values(): v.difference_update(ready)
+    return graph
+
+def _dependency_order(steps: List[str], graph):
+    """the steps ordered so that every step comes after the steps it waits for, otherwise in the run order"""
+    order, placed           =   [], set()
+    while len(order) < len(steps):
+        step_name           =   next(s for s in steps if s not in placed and all(dep in placed for dep in graph[s]))
+        order.append(step_name)
+        placed.add(step_name)
+    return order
+
 def iterate_over_lst(lst):
     """Decorator to apply a function to each element in lst."""
     def decorator(func):
@@ -137,6 +375,19 @@ def iterate_over_lst(lst):
 #             print(logs)
 #             print(f"--- [END LOGS] ---\n")
 
+_VALIDATOR_LOCKS: Dict[str, threading.Lock] = {}
+_VALIDATOR_LOCKS_GUARD  =   threading.Lock()
+
+def _validator_lock(name):
+    """the lock of a `run_once` validator so that concurrent steps do not run it twice, other validators run unlocked"""
+    with _VALIDATOR_LOCKS_GUARD:
+        if name not in _VALIDATOR_LOCKS: _VALIDATOR_LOCKS[name] = threading.Lock()
+        return _VALIDATOR_LOCKS[name]
+
+@contextmanager
+def _nullcontext(*args, **kwargs):
+    yield
+
 class PipelineRun:
     def __init__(self):
         self.params                 =   {}
@@ -147,6 +398,121 @@ class PipelineRun:
         self.validate_once          =   False
         self.prev_step_success      =   None
         self.validation_success     =   None
+        self.pad_output             =   True
+        self.use_cache              =   True
+        self.cached                 =   False
+        self.profiler               =   None
+        self.journal                =   None            # alfrd.journal.RunJournal of `alfrd run`
+        self.admitted               =   False           # resources of the step already reserved by run_dag
+
+    def reset(self):
+        """clears params and the state of the previous steps"""
+        use_cache, profiler, journal    =   self.use_cache, self.profiler, self.journal
+        self.__init__()
+        self.use_cache              =   use_cache
+        self.profiler               =   profiler
+        self.journal                =   journal
+
+    def padded(self, padding=4):
+        """padded stdout for this run, per thread with the LOG_SINK, else disabled for concurrently running steps"""
+        if LOG_SINK.installed:
+            return LOG_SINK.padded(padding)
+        return padded_output(padding) if self.pad_output else _nullcontext()
+
+    def profiled(self, name, cat='step'):
+        """records the block with the profiler of the run (alfrd run --profile), does nothing without one"""
+        return self.profiler.record(name, cat, project=self.project_name) if self.profiler else _nullcontext()
+
+    def fork(self, step_name=''):
+        """_creates a run for a single step which can be executed next to other steps_
+
+        The forked run reads the shared params but keeps `ret`/`ret_valid` and other writes
+        local until the step is done.
+
+        Args:
+            step_name (_str_): _name of the step to run_
+
+        Returns:
+            _PipelineRun_: _the forked run_
+        """
+        run                         =   PipelineRun()
+        run.params                  =   ChainMap({}, self.params)
+        run.project_name            =   self.project_name
+        run.use_cache               =   self.use_cache
+        run.profiler                =   self.profiler
+        run.journal                 =   self.journal
+        run.step_name               =   step_name
+        run.prev_step_success       =   True
+        run.validation_success      =   True
+        return run
+
+    def run_dag(self, steps: List[str], execute: Callable, jobs: int = 1, known=None):
+        """_runs the steps respecting their dependencies, independent steps run concurrently_
+
+        Args:
+            steps (_list_): _step names in the run order_
+            execute (_callable_): _execute(run, step_name) runs validators and the step, returns True if the step finished_
+            jobs (_int_): _maximum number of steps running at the same time_
+            known (_list_): _all step names of the project, see step_graph_
+
+        The params written by a step (e.g. `ret`) are seen by the steps depending on it, not by the steps running next
+        to it. When all steps are done they are merged into self.params in the dependency order of the steps (ties in
+        the run order), so `ret` is the one of the last step of this order whichever step finished last.
+
+        Returns:
+            _dict_: _step name -> True (finished), False (skipped) or None (failed)_
+        """
+        graph                       =   step_graph(steps, known=known)
+        order                       =   _dependency_order(steps, graph)
+        ancestors                   =   {}
+        for step_name in order:
+            ancestors[step_name]    =   set(graph[step_name]).union(*(ancestors[dep] for dep in graph[step_name]))
+        pending                     =   {step_name: graph[step_name] for step_name in steps}
+        done, running, queued       =   {}, {}, set()
+        written                     =   {}                                  # step name -> params written by the step
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            while pending or running:
+                for step_name, deps in list(pending.items()):
+                    if any(not done[dep] for dep in deps if dep in done):
+                        del pending[step_name]
+                        done[step_name]     =   False
+                        print(f" skipped  : {step_name} (waits for {', '.join(d for d in deps if not done.get(d, True))})")
+                    elif all(dep in done for dep in deps) and len(running) < max(1, jobs):
+                        request             =   ResourceGate.request(REGISTERED_STEPS.get(step_name, {}))
+                        if not RESOURCE_GATE.try_acquire(step_name, request):
+                            if step_name not in queued:
+                                print(f" queued   : {step_name} (waits for {', '.join(f'{k}={v}' for k, v in request.items())})")
+                                queued.add(step_name)
+                            continue
+                        del pending[step_name]
+                        run                 =   self.fork(step_name)
+                        run.params          =   ChainMap({}, self._merged(order, written, ancestors[step_name]))
+                        run.pad_output      =   jobs <= 1
+                        run.admitted        =   True
+                        running[pool.submit(execute, run, step_name)] = (step_name, run)
+                if not running:
+                    if pending: time.sleep(RESOURCE_GATE.interval)
+                    continue
+                finished, _         =   wait(running, timeout=RESOURCE_GATE.interval if queued & set(pending) else None,
+                                             return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step_name, run  =   running.pop(future)
+                    RESOURCE_GATE.release(step_name)
+                    try:
+                        done[step_name]     =   bool(future.result())
+                    except Exception:
+                        done[step_name]     =   None
+                    written[step_name]      =   run.params.maps[0]
+        self.params.update(self._merged(order, written, written))
+        return done
+
+    def _merged(self, order, written, step_names):
+        """the params with the params written by the step_names applied in the dependency order"""
+        params                      =   dict(self.params)
+        for step_name in order:
+            if step_name in step_names and step_name in written:
+                params.update(written[step_name])
+        return params
 
     def init_params(self, params):
         self.params                 =   {**params, **self.params}
@@ -180,7 +546,7 @@ class PipelineRun:
             if default_params:    update_existing_dict(default_params,self.params)
             
             required_params     =   {k: self.params.get(k, None) for k in required_params}
-            default_params      =   {**default_params, **required_params}
+            default_params      =   {k: resolve_lazy(v) for k, v in {**default_params, **required_params}.items()}     # glob values are expanded only for the steps using them
             
         return default_params
         
@@ -193,10 +559,27 @@ class PipelineRun:
         step_params                         =   self.all_step_params(required_params=required_params, default_params=default_params)
         
         func                                =   step["function"]
+        cache_key                           =   None
+        self.cached                         =   False
+        if step.get("cache") and self.use_cache:
+            try:
+                cache_key                   =   STEP_CACHE.key(func, step_params)
+            except Uncacheable as e:
+                print(f"not using the cache for {self.step_name}: {e}")
+            if cache_key:
+                self.cached, result         =   STEP_CACHE.get(cache_key)
+                if self.cached:
+                    typer.secho(f"Cache hit! {self.step_name} ({cache_key[:12]})", fg=typer.colors.GREEN)
+                    self.prev_step_success  =   True
+                    self.params['ret']      =   result
+                    return
         
         try:
-            result                          =   func(**step_params) if len(step_params) else func()
+            request                         =   {} if self.admitted else ResourceGate.request(step)
+            with RESOURCE_GATE.admitted(self.step_name, request), self.profiled(self.step_name):
+                result                      =   func(**step_params) if len(step_params) else func()
             self.prev_step_success          =   True
+            if cache_key: STEP_CACHE.put(cache_key, result)
         except Exception as e:
             self.prev_step_success          =   False
             result                          =   str(e)
@@ -206,31 +589,38 @@ class PipelineRun:
         self.params['ret']                  =   result
 
     def run_validations(self):
-        result                                  =   None
         if self.step_name in self.validate_steps:
             this_step                           =   self.validate_steps[self.step_name]
             
             for validator_func in this_step["functions"]:
                 
                 validator_name                  =   validator_func.__name__
-                run_count                       =   VALIDATORS[validator_name]['run_count']
-                if not (run_count>0 and VALIDATORS[validator_name]['run_once']) and self.validation_success!=False:
-                    try:
-                        print(f"• {validator_name}")
-                        required_params         =   VALIDATORS[validator_name]['required_params']       # taking from global.
-                        default_params          =   VALIDATORS[validator_name]['default_params']
-                        validator_params        =   self.all_step_params(required_params=required_params, default_params=default_params)
-                        self.prev_step_success  =   True                                                # this will change if error is raised.
-                        with padded_output(3):
-                            result                  =   validator_func(**validator_params) if len(validator_params) else validator_func()
-                        
-                        if self.validation_success is None: self.validation_success = result
-                        VALIDATORS[validator_name]['run_count'] += 1
-                        self.params['ret_valid']        =   result
-                    except ValueError as e:
-                        self.prev_step_success  =   False
-                        typer.secho(f"Validation Failed! {e}", fg=typer.colors.RED)
-                        result                  =   str(e)
-                        traceback.print_exc()
-                        raise typer.Exit()
-                
\ No newline at end of file
+                if VALIDATORS[validator_name]['run_once']:
+                    with _validator_lock(validator_name):
+                        self._run_validator(validator_func, validator_name)
+                else:
+                    self._run_validator(validator_func, validator_name)
+
+    def _run_validator(self, validator_func, validator_name):
+        result                          =   None
+        run_count                       =   VALIDATORS[validator_name]['run_count']
+        if not (run_count>0 and VALIDATORS[validator_name]['run_once']) and self.validation_success!=False:
+            try:
+                print(f"• {validator_name}")
+                required_params         =   VALIDATORS[validator_name]['required_params']       # taking from global.
+                default_params          =   VALIDATORS[validator_name]['default_params']
+                validator_params        =   self.all_step_params(required_params=required_params, default_params=default_params)
+                self.prev_step_success  =   True                                                # this will change if error is raised.
+                with self.padded(3), self.profiled(f"{validator_name} ({self.step_name})", 'validator'):
+                    result                  =   validator_func(**validator_params) if len(validator_params) else validator_func()
+                
+                if self.validation_success is None: self.validation_success = result
+                VALIDATORS[validator_name]['run_count'] += 1
+                self.params['ret_valid']        =   result
+            except ValueError as e:
+                self.prev_step_success  =   False
+                typer.secho(f"Validation Failed! {e}", fg=typer.colors.RED)
+                result                  =   str(e)
+                traceback.print_exc()
+                raise typer.Exit()
+        return result
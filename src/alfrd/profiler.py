@@ -0,0 +1,141 @@
+from pathlib import Path
+from contextlib import contextmanager
+from collections import Counter
+import os, sys, time, json, threading
+
+try:
+    import resource
+except ImportError:                                     # not available on windows
+    resource = None
+
+def _children_maxrss():
+    """largest peak RSS (bytes) of the finished child processes"""
+    if resource is None: return 0
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+class StepProfiler:
+    """
+    Records wall time, CPU time, peak RSS (including child processes) and I/O bytes of the pipeline steps
+    and validators, and saves them as a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev).
+
+    CPU time is the time of the thread running the step plus the time of child processes which finished
+    during the step, the peak RSS is sampled every `interval` seconds for the process and its children.
+    Child processes, RSS and I/O are measured for the whole process: a step which ran next to another step
+    (alfrd run --jobs) is charged for the work of the other as well, its numbers are marked approximate
+    ("approx": true in the trace, ~ in the summary).
+    With sample=True the stacks of the running steps are sampled as well and saved as `<path>.folded`
+    (one "step;module:function;..." line per stack with its count, e.g. for flamegraph.pl or speedscope).
+    """
+    def __init__(self, path, interval=0.05, sample=False):
+        import psutil
+        self.path           =   Path(path)
+        self.interval       =   interval
+        self.sample         =   sample
+        self.events         =   []
+        self.stacks         =   Counter()
+        self.process        =   psutil.Process()
+        self.t0             =   time.perf_counter()
+        self._active        =   {}                  # id -> {'peak': bytes, 'tid': thread id, 'name': name, 'overlap': bool}
+        self._lock          =   threading.Lock()
+        self._stop          =   threading.Event()
+        self._sampler       =   threading.Thread(target=self._sample_loop, name='alfrd-profiler', daemon=True)
+        self._sampler.start()
+
+    def _rss(self):
+        rss = 0
+        try:
+            rss = self.process.memory_info().rss
+            for child in self.process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except Exception:
+                    pass
+        except Exception:
+            pass
+        return rss
+
+    def _io(self):
+        try:
+            io = self.process.io_counters()
+            return io.read_bytes, io.write_bytes
+        except (AttributeError, NotImplementedError, Exception):
+            return None
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                if not self._active: continue
+                active = list(self._active.values())
+            rss = self._rss()
+            frames = sys._current_frames() if self.sample else {}
+            with self._lock:
+                for record in active:
+                    record['peak'] = max(record['peak'], rss)
+                    frame = frames.get(record['tid'])
+                    if frame is not None:
+                        stack = []
+                        while frame is not None:
+                            stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                            frame = frame.f_back
+                        self.stacks[';'.join([record['name']] + stack[::-1])] += 1
+
+    @contextmanager
+    def record(self, name, cat='step', **args):
+        """measures the code inside the with block as one trace event"""
+        tid                 =   threading.get_ident()
+        record              =   {'peak': self._rss(), 'tid': tid, 'name': name, 'overlap': False}
+        with self._lock:
+            for other in self._active.values():
+                if other['tid'] != tid:             # a validator recorded within its step is not an overlap
+                    other['overlap'] = record['overlap'] = True
+            self._active[id(record)] = record
+        children0           =   os.times()
+        maxrss0             =   _children_maxrss()
+        io0                 =   self._io()
+        cpu0                =   time.thread_time() if hasattr(time, 'thread_time') else time.process_time()
+        start               =   time.perf_counter()
+        try:
+            yield record
+        finally:
+            end             =   time.perf_counter()
+            cpu             =   (time.thread_time() if hasattr(time, 'thread_time') else time.process_time()) - cpu0
+            children        =   os.times()
+            cpu             +=  (children.children_user - children0.children_user) + (children.children_system - children0.children_system)
+            maxrss          =   _children_maxrss()
+            io              =   self._io()
+            with self._lock:
+                del self._active[id(record)]
+            peak            =   max(record['peak'], self._rss(), maxrss if maxrss > maxrss0 else 0)
+            event_args      =   {**{k: str(v) for k, v in args.items()}, 'wall_s': round(end - start, 6), 'cpu_s': round(cpu, 6),
+                                 'peak_rss_mb': round(peak / 1024**2, 2)}
+            if io and io0:
+                event_args.update({'read_mb': round((io[0]-io0[0]) / 1024**2, 3), 'write_mb': round((io[1]-io0[1]) / 1024**2, 3)})
+            if record['overlap']:
+                event_args['approx'] = True         # other steps ran at the same time
+            with self._lock:
+                self.events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                                    'ts': round((start - self.t0) * 1e6), 'dur': round((end - start) * 1e6), 'args': event_args})
+
+    def summary(self):
+        """prints one line per recorded step/validator"""
+        print(f"  {'name':30} {'type':10} {'wall':>10} {'cpu':>10} {'peak rss':>12}")
+        for event in sorted(self.events, key=lambda e: e['ts']):
+            a = event['args']
+            approx = '~' if a.get('approx') else ' '
+            print(f"  {event['name'][:30]:30} {event['cat']:10} {a['wall_s']:>9.2f}s {approx}{a['cpu_s']:>8.2f}s {approx}{a['peak_rss_mb']:>8.1f} MB")
+        if any(event['args'].get('approx') for event in self.events):
+            print("  ~ ran next to other steps, their child processes, memory and I/O are included")
+
+    def save(self):
+        """stops the sampler and writes the trace (and the sampled stacks)"""
+        self._stop.set()
+        self._sampler.join()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        if self.sample and self.stacks:
+            with open(f"{self.path}.folded", 'w') as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        return self.path
@@ -0,0 +1,356 @@
+from contextlib import contextmanager
+import os, time, socket, sqlite3, threading
+import pandas as pd
+from alfrd import c
+
+ROW     =   '_row'          # stable row id of the progress table (INTEGER PRIMARY KEY, not part of the loaded dataframe)
+LEASE_COLUMNS = ('LEASE_HOST', 'LEASE_PID', 'LEASE_UNTIL')       # worker holding a row and until when (epoch seconds)
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _sql_value(value):
+    """cell value as stored in sqlite: NA becomes NULL, numpy scalars are converted, bools are kept as 'True'/'False' as on the sheet"""
+    try:
+        if pd.isna(value): return None
+    except (TypeError, ValueError):
+        pass
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)): value = value.item()
+    if isinstance(value, bool): return str(value)
+    return value if isinstance(value, (int, float, str, bytes)) else str(value)
+
+class SQLiteStore:
+    """
+    SQLite (WAL) backend of LogFrame(db=...) shared by several alfrd processes on one node.
+
+    Every row level change is an UPDATE by the indexed primary column inside a `BEGIN IMMEDIATE` transaction,
+    so processes recording progress at the same time do not overwrite each other's rows (readers are not blocked
+    in WAL mode). Every changed cell is also appended to `<table>_changes`, which SheetExporter sends to the
+    google sheet in bulk.
+
+    :table:             name of the progress table
+    :primary_colname:   primary column, stored as TEXT and indexed
+    :timeout:           seconds to wait for the write lock of another process
+    :wal:               WAL needs all processes on the same host, use wal=False (rollback journal) for a database
+                        on a shared filesystem with working file locks used by several nodes
+    """
+    def __init__(self, path, table='progress', primary_colname='FILE_NAME', timeout=60, wal=True):
+        self.path           =   str(path)
+        self.table          =   table
+        self.primary_colname=   primary_colname
+        self.timeout        =   timeout
+        self.wal            =   wal
+        self._columns       =   set()
+        self._local         =   threading.local()
+
+    def _connect(self):
+        """one connection per thread and process, connections are not shared with forked workers"""
+        conn                =   getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn            =   sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute(f"PRAGMA journal_mode={'WAL' if self.wal else 'DELETE'}")
+            conn.execute(f"PRAGMA synchronous={'NORMAL' if self.wal else 'FULL'}")
+            self._local.conn, self._local.pid   =   conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """write transaction, nested blocks join the outer one"""
+        conn                =   self._connect()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def exists(self):
+        return self._connect().execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (self.table,)).fetchone() is not None
+
+    def create(self, df):
+        """creates the progress table from a dataframe (e.g. the sheet or csv), the rows keep their order"""
+        if df is None:
+            raise ValueError(f"{self.path} has no table '{self.table}', give a csv, gsc or df to create it")
+        if self.primary_colname not in df:
+            raise ValueError(f"primary column '{self.primary_colname}' not found in the columns: {list(df.columns)}")
+        t, pk               =   _quote(self.table), _quote(self.primary_colname)
+        columns             =   ', '.join(f"{_quote(col)} TEXT" if col == self.primary_colname else _quote(col) for col in df.columns)
+        with self.transaction() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {t} ({_quote(ROW)} INTEGER PRIMARY KEY, {columns})")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {_quote(self.table + '_pk')} ON {t} ({pk})")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {_quote(self.table + '_changes')} (id INTEGER PRIMARY KEY AUTOINCREMENT, row INTEGER, colname TEXT)")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {_quote(self.table + '_meta')} (key TEXT PRIMARY KEY, value)")
+            if conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] == 0:
+                conn.executemany(f"INSERT INTO {t} ({', '.join(_quote(col) for col in df.columns)}) VALUES ({', '.join('?' * len(df.columns))})",
+                                 ([_sql_value(v) for v in row] for row in df.itertuples(index=False, name=None)))
+        self._columns       =   set(df.columns)
+        return self
+
+    def columns(self):
+        names               =   [r[1] for r in self._connect().execute(f"PRAGMA table_info({_quote(self.table)})")]
+        self._columns       =   set(names) - {ROW}
+        return [name for name in names if name != ROW]
+
+    def _frame(self, cursor, index=False):
+        names               =   [d[0] for d in cursor.description]
+        df                  =   pd.DataFrame(cursor.fetchall(), columns=names, dtype=object)
+        return df.set_index(ROW) if index else df.drop(columns=ROW)
+
+    def load(self):
+        """the whole table as a dataframe"""
+        return self._frame(self._connect().execute(f"SELECT * FROM {_quote(self.table)} ORDER BY {_quote(ROW)}"))
+
+    def rows(self, keys):
+        """the rows of the primary values as a dataframe indexed by their row id"""
+        keys, cursor, frames =  [str(key) for key in keys], None, []
+        conn                =   self._connect()
+        for k in range(0, max(len(keys), 1), 500):                                  # sqlite limits the number of parameters
+            chunk           =   keys[k:k+500]
+            cursor          =   conn.execute(f"SELECT * FROM {_quote(self.table)} WHERE {_quote(self.primary_colname)} IN ({', '.join('?' * len(chunk))}) "
+                                             f"ORDER BY {_quote(ROW)}", chunk)
+            frames.append(self._frame(cursor, index=True))
+        return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+    def _add_column(self, conn, colname):
+        if colname in self._columns: return
+        if colname not in self.columns():                                           # another process may have added it
+            conn.execute(f"ALTER TABLE {_quote(self.table)} ADD COLUMN {_quote(colname)}")
+            self._columns.add(colname)
+
+    def write_cells(self, cells):
+        """
+        writes [(row id, colname, value)] and records them for the exporter, returns the number of cells written
+        """
+        if not cells: return 0
+        bycol               =   {}
+        for row, colname, value in cells:
+            bycol.setdefault(colname, []).append((_sql_value(value), int(row)))
+        with self.transaction() as conn:
+            for colname, values in bycol.items():
+                self._add_column(conn, colname)
+                conn.executemany(f"UPDATE {_quote(self.table)} SET {_quote(colname)} = ? WHERE {_quote(ROW)} = ?", values)
+                conn.executemany(f"INSERT INTO {_quote(self.table + '_changes')} (row, colname) VALUES (?, ?)",
+                                 [(row, colname) for _, row in values])
+        return len(cells)
+
+    def get_meta(self, key, default=None):
+        row                 =   self._connect().execute(f"SELECT value FROM {_quote(self.table + '_meta')} WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self._connect().execute(f"INSERT OR REPLACE INTO {_quote(self.table + '_meta')} (key, value) VALUES (?, ?)", (key, value))
+
+    def changes(self, after=0):
+        """[(change id, row id, colname)] recorded after the change id"""
+        return self._connect().execute(f"SELECT id, row, colname FROM {_quote(self.table + '_changes')} WHERE id > ? ORDER BY id", (after,)).fetchall()
+
+    def forget_changes(self, upto):
+        self._connect().execute(f"DELETE FROM {_quote(self.table + '_changes')} WHERE id <= ?", (upto,))
+
+class LeaseManager:
+    """
+    Claims rows of the progress table for a worker, so several `alfrd worker` processes (or nodes) share a survey.
+
+    claim(n) takes the next n rows with an empty status column whose lease is free or expired, and marks them with
+    the host, pid and lease expiry of this worker (LEASE_COLUMNS) in one transaction. The heartbeat renews the leases
+    of the held rows every ttl/3 seconds. finish() writes the status and frees the lease. If the worker crashes its
+    leases are not renewed, so the rows are claimed again by another worker once they expire.
+
+        leases = LeaseManager(SQLiteStore('progress.db'), status_col='STATUS', ttl=600)
+        with leases.heartbeat():
+            for row_id, row in leases.claim(10).iterrows():
+                ...
+                leases.finish(row_id, 'done')
+
+    :ttl:   seconds a lease lasts without a heartbeat
+    """
+    def __init__(self, store, status_col='STATUS', ttl=600):
+        self.store          =   store
+        self.status_col     =   status_col
+        self.ttl            =   ttl
+        self.host           =   socket.gethostname()
+        self.pid            =   os.getpid()
+        self.held           =   set()               # row ids claimed by this worker
+        self._lock          =   threading.Lock()
+        self._stop          =   threading.Event()
+
+    def _owned(self, conn, rows):
+        """the row ids which are still leased to this worker"""
+        host, pid, _        =   (_quote(col) for col in LEASE_COLUMNS)
+        rows                =   [int(row) for row in rows]
+        return [r[0] for r in conn.execute(f"SELECT {_quote(ROW)} FROM {_quote(self.store.table)} WHERE {_quote(ROW)} IN ({', '.join('?' * len(rows))}) "
+                                           f"AND {host} = ? AND {pid} = ?", (*rows, self.host, self.pid))] if rows else []
+
+    def claim(self, n=1):
+        """claims up to n rows, returns them as a dataframe indexed by row id (empty if there are none left)"""
+        status, until       =   _quote(self.status_col), _quote(LEASE_COLUMNS[2])
+        now                 =   time.time()
+        with self.store.transaction() as conn:
+            for colname in (self.status_col, *LEASE_COLUMNS):
+                self.store._add_column(conn, colname)
+            rows            =   self.store._frame(conn.execute(f"SELECT * FROM {_quote(self.store.table)} WHERE ({status} IS NULL OR {status} = '') "
+                                                               f"AND ({until} IS NULL OR {until} < ?) ORDER BY {_quote(ROW)} LIMIT ?", (now, int(n))), index=True)
+            expired         =   int(rows[LEASE_COLUMNS[2]].notna().sum())
+            if expired: print(f"{c['y']}Re-queued{c['x']} {expired} rows with an expired lease")
+            self.store.write_cells([(row, colname, value) for row in rows.index
+                                    for colname, value in zip(LEASE_COLUMNS, (self.host, self.pid, now + self.ttl))])
+        with self._lock:
+            self.held.update(rows.index)
+        return rows
+
+    def renew(self):
+        """extends the leases of the held rows, returns the number renewed (a lease which expired and was claimed again is dropped)"""
+        with self._lock:
+            rows            =   list(self.held)
+        if not rows: return 0
+        with self.store.transaction() as conn:
+            owned           =   self._owned(conn, rows)
+            conn.executemany(f"UPDATE {_quote(self.store.table)} SET {_quote(LEASE_COLUMNS[2])} = ? WHERE {_quote(ROW)} = ?",
+                             [(time.time() + self.ttl, row) for row in owned])           # not recorded for the exporter
+        lost                =   set(rows) - set(owned)
+        if lost:
+            print(f"{c['y']}Lost the lease{c['x']} of {len(lost)} rows")
+            with self._lock:
+                self.held  -=   lost
+        return len(owned)
+
+    def finish(self, row, status='done'):
+        """writes the status of the row and frees its lease"""
+        with self.store.transaction() as conn:
+            cells           =   [(row, self.status_col, status)]
+            if self._owned(conn, [row]):
+                cells      +=   [(row, colname, None) for colname in LEASE_COLUMNS]
+            self.store.write_cells(cells)
+        with self._lock:
+            self.held.discard(row)
+
+    def release(self, rows=None):
+        """frees the leases of the rows (default: all held rows) without a status, they can be claimed again right away"""
+        with self._lock:
+            rows            =   list(self.held if rows is None else rows)
+        if not rows: return
+        with self.store.transaction() as conn:
+            self.store.write_cells([(row, colname, None) for row in self._owned(conn, rows) for colname in LEASE_COLUMNS])
+        with self._lock:
+            self.held      -=   set(rows)
+
+    @contextmanager
+    def heartbeat(self):
+        """renews the leases in a background thread while the block runs, the rows still held at the end are released"""
+        def renew_loop():
+            while not self._stop.wait(self.ttl / 3):
+                try:
+                    self.renew()
+                except sqlite3.OperationalError as e:
+                    print(f"{c['y']}Lease renewal failed:{c['x']} {e}")
+        self._stop.clear()
+        thread              =   threading.Thread(target=renew_loop, name='alfrd-lease-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            self._stop.set()
+            thread.join()
+            self.release()
+
+class SheetExporter:
+    """
+    Sends the cells changed in a SQLiteStore to a google sheet in bulk, instead of every worker updating the sheet.
+
+    Rows are matched by the primary column (the n-th row of a primary value in the table is the n-th one on the sheet),
+    rows and columns which are not on the sheet yet are appended. The last exported change is kept in the database,
+    so a restarted exporter continues where it stopped. Use one exporter per database.
+
+        exporter = SheetExporter(SQLiteStore('progress.db'), GSC(url=...)).start(interval=60)
+        ...
+        exporter.stop()         # exports the remaining changes
+    """
+    def __init__(self, store, gsc):
+        self.store          =   store
+        self.gsc            =   gsc
+        self._stop          =   threading.Event()
+        self._thread        =   None
+
+    def export(self):
+        """sends the changes since the last export, returns the number of cells sent (None if sending failed)"""
+        changes             =   self.store.changes(after=self.store.get_meta('exported', 0))
+        if not changes: return 0
+        upto                =   changes[-1][0]
+        if getattr(self.gsc, 'df', None) is None: self.gsc.open()
+        sheet, pk           =   self.gsc.df.astype(object), self.store.primary_colname
+        rows                =   self.store._frame(self.store._connect().execute(f"SELECT * FROM {_quote(self.store.table)} WHERE {_quote(ROW)} IN "
+                                                                                 f"(SELECT DISTINCT row FROM {_quote(self.store.table + '_changes')} WHERE id <= ?)",
+                                                                                 (upto,)), index=True)
+        order               =   self.store._frame(self.store._connect().execute(f"SELECT {_quote(ROW)}, {_quote(pk)} FROM {_quote(self.store.table)} "
+                                                                                 f"ORDER BY {_quote(ROW)}"), index=True)[pk]
+        nth                 =   order.groupby(order.values).cumcount()                              # row id -> occurrence of its primary value
+        keys                =   sheet[pk].astype(str)
+        positions           =   dict(zip(zip(keys.values, keys.groupby(keys.values).cumcount().values), range(len(sheet))))
+
+        columns, nrows      =   list(sheet.columns), len(sheet)
+        cells, added        =   {}, []
+        for _, row, colname in changes:
+            if row not in rows.index: continue
+            if colname not in columns:
+                columns.append(colname)
+                cells[(1, len(columns))] = colname                                      # header of the new column
+            key             =   (str(rows.at[row, pk]), nth[row])
+            if key not in positions:
+                positions[key] = nrows + len(added)
+                added.append(row)
+                for j, col in enumerate(columns):                                       # new rows are sent completely
+                    if col in rows: cells[(positions[key]+2, j+1)] = rows.at[row, col]
+            cells[(positions[key]+2, columns.index(colname)+1)] = rows.at[row, colname]
+        cells               =   {cell: '' if value is None else value for cell, value in cells.items()}
+        self._grow(nrows + len(added) + 1, len(columns))
+        if cells and not self.gsc.send_cells(cells):
+            return None
+        for colname in columns[len(sheet.columns):]:
+            sheet[colname]  =   pd.Series(None, index=sheet.index, dtype=object)
+        if added:
+            sheet           =   pd.concat([sheet, rows.loc[added].reindex(columns=columns)], ignore_index=True)
+        for (i, j), value in cells.items():
+            if i > 1: sheet.iat[i-2, j-1] = value
+        self.gsc.df         =   sheet
+        with self.store.transaction():
+            self.store.set_meta('exported', upto)
+            self.store.forget_changes(upto)
+        return len(cells)
+
+    def _grow(self, nrows, ncols):
+        """adds rows/columns to the worksheet grid, cells outside of it can not be updated"""
+        ws                  =   getattr(self.gsc, 'sheet', None)
+        if ws is None or not hasattr(ws, 'row_count'): return
+        if nrows > ws.row_count: ws.add_rows(nrows - ws.row_count)
+        if ncols > ws.col_count: ws.add_cols(ncols - ws.col_count)
+
+    def start(self, interval=60):
+        """exports every `interval` seconds in a background thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread    =   threading.Thread(target=self.run, args=(interval,), name='alfrd-sheet-exporter', daemon=True)
+            self._thread.start()
+        return self
+
+    def run(self, interval=60):
+        """exports every `interval` seconds until stop() (or Ctrl-C when run in the foreground)"""
+        while True:
+            try:
+                n           =   self.export()
+                if n: print(f"{time.strftime('%H:%M:%S')} exported {n} cells")
+                elif n is None: print(f"{c['y']}Export failed,{c['x']} retrying in {interval}s")
+            except sqlite3.OperationalError as e:                                      # e.g. database locked for longer than the timeout
+                print(f"{c['y']}Export skipped:{c['x']} {e}")
+            if self._stop.wait(interval): return
+
+    def stop(self):
+        """stops the background thread and exports the remaining changes"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread    =   None
+        return self.export()
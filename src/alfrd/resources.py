@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+import os, sys, shutil, threading, time
+
+GB = 1024**3
+
+class ResourceGate:
+    """
+    Admission control for steps declaring resources with `@register(desc, mem_gb=.., cpus=.., scratch_gb=..)`.
+
+    A step is admitted when the live numbers of the machine (psutil available memory, idle cpus and
+    free disk of `scratch_dir`) cover its request, and so does what is left of the resources after the
+    reservations of the admitted steps, otherwise it waits (e.g. for the other reductions running on the node).
+    The reservations are taken from the memory/disk which was free when the first of the admitted steps was
+    admitted (and from all the cpus), not from the live numbers, which already exclude what the steps use.
+    A request larger than the whole machine is admitted once no other step is admitted, instead of waiting forever.
+
+    The reservations are kept per process: the workers of `alfrd run --over-rows` and other alfrd processes
+    do not see each other's reservations, only the resources the others already use (through the live numbers).
+
+    :reserve_mem_gb:    memory kept free for everything else running on the node
+    :interval:          seconds between re-checking the live numbers while a step waits
+    """
+    def __init__(self, scratch_dir='.', reserve_mem_gb=1.0, interval=2.0):
+        self.scratch_dir    =   scratch_dir
+        self.reserve_mem_gb =   reserve_mem_gb
+        self.interval       =   interval
+        self.reserved       =   {}                  # step name -> request
+        self._base          =   None                # free memory/disk when the first of the admitted steps was admitted
+        self._cpu_primed    =   False
+        self._cond          =   threading.Condition()
+        if 'psutil' in sys.modules: self._prime()    # not imported just for this, psutil stays out of the alfrd startup
+
+    def _prime(self):
+        """starts the cpu_percent measurement, the first cpu_percent(interval=None) only returns 0.0"""
+        import psutil
+        psutil.cpu_percent(interval=None)
+        self._cpu_primed    =   True
+
+    def _free(self):
+        import psutil
+        return {'mem_gb': psutil.virtual_memory().available / GB - self.reserve_mem_gb,
+                'scratch_gb': shutil.disk_usage(self.scratch_dir).free / GB}
+
+    @staticmethod
+    def request(step):
+        """the resources declared by a registered step, {} if it did not declare any"""
+        return {k: step[k] for k in ('mem_gb', 'cpus', 'scratch_gb') if step.get(k)}
+
+    def available(self):
+        """
+        live free resources of the machine, at most what is left after the reservations of the admitted steps
+
+        Returns
+        ---
+
+        {'mem_gb': .., 'cpus': .., 'scratch_gb': ..}
+        """
+        import psutil
+        if not self._cpu_primed:
+            self._cpu_primed =  True
+            psutil.cpu_percent(interval=0.1)        # a first sample, the next ones measure since the last check
+        ncpus           =   psutil.cpu_count() or 1
+        free            =   {**self._free(), 'cpus': ncpus * (100 - psutil.cpu_percent(interval=None)) / 100}
+        if not self.reserved:
+            return free
+        reserved        =   {k: sum(r.get(k, 0) for r in self.reserved.values()) for k in ('mem_gb', 'cpus', 'scratch_gb')}
+        # admitted steps may not have allocated their memory/cpus/disk yet, what they use is already missing in the live numbers
+        left            =   {'mem_gb': self._base['mem_gb'] - reserved['mem_gb'], 'cpus': ncpus - reserved['cpus'],
+                             'scratch_gb': self._base['scratch_gb'] - reserved['scratch_gb']}
+        return {k: min(free[k], left[k]) for k in free}
+
+    def total(self):
+        """resources of the whole machine"""
+        import psutil
+        return {'mem_gb': psutil.virtual_memory().total / GB - self.reserve_mem_gb, 'cpus': psutil.cpu_count() or 1,
+                'scratch_gb': shutil.disk_usage(self.scratch_dir).total / GB}
+
+    def fits(self, request):
+        if not request:
+            return True
+        free = self.available()
+        if all(request.get(k, 0) <= free[k] for k in free):
+            return True
+        total = self.total()
+        return not self.reserved and any(request.get(k, 0) > total[k] for k in total)
+
+    def try_acquire(self, name, request):
+        """admits the step if its request fits now, returns False otherwise"""
+        with self._cond:
+            if not self.fits(request):
+                return False
+            self._admit(name, request)
+            return True
+
+    def acquire(self, name, request, timeout=None):
+        """waits until the step is admitted, returns False on timeout"""
+        deadline, waiting   =   None if timeout is None else time.monotonic() + timeout, False
+        with self._cond:
+            while not self.fits(request):
+                if not waiting:
+                    print(f"waiting for resources: {name} ({', '.join(f'{k}={v}' for k, v in request.items())})")
+                    waiting =   True
+                wait        =   self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+                self._cond.wait(wait)
+            self._admit(name, request)
+            return True
+
+    def _admit(self, name, request):
+        if not request: return
+        if not self.reserved: self._base = self._free()
+        self.reserved[name] = request
+
+    def release(self, name):
+        with self._cond:
+            if self.reserved.pop(name, None) is not None:
+                if not self.reserved: self._base = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def admitted(self, name, request):
+        """holds the reservation of the step while the block runs"""
+        self.acquire(name, request)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+RESOURCE_GATE = ResourceGate(scratch_dir=os.environ.get('ALFRD_SCRATCH', '.'))
@@ -0,0 +1,78 @@
+"""
+Startup time budget for the alfrd CLI.
+
+    python -m alfrd.startup --max-import-ms 150 --max-help-ms 600
+
+tests/test_startup.py runs the same check with pytest (the budget there leaves room for slower CI machines).
+
+measures `import alfrd` with `python -X importtime` and the wall time of `alfrd --help` in fresh interpreters,
+and exits with 1 if the best of the runs is over the budget or if a heavy library is imported at startup.
+"""
+import subprocess, sys, time, argparse
+
+# libraries which should only be imported when a command needs them
+HEAVY_MODULES = ('numpy', 'pandas', 'gspread', 'gspread_formatting', 'google.oauth2', 'psutil', 'asyncio')
+
+def import_times(module='alfrd'):
+    """
+    imports the module in a fresh interpreter with -X importtime
+
+    Returns
+    ---
+
+    {imported module: cumulative time in ms}
+    """
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    times = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+def command_time(args=('--help',)):
+    """wall time in ms of running the alfrd cli in a fresh interpreter"""
+    code = f'import sys; from alfrd import alfrd_cli; sys.argv = ["alfrd", *{list(args)!r}]; alfrd_cli()'
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - t0) * 1000
+
+def check_startup(max_import_ms=150, max_help_ms=600, runs=5):
+    """
+    returns a list of problems, empty if the startup is within the budget
+    """
+    problems = []
+    best = min((import_times() for _ in range(runs)), key=lambda times: times.get('alfrd', 0))
+    import_ms = best.get('alfrd', 0)
+    heavy = sorted(name for name in best if name.split('.')[0] in HEAVY_MODULES or name in HEAVY_MODULES)
+    help_ms = min(command_time() for _ in range(runs))
+
+    print(f"import alfrd : {import_ms:8.1f} ms (budget {max_import_ms} ms)")
+    print(f"alfrd --help : {help_ms:8.1f} ms (budget {max_help_ms} ms)")
+    slowest = sorted(((ms, name) for name, ms in best.items() if '.' not in name and name != 'alfrd'), reverse=True)[:5]
+    print("slowest imports: " + ", ".join(f"{name} ({ms:.1f} ms)" for ms, name in slowest))
+
+    if import_ms > max_import_ms:
+        problems.append(f"import alfrd took {import_ms:.1f} ms > {max_import_ms} ms")
+    if help_ms > max_help_ms:
+        problems.append(f"alfrd --help took {help_ms:.1f} ms > {max_help_ms} ms")
+    if heavy:
+        problems.append(f"heavy modules imported at startup: {', '.join(heavy)}")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="check the startup time of the alfrd CLI")
+    parser.add_argument('--max-import-ms', type=float, default=150)
+    parser.add_argument('--max-help-ms', type=float, default=600)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    problems = check_startup(args.max_import_ms, args.max_help_ms, args.runs)
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,8 @@
-import numpy as np
 from pathlib import Path
 import os
-import subprocess, glob, shutil, time, json
+import glob, shutil, shlex, time, json
 from collections import defaultdict
-import sys
+import sys, threading
 from contextlib import contextmanager
 
 @contextmanager
@@ -23,15 +22,115 @@ def padded_output(padding=4):
     finally:
         sys.stdout.write = original_write
 
-def read_inputfile(folder,inputfile='.inp'):
+class LazyGlob(list):
+    """
+    glob pattern of a parameter file value, a list of the files which is only globbed (once) when it is first used,
+    resolve_lazy gives the plain list
+    """
+    def __init__(self, pattern, files=None):
+        super().__init__(files or [])
+        self.pattern    =   pattern
+        self._expanded  =   files is not None
+        self._error     =   False
+
+    def expand(self):
+        if not self._expanded:
+            self._expanded  =   True
+            try:
+                list.extend(self, glob.glob(f'{self.pattern}', recursive=True))
+            except Exception:
+                self._error =   True
+        return str(self.pattern) if self._error else list.copy(self)
+
+    def __reduce_ex__(self, protocol):
+        return LazyGlob, (self.pattern, self.expand())
+
+def _expanding(name):
+    method              =   getattr(list, name)
+    def expanded(self, *args, **kwargs):
+        self.expand()
+        return method(self, *args, **kwargs)
+    expanded.__name__   =   name
+    return expanded
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__iter__', '__reversed__', '__len__', '__contains__', '__repr__',
+              '__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__', '__add__', '__iadd__', '__mul__', '__rmul__', '__imul__',
+              'append', 'extend', 'insert', 'remove', 'pop', 'clear', 'index', 'count', 'sort', 'reverse', 'copy'):
+    setattr(LazyGlob, _name, _expanding(_name))
+
+def resolve_lazy(value):
+    """expands LazyGlob values (into a plain list), other values are returned as they are"""
+    return value.expand() if isinstance(value, LazyGlob) else value
+
+_GLOB               =   object()                # marks values which are glob patterns in the parsed file cache
+_INPUTFILE_CACHE    =   {}                      # file path -> ((mtime_ns, size), [(key, raw value, value)])
+
+def _infer_value(v):
+    """converts a raw parameter value by trying int, float, glob and bool (leading zeros are kept as string)"""
+    # check for leading zeros
+    if str(v).strip() and v.strip()[0] == '0':
+        return str(v).strip()
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        return float(v)
+    except ValueError:
+        pass
+    v = str(v).strip()
+    if "*" in v:
+        return _GLOB
+    return v.lower() == 'true' if (any(boolv == v.lower() for boolv in ['true', 'false'])) else v
+
+def _typed_value(v, kind):
+    """converts a raw parameter value with the type given in the schema"""
+    v = str(v).strip()
+    if kind == 'glob':
+        return LazyGlob(v)
+    if kind is bool:
+        return v.lower() in ('true', '1', 'yes')
+    return kind(v)
+
+def parse_inputfile(filepath):
+    """
+    parses one parameter file, cached by path, mtime and size
+
+    Returns
+    ---
+
+    list of (key, raw value, value) where value is _GLOB for glob patterns
+    """
+    st          =   os.stat(filepath)
+    stamp       =   (st.st_mtime_ns, st.st_size)
+    cached      =   _INPUTFILE_CACHE.get(filepath)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    entries     =   []
+    with open(filepath,'r') as f:
+        for p in f.read().splitlines():
+            if '#' in p:
+                continue
+            elif '=' in p:
+                k,v     =   p.split('=')
+                entries.append((k.strip(), v, _infer_value(v)))
+    _INPUTFILE_CACHE[filepath] = (stamp, entries)
+    return entries
+
+def read_inputfile(folder,inputfile='.inp', schema=None, lazy=False):
     """Read the input file and return a dictionary with the parameters.
 
+    :schema:    optional {parameter: type} e.g {'nchan': int, 'flag': bool, 'ms_files': 'glob'},
+                parameters without a type are converted by trying int, float, glob and bool
+    :lazy:      glob patterns are returned as LazyGlob and only expanded when used (see resolve_lazy)
+
     Returns
     ---
 
     (params, files, input_folder)
 
     """
+    schema = schema or {}
     params = defaultdict(list)
     input_folder= None
     files=glob.glob(f'{folder}/*{inputfile}',recursive=True)
@@ -41,33 +140,14 @@ def read_inputfile(folder,inputfile='.inp'):
         input_folder = str(Path(files[-1]).parent) + '/'
         for filepath in files:
             if inputfile in filepath:
-                with open(filepath,'r') as f:
-                    pr=f.read().splitlines()
-                    for p in pr:
-                        if '#' in p:
-                            continue
-                        elif '=' in p:
-                            k,v=p.split('=')
-                            # check for leading zeros
-                            if str(v).strip() and v.strip()[0] == '0':
-                                v   =   str(v).strip()
-                                
-                            else:
-                                try:
-                                    v=int(v)
-                                except:
-                                    try:
-                                        v=float(v)
-                                    except:
-                                        v=str(v).strip()
-                                        if "*" in v:
-                                            try:
-                                                v = glob.glob(f'{v}', recursive=True)
-                                            except:
-                                                v = str(v)
-                                        else:
-                                            v = v.lower() == 'true' if (any(boolv == v.lower() for boolv in ['true', 'false'])) else v
-                            params[k.strip()]=v
+                for k, raw, v in parse_inputfile(filepath):
+                    if k in schema:
+                        v   =   _typed_value(raw, schema[k])
+                    elif v is _GLOB:
+                        v   =   LazyGlob(str(raw).strip())
+                    if isinstance(v, LazyGlob) and not lazy:
+                        v   =   v.expand()
+                    params[k]=v
                             
     return params, files, input_folder
 
@@ -93,12 +173,12 @@ def read_metafile(metafile):
     return meta
 
 def find_size(fitsfile):
-    size = np.round(Path(fitsfile).stat().st_size/(1024*1024),2)
+    size = round(Path(fitsfile).stat().st_size/(1024*1024),2)
     if size >= 1024.0 : 
         size = size/1024
-        size = f"{np.round(size, 2)} GB"
+        size = f"{round(size, 2)} GB"
     else:
-        size = f"{np.round(size, 2)} MB"
+        size = f"{round(size, 2)} MB"
     return size
 
 def find_project(fitsfile):
@@ -122,40 +202,215 @@ def build_path(filepath):
                 pass
     return filepath
 
+FICLONE             =   0x40049409              # linux ioctl cloning a file (reflink) on btrfs, xfs, ...
+_REFLINK_DEVICES    =   {}                      # st_dev -> False if the filesystem does not support reflinks
+
+def _clone_file(src, dst, link='auto'):
+    """
+    copy_function of provision_template
+
+    link:   'auto'/'reflink': copy-on-write clone if the filesystem supports it, else a copy
+            'hardlink': hardlink (copy across filesystems), use detach() before changing such a file in place
+            'copy': a normal copy
+    """
+    if link == 'hardlink':
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    elif link in ('auto', 'reflink'):
+        dev         =   os.stat(os.path.dirname(dst) or '.').st_dev
+        if _REFLINK_DEVICES.get(dev, True):
+            try:
+                import fcntl
+                with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+                return dst
+            except (ImportError, OSError):
+                _REFLINK_DEVICES[dev]   =   False               # e.g EOPNOTSUPP, EXDEV: not tried again on this filesystem
+    return shutil.copy2(src, dst)
+
+def provision_template(ifolder, wd_ifolder, link='auto'):
+    """
+    sets up the input template of a working directory without copying the data when possible (see _clone_file),
+    reflinks share the blocks until a file is changed, hardlinks share the file itself
+    """
+    return shutil.copytree(ifolder, wd_ifolder, symlinks=True, copy_function=lambda src, dst: _clone_file(src, dst, link))
+
+def detach(filepath):
+    """
+    copy on first write for templates provisioned with link='hardlink':
+    replaces a hardlinked file by its own copy so that changing it does not change the template
+    """
+    filepath        =   Path(filepath)
+    if filepath.stat().st_nlink > 1:
+        tmp         =   filepath.with_name(f".{filepath.name}.tmp{os.getpid()}")
+        shutil.copy2(filepath, tmp)
+        os.replace(tmp, filepath)
+    return filepath
+
+class WDIndex:
+    """
+    Persistent index of the working directories of `tdir`: (project, fits file name) -> wd,
+    kept in `{tdir}/.alfrd_wd_index.jsonl` (one json record per line, appended by every process creating a wd).
+
+    dir_for_project looks the fits files up here instead of probing wd, wd_1, wd_2, .. and globbing `wd*/raw/`,
+    the index is built once by scanning tdir if it does not exist (see rebuild).
+    """
+    def __init__(self, tdir):
+        self.tdir           =   Path(tdir)
+        self.path           =   self.tdir / '.alfrd_wd_index.jsonl'
+        self.files          =   {}                  # (segment, fits file name) -> wd
+        self.wds            =   defaultdict(set)    # segment -> wds
+        self._offset        =   0
+        self._lock          =   threading.Lock()
+
+    def _apply(self, record):
+        if 'forget' in record:
+            path            =   record['forget'].rstrip('/')
+            gone            =   lambda wd: wd == path or wd.startswith(path + '/')
+            self.files      =   {k: v for k, v in self.files.items() if not gone(v)}
+            for segment, wds in self.wds.items(): self.wds[segment] = {wd for wd in wds if not gone(wd)}
+            return
+        self.wds[record['segment']].add(record['wd'])
+        if record.get('name'): self.files[(record['segment'], record['name'])] = record['wd']
+
+    def _read(self):
+        """applies the records appended (also by other processes) since the last read"""
+        if not self.path.exists():
+            self.rebuild()
+            return
+        if self.path.stat().st_size == self._offset: return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data            =   f.read()
+        end                 =   data.rfind(b'\n') + 1                       # a line still being written is read next time
+        for line in data[:end].splitlines():
+            try:
+                self._apply(json.loads(line))
+            except ValueError:
+                continue
+        self._offset        +=  end
+
+    def _write(self, records):
+        data                =   ''.join(json.dumps(record) + '\n' for record in records).encode()
+        fd                  =   os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+            os.write(fd, data)                                              # one append, lines of processes do not mix
+        finally:
+            os.close(fd)
+
+    def rebuild(self):
+        """scans tdir once for {segment}/wd*/raw/* and writes a new index, a tdir which does not exist yet is an empty index"""
+        records             =   []
+        self.files, self.wds, self._offset  =   {}, defaultdict(set), 0
+        if not self.tdir.is_dir(): return                                   # written by the first new_wd
+        with os.scandir(self.tdir) as segments:
+            for segment in segments:
+                if not segment.is_dir() or segment.name.startswith('.'): continue
+                with os.scandir(segment.path) as wds:
+                    for wd in wds:
+                        if not (wd.name == 'wd' or wd.name.startswith('wd_')) or not wd.is_dir(): continue
+                        wdpath  =   f"{self.tdir}/{segment.name}/{wd.name}"
+                        records.append({'segment': segment.name, 'wd': wdpath})
+                        if os.path.isdir(f"{wd.path}/raw"):
+                            records.extend({'segment': segment.name, 'wd': wdpath, 'name': raw.name} for raw in os.scandir(f"{wd.path}/raw"))
+        tmp                 =   self.path.with_name(f"{self.path.name}.tmp{os.getpid()}")
+        with open(tmp, 'w') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+        os.replace(tmp, self.path)
+        self._read()
+
+    def lookup(self, segment, name):
+        """
+        the wd holding the fits file name, None if there is none
+
+        files put into raw/ by other tools (e.g the split files) are looked for in the indexed wds of the project
+        """
+        with self._lock:
+            self._read()
+            wd              =   self.files.get((segment, name))
+            if wd and not os.path.lexists(f"{wd}/raw/{name}"):              # removed outside of alfrd
+                self._write([{'forget': wd}])
+                self._read()
+                wd          =   None
+            if wd is None:
+                wd          =   next((wd for wd in sorted(self.wds[segment]) if os.path.lexists(f"{wd}/raw/{name}")), None)
+                if wd: self._write([{'segment': segment, 'wd': wd, 'name': name}])
+            return wd
+
+    def new_wd(self, segment, base):
+        """reserves the next free wd, wd_1, wd_2, .. of the project (build_path naming) by creating it"""
+        with self._lock:
+            self._read()
+            taken           =   self.wds[segment]
+            numb            =   0
+            while True:
+                wd          =   base if not numb else f"{base}_{numb}"
+                numb        +=  1
+                if wd in taken: continue
+                try:
+                    os.makedirs(wd)                                         # fails if another process (or anything else) has it
+                except FileExistsError:
+                    continue
+                self._write([{'segment': segment, 'wd': wd}])
+                return wd
+
+    def add(self, segment, wd, name):
+        with self._lock:
+            self._write([{'segment': segment, 'wd': str(wd), 'name': name}])
+
+    def forget(self, path):
+        """drops the wd, or all wds in the folder of a project, from the index"""
+        with self._lock:
+            self._write([{'forget': str(path)}])
+
+_WD_INDEXES         =   {}                          # tdir -> WDIndex
+
+def wd_index(tdir):
+    """the WDIndex of tdir, shared within the process"""
+    key             =   str(Path(tdir).absolute())
+    if key not in _WD_INDEXES: _WD_INDEXES[key] = WDIndex(tdir)
+    return _WD_INDEXES[key]
+
 def symlink_bywd(wd, fitsfile, create=True):
     rawsymlink          =   f"{wd}/raw/{Path(fitsfile).name}" 
     Path(f"{wd}/raw").mkdir(parents=True, exist_ok=True)
     if create : os.symlink(fitsfile, rawsymlink)
     return rawsymlink
 
-def dir_for_project(fitsfile, tdir='/data/avi/reductions/100test/', ifolder='/data/avi/gh/picard/src/picard/input_template/', create=True, splitted=False):
+def dir_for_project(fitsfile, tdir='/data/avi/reductions/100test/', ifolder='/data/avi/gh/picard/src/picard/input_template/', create=True, splitted=False,
+                    link='auto'):
     """
-    looks for wd using project name
+    looks for wd using project name, the wds are found through the index of tdir (see WDIndex)
+
+    link:   how the input template is set up in a new wd, 'auto' (reflink or copy), 'hardlink' or 'copy' (see provision_template)
     """
     new                 =   True
     segment             =   find_project(fitsfile)
     wd                  =   f"{tdir}{segment}/wd"
     wd_ifolder          =   None
     lookfile            =   fitsfile if not splitted else f"{str(Path(fitsfile).stem)}_split{Path(fitsfile).suffix}"
+    index               =   wd_index(tdir)
+    found               =   index.lookup(segment, Path(lookfile).name)
     if create:
-        if not Path(f"{wd}/raw/{Path(lookfile).name}").exists():
-            wd                  =   build_path(wd)
-            
+        wd                  =   found or index.new_wd(segment, wd)
         try:
             rawsymlink = symlink_bywd(wd, fitsfile)
+            index.add(segment, wd, Path(fitsfile).name)
                
             wd_ifolder          =   f'{wd}/input_template/'
-            if not Path(wd_ifolder).exists():shutil.copytree(ifolder,wd_ifolder)
+            if not Path(wd_ifolder).exists():provision_template(ifolder,wd_ifolder,link=link)
         except Exception as e:
             print(f"exists? : {segment} : {e}")
             new             =   False
     
         new             =   False
     else:
-        possible_file = glob.glob(f'{wd}*/raw/{Path(lookfile).name}')
-        
-        if len(possible_file):
-            wd_ifolder = Path(possible_file[0]).parent.parent / "input_template"
+        if found:
+            wd_ifolder = Path(found) / "input_template"
             new = False
     return wd_ifolder, new
 
@@ -167,15 +422,23 @@ def del_extra_wdfolder(wd_ifolder, fitsfile):
     Note: assumes wd_1, wd_2 etc are created by mistake
     """
     if 'wd_' in str(wd_ifolder):
-        subprocess.run(['rm','-rf', str(Path(wd_ifolder).parent.parent)])
+        from alfrd.cleanup import remove_paths
+        remove_paths([Path(wd_ifolder).parent.parent])
+        wd_index(Path(wd_ifolder).parent.parent.parent).forget(Path(wd_ifolder).parent.parent)
         wd_ifolder, new= dir_for_project(fitsfile)
         print('created',wd_ifolder)
 
 def latest_file(path: Path, pattern: str = "*"):
     """
     to get the last file that was generated, this can be useful for getting any new logfiles.
+
+    the files of the directory are kept by a DirWatcher (alfrd.watch), so repeated calls only list
+    the directory again when files were added or removed. Patterns with subfolders are globbed.
     """
-    files = path.glob(pattern)
+    if '/' not in pattern and Path(path).is_dir():
+        from alfrd.watch import watcher
+        return watcher(path, pattern).latest()
+    files = Path(path).glob(pattern)
     lastf = Path('')
     
     try:
@@ -193,32 +456,93 @@ def timeinmin(td):
         tds     =   td%60
     else:
         tds     =   td
-    ret_time    =   f"{int(tdm)}m{np.round(tds,1)}s"
+    ret_time    =   f"{int(tdm)}m{round(float(tds),1)}s"
 
     return ret_time
 
-def del_fl(wd, count=0, fl='*ms*', rm=False):
+def del_fl(wd, count=0, fl='*ms*', rm=False, workers=8, report=False):
     """
-    delete files from the input folder
+    delete files from the input folder, the matches are removed in parallel (alfrd.cleanup)
+    without rm only the command is printed, report=True also walks the matches to report the bytes which would be freed
     """
     wd          =   Path(wd)
     filefound = glob.glob(f"{str(wd)}/{fl}")
     if len(filefound):
-        cmd = ['rm','-rf']
-        cmd.extend(str( wd / " ".join(filefound)).split(' '))
-        print(" ".join(cmd))
+        print(" ".join(['rm', '-rf', *[shlex.quote(f) for f in filefound]]))
         count+=1
-        if rm: subprocess.run(cmd)
+        if rm or report:
+            from alfrd.cleanup import remove_paths
+            remove_paths(filefound, dry_run=not rm, workers=workers)
     return count
 
+def log_stamp():
+    """current time as used in the log file names e.g 2024-01-31-12_00_00"""
+    thisdate = time.strftime('%F-%T', time.gmtime())
+    return thisdate.replace(':', '_')
+
 def build_logpath(wd_ifolder):
     """
     builds rpicard and casa style log files for the current time
     """
-    thisdate = time.strftime('%F-%T', time.gmtime())
-    thisdate = thisdate.replace(':', '_')
+    thisdate = log_stamp()
     
     errlogf = Path(wd_ifolder).parent / f'mpi_and_err.out_{thisdate}'
     casalogf = Path(wd_ifolder).parent / f'casa.log_{thisdate}'
     
-    return str(errlogf), str(casalogf)
\ No newline at end of file
+    return str(errlogf), str(casalogf)
+
+def build_steplogpath(log_dir, step_name, ext=''):
+    """
+    builds the log file of a step for the current time, named like the casa logs e.g {log_dir}/{step_name}.log_{thisdate}
+    if a log of the step was already started within the same second _1, _2, .. is added e.g {step_name}.log_{thisdate}_1
+
+    ext:    extension added to the file when it is created e.g '.gz'
+    """
+    path                =   str(Path(log_dir) / f'{step_name}.log_{log_stamp()}')
+    numb, opt           =   0, path
+    while Path(f"{path}{ext}").exists():
+        numb            +=  1
+        path            =   f"{opt}_{numb}"
+    return path
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter, allows `rate` requests per `per` seconds with bursts up to `capacity`.
+    e.g TokenBucket(60, 60) keeps the requests below the google sheets quota of 60 requests/minute
+    """
+    def __init__(self, rate=60, per=60.0, capacity=None):
+        self.fill_rate      =   rate / per
+        self.capacity       =   capacity or rate
+        self.tokens         =   float(self.capacity)
+        self.t0             =   time.monotonic()
+        self.paused_until   =   0.0
+        self.lock           =   threading.Lock()
+
+    def _refill(self, now):
+        self.tokens         =   min(self.capacity, self.tokens + (now - self.t0) * self.fill_rate)
+        self.t0             =   now
+
+    def acquire(self, tokens=1, block=True):
+        """
+        takes tokens from the bucket, waits until they are available if block is True
+        returns False if block is False and there were not enough tokens
+        """
+        while True:
+            with self.lock:
+                now         =   time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= tokens:
+                    self.tokens -=  tokens
+                    return True
+                wait        =   max(self.paused_until - now, (tokens - self.tokens) / self.fill_rate)
+            if not block:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        stops handing out tokens for the given seconds e.g after the server responded with 429 (Too Many Requests)
+        """
+        with self.lock:
+            self.paused_until   =   max(self.paused_until, time.monotonic() + seconds)
+            self.tokens         =   0.0
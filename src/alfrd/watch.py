@@ -0,0 +1,249 @@
+from collections import OrderedDict
+from pathlib import Path
+import os, sys, time, struct, select, fnmatch, threading
+
+IN_CREATE, IN_MOVED_TO, IN_DELETE, IN_MOVED_FROM, IN_Q_OVERFLOW = 0x100, 0x80, 0x200, 0x40, 0x4000
+IN_MODIFY, IN_ATTRIB, IN_DELETE_SELF, IN_MOVE_SELF, IN_IGNORED = 0x2, 0x4, 0x400, 0x800, 0x8000
+IN_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_MODIFY | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+_EVENT = struct.Struct('iIII')                  # struct inotify_event: wd, mask, cookie, len (+ name)
+
+def _inotify():
+    """libc inotify functions through ctypes, None if they are not available (not linux)"""
+    if not sys.platform.startswith('linux'): return None
+    try:
+        import ctypes, ctypes.util
+        libc                =   ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes, libc.inotify_add_watch.argtypes = [ctypes.c_int], [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class DirWatcher:
+    """
+    Reports the files appearing in a directory (e.g. new casa logs) without listing it on every check.
+
+    polling backend: the directory is only scanned (os.scandir) when its mtime changed, so a check of a directory
+    with thousands of logs is a single stat (and one of the newest file for latest(), the other files are ranked by
+    the ctime they had when the directory was last listed). inotify backend (linux): the kernel reports the new names
+    and the files written to, a check reads them without touching the directory. backend='auto' uses inotify when possible.
+    If the directory is removed (or moved away) the watch is set again on the directory found at the path.
+
+        watcher = DirWatcher(wd, 'casa*.log*')
+        for logfile in watcher.events(timeout=3600):      # new files as they appear
+            ...
+        watcher.latest()                                  # newest file, as util.latest_file
+
+    :existing:  report the files already in the directory as new files on the first check
+    """
+    def __init__(self, path, pattern='*', backend='auto', existing=False):
+        self.path           =   Path(path)
+        self.pattern        =   pattern
+        self.files          =   {}                  # name -> ctime
+        self._newest        =   None                # name of the newest file, None if it has to be looked for
+        self._mtime         =   None
+        self._fd            =   None
+        self._inotify       =   backend in ('auto', 'inotify')
+        self._lock          =   threading.Lock()
+        if self._inotify:
+            self._start_inotify(required=backend == 'inotify')
+        self._scan(report=existing)                 # the inotify watch is set first, a file created meanwhile is in both
+
+    @property
+    def backend(self):
+        return 'inotify' if self._fd is not None else 'poll'
+
+    def _start_inotify(self, required=False):
+        libc                =   _inotify()
+        fd                  =   libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC) if libc else -1
+        if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(self.path), IN_MASK) >= 0:
+            self._fd        =   fd
+            return True
+        if fd >= 0: os.close(fd)                    # e.g. out of inotify watches or no directory yet, polling is used
+        if required: raise OSError(f"inotify is not available for {self.path}")
+        return False
+
+    def _rewatch(self):
+        """the watched directory was removed or moved: watches the directory at the path again (polls until there is one)"""
+        os.close(self._fd)
+        self._fd, self._mtime   =   None, None
+        self._start_inotify()
+        return self._scan()
+
+    def _matches(self, name):
+        return fnmatch.fnmatchcase(name, self.pattern)
+
+    def _add(self, names):
+        new                 =   []
+        for name in names:
+            if name in self.files or not self._matches(name): continue
+            try:
+                self.files[name] =  os.stat(self.path / name).st_ctime
+            except FileNotFoundError:
+                continue
+            if self._newest is not None and self.files[name] >= self.files[self._newest]: self._newest = name
+            new.append(self.path / name)
+        return sorted(new, key=lambda p: self.files[p.name])
+
+    def _touch(self, names):
+        """takes the current ctime of the known files (written to or changed since they were found)"""
+        for name in names:
+            if name not in self.files: continue
+            try:
+                self.files[name] =  os.stat(self.path / name).st_ctime
+            except FileNotFoundError:
+                self._forget(name)
+                continue
+            if self._newest is not None and self.files[name] >= self.files[self._newest]: self._newest = name
+
+    def _scan(self, report=True):
+        """lists the directory if its mtime changed, returns the new files"""
+        try:
+            mtime           =   os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self._mtime, self.files, self._newest = None, {}, None
+            return []
+        # an mtime of the last second may not show a file created right after the scan (timestamp granularity)
+        if mtime == self._mtime and time.time_ns() - mtime > 2e9:
+            return []
+        self._mtime         =   mtime
+        with os.scandir(self.path) as entries:
+            names           =   [entry.name for entry in entries]
+        gone                =   self.files.keys() - set(names)
+        for name in gone: self._forget(name)
+        new                 =   self._add(names)
+        return new if report else []
+
+    def _read_events(self):
+        created, touched    =   [], set()
+        while True:
+            try:
+                data        =   os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                self._touch(touched)
+                return self._add(created)
+            k               =   0
+            while k < len(data):
+                _, mask, _, length  =   _EVENT.unpack_from(data, k)
+                name        =   data[k + _EVENT.size:k + _EVENT.size + length].rstrip(b'\0').decode(errors='surrogateescape')
+                k           +=  _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self._mtime =   None            # events were lost, the directory is listed again
+                    self._touch(list(self.files))
+                    return self._add(created) + self._scan()
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    return self._add(created) + self._rewatch()
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    created.append(name)
+                elif mask & (IN_MODIFY | IN_ATTRIB):
+                    touched.add(name)
+                else:
+                    self._forget(name)              # a file created and removed in between is skipped by _add
+
+    def _forget(self, name):
+        self.files.pop(name, None)
+        if name == self._newest: self._newest = None
+
+    def poll(self):
+        """the files which appeared since the last check"""
+        with self._lock:
+            if self._fd is not None: return self._read_events()
+            if self._inotify and self._mtime is None: self._start_inotify()     # e.g. the directory is back
+            return self._scan()
+
+    def events(self, timeout=None, interval=1.0):
+        """yields the new files as they appear, until the timeout (seconds) is over"""
+        deadline            =   None if timeout is None else time.monotonic() + timeout
+        while True:
+            yield from self.poll()
+            wait            =   interval if deadline is None else min(interval, deadline - time.monotonic())
+            if wait <= 0: return
+            if self._fd is not None:
+                select.select([self._fd], [], [], wait)
+            else:
+                time.sleep(wait)
+
+    def latest(self):
+        """the newest matching file by its current ctime (as util.latest_file), Path('') if there is none"""
+        self.poll()
+        if self._fd is None and self._newest is not None:
+            with self._lock:
+                self._touch([self._newest])         # polling does not see files being written, the newest may be gone
+        if not self.files: return Path('')
+        if self._newest is None: self._newest = max(self.files, key=self.files.get)
+        return self.path / self._newest
+
+    def close(self):
+        """releases the inotify fd, the watcher keeps working by polling"""
+        self._inotify       =   False
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd        =   None
+
+    def __del__(self):
+        self.close()
+
+class FileTailer:
+    """
+    Reads only the lines appended to a file since the last read, e.g. to look for completion markers in a log
+    without reading the whole log again. A file which was truncated or replaced (log rotation) is read from the start.
+
+        tailer = FileTailer(casalog)
+        line = tailer.wait_for('Finished', timeout=600)
+    """
+    def __init__(self, path, from_start=True, encoding='utf-8'):
+        self.path           =   Path(path)
+        self.encoding       =   encoding
+        self.offset         =   0
+        self._inode         =   None
+        self._partial       =   b''
+        if not from_start and self.path.exists():
+            st              =   self.path.stat()
+            self.offset, self._inode    =   st.st_size, st.st_ino
+
+    def lines(self):
+        """the complete lines appended since the last call, a line still being written is returned by a later call"""
+        try:
+            st              =   os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        if st.st_ino != self._inode or st.st_size < self.offset:        # replaced or truncated
+            self.offset, self._inode, self._partial = 0, st.st_ino, b''
+        if st.st_size == self.offset:
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data            =   f.read()
+        self.offset         +=  len(data)
+        data                =   self._partial + data
+        end                 =   data.rfind(b'\n') + 1
+        self._partial       =   data[end:]
+        return data[:end].decode(self.encoding, errors='replace').splitlines()
+
+    def follow(self, timeout=None, interval=0.5):
+        """yields the appended lines as they are written, until the timeout (seconds) is over"""
+        deadline            =   None if timeout is None else time.monotonic() + timeout
+        while True:
+            yield from self.lines()
+            if deadline is not None and time.monotonic() >= deadline: return
+            time.sleep(interval)
+
+    def wait_for(self, marker, timeout=None, interval=0.5):
+        """the first appended line containing marker, None on timeout"""
+        return next((line for line in self.follow(timeout, interval) if marker in line), None)
+
+MAX_WATCHERS = 32                               # each watcher holds an inotify fd
+_WATCHERS = OrderedDict()                       # (path, pattern) -> DirWatcher used by util.latest_file, least recently used first
+_WATCHERS_LOCK = threading.Lock()
+
+def watcher(path, pattern='*'):
+    """the DirWatcher of the directory and pattern, shared within the process (the least recently used are closed)"""
+    key                     =   (str(Path(path).absolute()), pattern)
+    with _WATCHERS_LOCK:
+        if key in _WATCHERS:
+            _WATCHERS.move_to_end(key)
+            return _WATCHERS[key]
+        _WATCHERS[key]      =   DirWatcher(path, pattern)
+        while len(_WATCHERS) > MAX_WATCHERS:
+            _WATCHERS.popitem(last=False)[1].close()
+        return _WATCHERS[key]
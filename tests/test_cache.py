@@ -0,0 +1,24 @@
+from alfrd.cache import StepCache
+
+
+def flag(vis, mode='manual'):
+    return vis
+
+
+def test_relative_name_is_fingerprinted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache           =   StepCache(cache_dir=tmp_path / 'cache')
+    (tmp_path / 'target.ms').write_text('a')
+    key             =   cache.key(flag, {'vis': 'target.ms'})
+    assert cache.key(flag, {'vis': 'target.ms'}) == key
+    (tmp_path / 'target.ms').write_text('changed')
+    assert cache.key(flag, {'vis': 'target.ms'}) != key
+    assert cache.key(flag, {'vis': 'target.ms', 'mode': 'auto'}) != cache.key(flag, {'vis': 'target.ms'})
+
+
+def test_get_put(tmp_path):
+    cache           =   StepCache(cache_dir=tmp_path / 'cache', max_bytes=10**6)
+    key             =   cache.key(flag, {'vis': str(tmp_path)})
+    assert cache.get(key) == (False, None)
+    assert cache.put(key, {'flagged': 0.1})
+    assert cache.get(key) == (True, {'flagged': 0.1})
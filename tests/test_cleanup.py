@@ -0,0 +1,41 @@
+import os
+
+from alfrd.cleanup import Cleanup, remove_paths
+from alfrd.util import del_fl
+
+
+def make_ms(path, nfiles=20, size=5000):
+    for k in range(nfiles):
+        sub         =   path / f"table{k % 4}"
+        sub.mkdir(parents=True, exist_ok=True)
+        (sub / f"f{k}").write_bytes(os.urandom(size))
+    return path
+
+
+def test_dry_run_counts_what_is_freed(tmp_path):
+    targets         =   [make_ms(tmp_path / 'a b.ms'), make_ms(tmp_path / 'c.ms', nfiles=3)]
+    (tmp_path / 'keep').mkdir()
+    os.symlink(tmp_path / 'keep', tmp_path / 'c.ms' / 'link')
+    would           =   remove_paths(targets, dry_run=True, workers=4)
+    assert all(target.exists() for target in targets)
+    freed           =   remove_paths(targets, workers=4)
+    assert freed == would and freed[str(targets[0])] >= 20 * 5000
+    assert not any(target.exists() for target in targets)
+    assert (tmp_path / 'keep').exists()                     # symlinks are removed, not followed
+
+
+def test_hardlinks_free_nothing(tmp_path):
+    (tmp_path / 'template').write_bytes(os.urandom(10000))
+    os.link(tmp_path / 'template', tmp_path / 'linked')
+    assert Cleanup(report_every=0).run([tmp_path / 'linked']) == {str(tmp_path / 'linked'): 0}
+
+
+def test_del_fl(tmp_path, capsys):
+    make_ms(tmp_path / 'target.ms')
+    assert del_fl(tmp_path) == 1
+    out             =   capsys.readouterr().out
+    assert out.startswith('rm -rf') and 'would free' not in out
+    del_fl(tmp_path, report=True)
+    assert 'would free' in capsys.readouterr().out
+    del_fl(tmp_path, rm=True)
+    assert not (tmp_path / 'target.ms').exists()
@@ -0,0 +1,30 @@
+import sys
+
+import pytest
+
+from alfrd.commands import run_command, CommandFailed
+
+
+def test_long_line(capfd):
+    assert run_command([sys.executable, '-c', "print('x' * 3000000); print('done')"]) == 0
+    out             =   capfd.readouterr().out
+    assert 'x' * 3000000 + '\ndone\n' in out
+
+
+def test_exit_code_and_timeout():
+    with pytest.raises(CommandFailed) as e:
+        run_command([sys.executable, '-c', 'raise SystemExit(3)'])
+    assert e.value.returncode == 3
+    assert run_command([sys.executable, '-c', 'raise SystemExit(3)'], ok_codes=(3,)) == 3
+    with pytest.raises(CommandFailed, match='timed out'):
+        run_command([sys.executable, '-c', 'import time; time.sleep(10)'], timeout=0.5, kill_after=1)
+
+
+def test_inside_running_loop(capfd):
+    import asyncio
+
+    async def main():
+        return run_command([sys.executable, '-c', "print('from the loop')"])
+
+    assert asyncio.run(main()) == 0
+    assert 'from the loop' in capfd.readouterr().out
@@ -0,0 +1,113 @@
+from alfrd.lib import GSC, ClientPool, cell_ranges, batch_ranges
+from alfrd.util import TokenBucket
+
+
+class FakeWorksheet:
+    def __init__(self, rows, title='Sheet1'):
+        self.rows       =   rows                # header + rows as lists of strings
+        self.title      =   title
+        self.batches    =   []
+
+    def col_values(self, col):
+        return [row[col - 1] for row in self.rows]
+
+    def get_all_records(self, numericise_ignore=None):
+        return [dict(zip(self.rows[0], row)) for row in self.rows[1:]]
+
+    def batch_update(self, body, **kwargs):
+        self.batches.append(body)
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheet):
+        self.worksheet  =   worksheet
+        self.listed     =   0
+
+    def worksheets(self):
+        self.listed     +=  1
+        return [self.worksheet]
+
+
+class FakeClient:
+    def __init__(self, worksheet):
+        self.spreadsheet =  FakeSpreadsheet(worksheet)
+        self.opened     =   0
+
+    def open_by_key(self, sid):
+        self.opened     +=  1
+        return self.spreadsheet
+
+
+def make_gsc(tmp_path, worksheet):
+    return GSC(sid='s' * 44, client=FakeClient(worksheet), cache_dir=tmp_path, pool=ClientPool())
+
+
+def test_open_sees_remote_edit(tmp_path):
+    ws              =   FakeWorksheet([['FILE_NAME', 'STATUS'], ['a.ms', ''], ['b.ms', '']])
+    assert make_gsc(tmp_path, ws).open().STATUS.tolist() == ['', '']
+    ws.rows[1][1]   =   'done'                  # edited on the sheet, the first column is unchanged
+    assert make_gsc(tmp_path, ws).open().STATUS.tolist() == ['done', '']
+
+
+def test_open_snapshot_with_max_age_and_offline(tmp_path):
+    ws              =   FakeWorksheet([['FILE_NAME', 'STATUS'], ['a.ms', '']])
+    make_gsc(tmp_path, ws).open()
+    ws.rows[1][1]   =   'done'
+    assert make_gsc(tmp_path, ws).open(max_age=600).STATUS.tolist() == ['']
+    assert make_gsc(tmp_path, ws).open(offline=True).STATUS.tolist() == ['']
+
+
+def test_cell_ranges_merge_rows_then_columns():
+    cells           =   {(2, 1): 'a', (3, 1): 'b', (2, 2): 'c', (3, 2): 'd', (5, 2): 'e', (2, 4): 'f'}
+    assert sorted(cell_ranges(cells)) == [(2, 1, [['a', 'c'], ['b', 'd']]), (2, 4, [['f']]), (5, 2, [['e']])]
+
+
+def test_batch_ranges_split_large_ranges():
+    ranges          =   [(2, 1, [[k, k] for k in range(5)]), (10, 3, [['x']])]
+    batches         =   batch_ranges(ranges, max_cells=4)
+    assert [[update['range'] for update in batch] for batch in batches] == [['A2:B3'], ['A4:B5'], ['A6:B6', 'C10']]
+    assert sum(len(update['values']) * len(update['values'][0]) for batch in batches for update in batch) == 11
+
+
+def test_send_cells_one_request_per_batch(tmp_path):
+    ws              =   FakeWorksheet([['FILE_NAME', 'STATUS'], ['a.ms', ''], ['b.ms', '']])
+    gsc             =   make_gsc(tmp_path, ws)
+    gsc.open()
+    gsc.max_cells   =   2
+    assert gsc.send_cells({(2, 2): 'done', (3, 2): 'done', (2, 1): 'a.ms'})
+    assert len(ws.batches) == 2
+    assert make_gsc(tmp_path, ws).open(offline=True).STATUS.tolist() == ['done', 'done']
+
+
+def test_background_writer_merges_cells(tmp_path):
+    ws              =   FakeWorksheet([['FILE_NAME', 'STATUS'], ['a.ms', ''], ['b.ms', '']])
+    gsc             =   make_gsc(tmp_path, ws)
+    gsc.open()
+    gsc.queue_cells({(2, 2): 'running'})
+    gsc.queue_cells({(2, 2): 'done', (3, 2): 'failed'})
+    with gsc:
+        assert gsc.flush(timeout=10)
+        assert gsc.update_cell(gsc.df, [0], [1])                # queued while the writer runs
+    assert gsc._writer is None
+    assert ws.batches[0] == [{'range': 'B2:B3', 'values': [['done'], ['failed']]}]
+    assert ws.batches[-1] == [{'range': 'B2', 'values': [['']]}]
+
+
+def test_client_pool_opens_spreadsheet_once(tmp_path):
+    ws              =   FakeWorksheet([['FILE_NAME'], ['a.ms']])
+    client, pool    =   FakeClient(ws), ClientPool()
+    for _ in range(3):
+        GSC(sid='s' * 44, client=client, cache_dir=tmp_path, pool=pool).open()
+    assert client.opened == 1 and client.spreadsheet.listed == 1
+    pool.forget('s' * 44)
+    GSC(sid='s' * 44, client=client, cache_dir=tmp_path, pool=pool).open()
+    assert client.opened == 2
+
+
+def test_token_bucket():
+    bucket          =   TokenBucket(rate=2, per=60)
+    assert bucket.acquire(block=False) and bucket.acquire(block=False)
+    assert not bucket.acquire(block=False)
+    bucket          =   TokenBucket(rate=1000, per=1)
+    bucket.pause(0.2)
+    assert not bucket.acquire(block=False)
@@ -0,0 +1,26 @@
+from alfrd.journal import RunJournal
+from alfrd.util import LazyGlob
+
+
+def test_state_after_a_crash(tmp_path):
+    journal         =   RunJournal.create('proj', ['a', 'b', 'c'], runs_dir=tmp_path)
+    journal.step_started('a')
+    journal.step_finished('a', True, {'n': 1, 'files': LazyGlob(f"{tmp_path}/*.ms"), 'lf': object()}, {'check': 1})
+    journal.step_started('b')
+    journal.step_finished('b', False, {'n': 2}, {})
+    with open(journal.path, 'a') as f:
+        f.write('{"event": "finish", "step": "c", "fini')          # cut off by the crash
+
+    state           =   RunJournal.load(journal.run_id, runs_dir=tmp_path).state()
+    assert state['proj'] == 'proj' and state['steps'] == ['a', 'b', 'c']
+    assert state['finished'] == ['a'] and state['run_counts'] == {'check': 1}
+    assert state['params']['n'] == 2 and 'lf' not in state['params']
+    assert isinstance(state['params']['files'], LazyGlob) and state['params']['files'].pattern == f"{tmp_path}/*.ms"
+
+
+def test_resumed_run_keeps_its_steps(tmp_path):
+    journal         =   RunJournal.create('proj', ['a', 'b'], runs_dir=tmp_path)
+    journal.step_finished('a', True, {}, {})
+    journal.write({'event': 'run', 'proj': 'proj', 'steps': ['b'], 'resumed': True})
+    journal.step_finished('a', False, {}, {})                       # run again and failed
+    assert journal.state()['steps'] == ['a', 'b'] and journal.state()['finished'] == []
@@ -0,0 +1,130 @@
+import pandas as pd
+
+from alfrd.lib import LogFrame, GSC
+
+
+class FakeGSC:
+    """stands in for GSC, records the cells sent by update_cell"""
+    def __init__(self, df):
+        self.df         =   df
+        self.sent       =   {}
+
+    def update_cell(self, dataframe, I, J):
+        self.sent.update(GSC._cells(dataframe, I, J))
+        return True
+
+    def update(self, dataframe):
+        self.sent['all'] = dataframe.copy()
+        return True
+
+
+def sheet():
+    return pd.DataFrame({'FILE_NAME': ['a.ms', 'b.ms'], 'TSYS': ['', ''], 'STATUS': ['', '']}, dtype=object)
+
+
+def test_direct_loc_edit_is_sent():
+    gsc             =   FakeGSC(sheet())
+    lf              =   LogFrame(gsc=gsc)
+    lf.df_sheet.loc[0, 'TSYS'] = True
+    lf.update_sheet(count=1, failed=0)
+    assert gsc.sent == {(2, 2): True}
+
+
+def test_track_changes_sends_put_value_cells():
+    gsc             =   FakeGSC(sheet())
+    lf              =   LogFrame(gsc=gsc, primary_value='b.ms', track_changes=True)
+    lf.put_value('done', 'STATUS')
+    lf.update_sheet(count=1, failed=0)
+    assert gsc.sent == {(3, 3): 'done'}
+    assert lf.dirty_cells() == []
+
+
+def test_changed_cells():
+    lf              =   LogFrame(df=sheet(), primary_value='a.ms')
+    lf.put_value('done', 'STATUS')
+    lf.df_sheet.loc[1, 'TSYS'] = 'x'
+    assert sorted(lf.changed_cells()) == [('a.ms', 'STATUS', 'done'), ('b.ms', 'TSYS', 'x')]
+
+
+def test_pk_rows_reindex():
+    lf              =   LogFrame(df=pd.DataFrame({'FILE_NAME': ['a.ms', 'b.ms', 'a.ms']}, dtype=object))
+    assert lf.pk_rows('a.ms') == [0, 2] and lf.pk_rows('c.ms') == []
+    lf.df_sheet.iat[1, 0] = 'c.ms'                  # changed directly, same length
+    lf.reindex()
+    assert lf.pk_rows('c.ms') == [1] and lf.pk_rows('b.ms') == []
+
+
+def test_put_values_get_values():
+    lf              =   LogFrame(df=sheet(), track_changes=True)
+    lf.df_sheet['STATUS'] = [None, 'done']
+    assert lf.put_values({'a.ms': 'x', 'b.ms': 'y', 'c.ms': 'z'}, 'TSYS') == 2
+    assert lf.put_values({'a.ms': 'done', 'b.ms': 'failed'}, 'STATUS', force=True) == 1
+    assert lf.df_sheet.STATUS.tolist() == ['done', 'done']
+    assert lf.get_values(['b.ms', 'a.ms', 'c.ms'], 'TSYS').tolist() == ['y', 'x', '']
+    assert lf.get_values(['a.ms'], 'TSYS', where=["STATUS == 'failed'"]).tolist() == ['']
+
+
+def test_csv_checkpoint_and_compaction(tmp_path):
+    path            =   tmp_path / 'rows.csv'
+    pd.DataFrame({'FILE_NAME': ['a.ms', 'b.ms'], 'NCHAN': ['064', '128'], 'STATUS': ['', '']}).to_csv(path, index=False)
+    before          =   path.read_text()
+    lf              =   LogFrame(csv=path, primary_value='a.ms', track_changes=True, dtype=str)
+    lf.put_value('done', 'STATUS')
+    assert lf.checkpoint() == 1
+    with open(f"{path}.delta", 'a') as f:
+        f.write('[1, "STATUS", "do')                # cut off by a crash
+    df              =   LogFrame(csv=path, dtype=str).df_sheet
+    assert path.read_text() == before               # only the delta log was written
+    assert df.STATUS[0] == 'done' and pd.isna(df.STATUS[1]) and df.NCHAN.tolist() == ['064', '128']
+
+    lf.store.compact_every = 1
+    lf.primary_value = 'b.ms'
+    lf.put_value('failed', 'STATUS')
+    lf.checkpoint()
+    assert not (tmp_path / 'rows.csv.delta').exists()
+    assert LogFrame(csv=path, dtype=str).df_sheet.STATUS.tolist() == ['done', 'failed']
+
+
+def test_csv_delta_of_another_version_is_ignored(tmp_path):
+    path            =   tmp_path / 'rows.csv'
+    pd.DataFrame({'FILE_NAME': ['a.ms'], 'STATUS': ['']}).to_csv(path, index=False)
+    lf              =   LogFrame(csv=path, primary_value='a.ms', track_changes=True)
+    lf.put_value('done', 'STATUS')
+    lf.checkpoint()
+    assert (tmp_path / 'rows.csv.delta').exists()
+    pd.DataFrame({'FILE_NAME': ['b.ms'], 'STATUS': ['']}).to_csv(path, index=False)     # replaced by another tool
+    assert LogFrame(csv=path).df_sheet.FILE_NAME.tolist() == ['b.ms']
+    assert LogFrame(csv=path).df_sheet.STATUS.isna().all()
+
+
+def test_aupdate_sheet_checkpoints_csv(tmp_path, monkeypatch):
+    import asyncio
+    monkeypatch.chdir(tmp_path)
+    path            =   tmp_path / 'rows.csv'
+    pd.DataFrame({'FILE_NAME': ['a.ms', 'b.ms'], 'STATUS': ['', '']}).to_csv(path, index=False)
+    lf              =   LogFrame(csv=path, primary_value='a.ms', track_changes=True)
+    lf.put_value('done', 'STATUS')
+    asyncio.run(lf.aupdate_sheet(count=1, failed=0))
+    lf.primary_value=   'b.ms'
+    lf.put_value('failed', 'STATUS')
+    lf.update_sheet(count=2, failed=0)
+    assert LogFrame(csv=path).df_sheet.STATUS.tolist() == ['done', 'failed']
+    assert not (tmp_path / 'df_sheet.csv').exists()
+
+
+def test_dirty_cells_only_recorded_with_track_changes():
+    lf              =   LogFrame(df=sheet(), primary_value='a.ms')
+    for k in range(3): lf.put_value(f"run {k}", 'STATUS')
+    lf.mark_dirty(1, 'TSYS')
+    assert lf._dirty == {} and lf.changed_cells() == [('a.ms', 'STATUS', 'run 2')]
+
+
+def test_csv_empty_base_file(tmp_path):
+    from alfrd.lib import CSVStore
+
+    path            =   tmp_path / 'rows.csv'
+    path.write_text('')
+    store           =   CSVStore(path)
+    assert store.load().empty
+    store.compact(pd.DataFrame({'FILE_NAME': ['a.ms']}))
+    assert CSVStore(path).load().FILE_NAME.tolist() == ['a.ms']
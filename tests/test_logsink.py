@@ -0,0 +1,42 @@
+import gzip, os, sys
+
+from alfrd.logsink import StepLog, LogSink
+from alfrd.util import build_steplogpath
+
+
+def test_rotation_by_size_on_disk(tmp_path):
+    log             =   StepLog(tmp_path / 'flag.log', compress=True, max_bytes=20000, backups=2, bufsize=1024)
+    for k in range(3000):
+        log.write(f"{k} {os.urandom(16).hex()}\n")
+    log.close()
+    rotated         =   tmp_path / 'flag.log.gz.1'
+    assert rotated.exists()
+    assert 20000 < rotated.stat().st_size < 30000                   # the compressor keeps a few KB before writing
+    assert gzip.open(rotated).read().decode().endswith('\n')
+
+    log             =   StepLog(tmp_path / 'plain.log', max_bytes=1000, backups=1)
+    log.write('é' * 600)                                    # 1200 bytes on disk
+    log.close()
+    assert (tmp_path / 'plain.log.1').stat().st_size == 1200
+
+
+def test_log_names_are_unique(tmp_path):
+    first           =   build_steplogpath(tmp_path, 'flag', ext='.gz')
+    open(f"{first}.gz", 'w').close()
+    second          =   build_steplogpath(tmp_path, 'flag', ext='.gz')
+    assert second != first and second.startswith(first)
+
+
+def test_rows_get_their_own_logs(tmp_path):
+    sink            =   LogSink(log_dir=tmp_path, terminal=False)
+    stdout, stderr  =   sys.stdout, sys.stderr
+    sink.install()
+    try:
+        for row in ('a.fits', 'b/c.fits'):
+            with sink.step('flag', tag=row):
+                print(f"flagging {row}")
+    finally:
+        sink.uninstall()
+        sys.stdout, sys.stderr = stdout, stderr
+    logs            =   sorted(path.name.split('.log_')[0] for path in tmp_path.iterdir())
+    assert logs == ['flag_a.fits', 'flag_b_c.fits']
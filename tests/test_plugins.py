@@ -0,0 +1,198 @@
+from pathlib import Path
+
+from alfrd.plugins import project_manifest, scan_plugin
+
+
+def write(path, text):
+    path.write_text(text)
+    return path
+
+
+def test_scan_plugin(tmp_path):
+    plugin          =   write(tmp_path / 'steps.py', '''
+from alfrd.plugins import register, register_command, validator, validate
+
+@validator("check the data", after=True, run_once=True)
+def check(): ...
+
+@validate(by=[check])
+@register("Load the data", mem_gb=4)
+def load(): ...
+
+@register_command("Run rPicard", after=[load])
+def rpicard(): ...
+''')
+    scanned         =   scan_plugin(plugin)
+    assert [step['name'] for step in scanned['steps']] == ['load', 'rpicard']
+    assert scanned['steps'][0]['validate_by'] == ['check'] and scanned['steps'][0]['mem_gb'] == 4
+    assert scanned['steps'][1]['after'] == ['load']
+    assert scanned['validators'] == [{'name': 'check', 'desc': 'check the data', 'after': True, 'run_once': True}]
+    assert not scanned['dynamic']
+
+
+def test_registrations_without_decorator(tmp_path):
+    write(tmp_path / 'steps.py', '''
+from alfrd.plugins import register, register_command
+
+@register("Load the data")
+def load(): ...
+
+def image(): ...
+register("Image the data")(image)
+''')
+    manifest        =   project_manifest(tmp_path, cache_path=tmp_path / 'manifest.json')
+    assert manifest['dynamic'] == [str(tmp_path / 'steps.py')]
+
+
+def test_duplicate_steps_warn(tmp_path, capsys):
+    for name in ('a.py', 'b.py'):
+        write(tmp_path / name, f'''
+from alfrd.plugins import register
+
+@register("{name}")
+def load(): ...
+''')
+    manifest        =   project_manifest(tmp_path, cache_path=tmp_path / 'manifest.json')
+    last            =   list(Path(tmp_path).glob('*.py'))[-1]
+    assert manifest['steps']['load']['desc'] == last.name
+    assert "step 'load' is defined in" in capsys.readouterr().out
+
+
+def test_manifest_files_include_validators_of_other_steps(tmp_path, monkeypatch):
+    from alfrd import plugins
+    from alfrd.plugins import load_projects, manifest_files
+
+    for name in ('REGISTERED_STEPS', 'VALIDATORS', 'VALIDATE_BEFORE', 'VALIDATE_AFTER'):
+        monkeypatch.setattr(plugins, name, {})
+    write(tmp_path / 'steps.py', '''
+from alfrd.plugins import register, validate
+
+@register("Load the data")
+def load(): ...
+
+@validate(by=['v1'])
+@register("Image the data")
+def image(): ...
+''')
+    write(tmp_path / 'checks.py', '''
+from alfrd.plugins import register, validate, validator
+
+@validator("first check")
+def v1(): ...
+
+@validate(by=['v2'])
+@register("Flag the data")
+def flag(): ...
+''')
+    write(tmp_path / 'more_checks.py', '''
+from alfrd.plugins import validator
+
+@validator("second check")
+def v2(): ...
+''')
+    write(tmp_path / 'other.py', '''
+from alfrd.plugins import register
+
+@register("Not needed")
+def other(): ...
+''')
+    manifest        =   project_manifest(tmp_path, cache_path=tmp_path / 'manifest.json')
+    files           =   manifest_files(manifest, ['load'])
+    assert [Path(f).name for f in files] == ['more_checks.py', 'checks.py', 'steps.py']
+    load_projects(tmp_path, only=files)
+    assert set(plugins.REGISTERED_STEPS) == {'load', 'image', 'flag'}
+
+
+
+def test_only_run_once_validators_are_locked(monkeypatch):
+    import threading, time
+    from alfrd import plugins
+
+    monkeypatch.setattr(plugins, 'VALIDATORS', {})
+    running, overlap    =   [], []
+    calls               =   []
+
+    @plugins.validator("checks the data")
+    def check():
+        running.append(1)
+        time.sleep(0.05)
+        overlap.append(len(running))
+        running.pop()
+        return True
+
+    @plugins.validator("sets up once", run_once=True)
+    def setup():
+        calls.append(1)
+        time.sleep(0.05)
+        return True
+
+    def step(name):
+        run                 =   plugins.PipelineRun().fork(name)
+        run.validate_steps  =   {name: {'functions': [setup, check]}}
+        run.run_validations()
+
+    threads         =   [threading.Thread(target=step, args=(name,)) for name in ('flag', 'image')]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert calls == [1]
+    assert max(overlap) == 2
+
+
+def dag_steps(monkeypatch, **after):
+    from alfrd import plugins
+    monkeypatch.setattr(plugins, 'REGISTERED_STEPS', {name: {'desc': name, 'after': deps} for name, deps in after.items()})
+
+
+def test_step_graph(monkeypatch):
+    import pytest
+    from alfrd.plugins import step_graph
+
+    dag_steps(monkeypatch, load=None, bandpass=['load'], phases=['load'], image=['bandpass', 'phases'], report=None)
+    assert step_graph(['load', 'bandpass', 'phases', 'image', 'report']) == {
+        'load': [], 'bandpass': ['load'], 'phases': ['load'], 'image': ['bandpass', 'phases'], 'report': ['image']}
+    assert step_graph(['bandpass', 'phases'])['phases'] == []                  # load is not part of the run
+    dag_steps(monkeypatch, a=['b'], b=['a'])
+    with pytest.raises(ValueError, match='Cyclic'):
+        step_graph(['a', 'b'])
+    dag_steps(monkeypatch, a=['missing'])
+    with pytest.raises(ValueError, match='not registered'):
+        step_graph(['a'])
+
+
+def test_run_dag_diamond(monkeypatch):
+    import threading, time
+    from alfrd.plugins import PipelineRun
+
+    dag_steps(monkeypatch, load=None, bandpass=['load'], phases=['load'], image=['bandpass', 'phases'])
+    started, lock   =   [], threading.Lock()
+
+    def execute(run, step_name):
+        with lock: started.append(step_name)
+        time.sleep({'bandpass': 0.2, 'phases': 0.0}.get(step_name, 0))          # phases finishes first
+        run.params[f"seen_{step_name}"] = sorted(k for k in run.params if k.startswith('by_'))
+        run.params[f"by_{step_name}"] = True
+        run.params['ret'] = step_name
+        return True
+
+    pipeline        =   PipelineRun()
+    done            =   pipeline.run_dag(['load', 'bandpass', 'phases', 'image'], execute, jobs=2)
+    assert done == {'load': True, 'bandpass': True, 'phases': True, 'image': True}
+    assert started[0] == 'load' and started[-1] == 'image'
+    assert pipeline.params['seen_bandpass'] == pipeline.params['seen_phases'] == ['by_load']
+    assert pipeline.params['seen_image'] == ['by_bandpass', 'by_load', 'by_phases']
+    pipeline.params.pop('ret')
+    pipeline.run_dag(['bandpass', 'phases'], execute, jobs=2)
+    assert pipeline.params['ret'] == 'phases'                                   # the run order, not the one finishing last
+
+
+def test_run_dag_failed_step_skips_dependents(monkeypatch):
+    from alfrd.plugins import PipelineRun
+
+    dag_steps(monkeypatch, load=None, bandpass=['load'], phases=['load'], image=['bandpass', 'phases'])
+
+    def execute(run, step_name):
+        if step_name == 'bandpass': raise RuntimeError(step_name)
+        return step_name != 'phases'
+
+    done            =   PipelineRun().run_dag(['load', 'bandpass', 'phases', 'image'], execute, jobs=2)
+    assert done == {'load': True, 'bandpass': None, 'phases': False, 'image': False}
@@ -0,0 +1,27 @@
+import json, threading, time
+
+from alfrd.profiler import StepProfiler
+
+
+def test_overlapping_steps_are_approximate(tmp_path, capsys):
+    profiler        =   StepProfiler(tmp_path / 'profile.json', interval=0.01)
+    with profiler.record('load'):
+        with profiler.record('check (load)', 'validator'):
+            time.sleep(0.02)
+    started         =   threading.Barrier(2)
+
+    def step(name):
+        with profiler.record(name):
+            started.wait()
+            time.sleep(0.02)
+
+    threads         =   [threading.Thread(target=step, args=(name,)) for name in ('flag', 'image')]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    path            =   profiler.save()
+    events          =   {event['name']: event['args'] for event in json.load(open(path))['traceEvents']}
+    assert 'approx' not in events['load'] and 'approx' not in events['check (load)']
+    assert events['flag']['approx'] and events['image']['approx']
+    assert events['load']['wall_s'] >= 0.02
+    profiler.summary()
+    assert '~ ran next to other steps' in capsys.readouterr().out
@@ -0,0 +1,92 @@
+import time
+
+import pandas as pd
+
+from alfrd.lib import LogFrame
+from alfrd.progressdb import SQLiteStore, LeaseManager, SheetExporter, LEASE_COLUMNS
+
+
+def rows():
+    return pd.DataFrame({'FILE_NAME': ['a.ms', 'b.ms', 'c.ms'], 'STATUS': ['', '', '']}, dtype=object)
+
+
+def make_store(tmp_path):
+    return SQLiteStore(tmp_path / 'progress.db').create(rows())
+
+
+class FakeGSC:
+    """stands in for GSC, the sheet is a dataframe and send_cells records the cells"""
+    def __init__(self, df):
+        self.df         =   df
+        self.sent       =   []
+
+    def open(self):
+        return self.df
+
+    def send_cells(self, cells):
+        self.sent.append(dict(cells))
+        return True
+
+
+def test_logframe_db_writes_rows(tmp_path):
+    store           =   make_store(tmp_path)
+    lf              =   LogFrame(db=store, primary_value='b.ms')
+    lf.put_value('done', 'STATUS')
+    lf.put_values({'a.ms': 64, 'c.ms': 128}, 'NCHAN')
+    other           =   LogFrame(db=SQLiteStore(tmp_path / 'progress.db'), primary_value='b.ms')      # another process
+    assert other.get_value('STATUS') == 'done'
+    assert other.get_values(['a.ms', 'c.ms'], 'NCHAN').tolist() == ['64', '128']
+    assert [(row, colname) for _, row, colname in store.changes()] == [(2, 'STATUS'), (1, 'NCHAN'), (3, 'NCHAN')]
+
+
+def test_leases_claim_finish_and_expire(tmp_path):
+    store           =   make_store(tmp_path)
+    first, second   =   LeaseManager(store, ttl=600), LeaseManager(SQLiteStore(store.path), ttl=600)
+    second.pid      +=  1                           # another worker
+    claimed         =   first.claim(2)
+    assert claimed.FILE_NAME.tolist() == ['a.ms', 'b.ms']
+    assert second.claim(2).FILE_NAME.tolist() == ['c.ms']
+    assert not len(second.claim(1))
+    first.finish(claimed.index[0], 'done')
+    store.write_cells([(claimed.index[1], LEASE_COLUMNS[2], time.time() - 1)])     # the first worker stopped renewing
+    assert second.claim(1).FILE_NAME.tolist() == ['b.ms']
+    assert first.renew() == 0 and not first.held
+    df              =   store.load()
+    assert df.STATUS.tolist()[0] == 'done' and df[LEASE_COLUMNS[0]].isna().tolist() == [True, False, False]
+
+
+def test_heartbeat_releases_held_rows(tmp_path):
+    store           =   make_store(tmp_path)
+    leases          =   LeaseManager(store, ttl=600)
+    with leases.heartbeat():
+        leases.claim(3)
+    assert LeaseManager(store).claim(3).FILE_NAME.tolist() == ['a.ms', 'b.ms', 'c.ms']
+
+
+def test_sheet_exporter(tmp_path):
+    store           =   make_store(tmp_path)
+    gsc             =   FakeGSC(rows().iloc[:2])    # c.ms is not on the sheet yet
+    lf              =   LogFrame(db=store, primary_value='a.ms')
+    lf.put_value('done', 'STATUS')
+    lf.primary_value=   'c.ms'
+    lf.put_value('x', 'NCHAN')
+    exporter        =   SheetExporter(store, gsc)
+    assert exporter.export() == 5
+    assert gsc.sent == [{(2, 2): 'done', (1, 3): 'NCHAN', (4, 1): 'c.ms', (4, 2): '', (4, 3): 'x'}]
+    assert gsc.df.FILE_NAME.tolist() == ['a.ms', 'b.ms', 'c.ms']
+    assert exporter.export() == 0 and store.get_meta('exported') == 2 and not store.changes()
+
+
+def test_update_sheet_in_db_mode(tmp_path, monkeypatch):
+    import asyncio
+    monkeypatch.chdir(tmp_path)
+    store           =   make_store(tmp_path)
+    lf              =   LogFrame(db=store, primary_value='a.ms')
+    lf.put_value('done', 'STATUS')
+    asyncio.run(lf.aupdate_sheet(count=1, failed=0))
+    lf.primary_value=   'b.ms'
+    lf.put_value('failed', 'STATUS')
+    lf.update_sheet(count=2, failed=0)
+    assert lf.registered == (2, 0)
+    assert store.load().STATUS.tolist() == ['done', 'failed', '']
+    assert not (tmp_path / 'df_sheet.csv').exists()
@@ -0,0 +1,36 @@
+import psutil
+
+from alfrd.resources import ResourceGate
+
+
+class FakeGate(ResourceGate):
+    """a machine with 100 GB of memory free and 1000 GB of scratch, the steps use what they reserved"""
+    def __init__(self):
+        super().__init__(reserve_mem_gb=0, interval=0.01)
+        self.used       =   {'mem_gb': 0, 'scratch_gb': 0}
+
+    def _free(self):
+        return {'mem_gb': 100 - self.used['mem_gb'], 'scratch_gb': 1000 - self.used['scratch_gb']}
+
+
+def test_reservations_not_counted_twice(monkeypatch):
+    monkeypatch.setattr(psutil, 'cpu_percent', lambda interval=None: 0.0)
+    gate            =   FakeGate()
+    assert gate.try_acquire('a', {'mem_gb': 40})
+    assert gate.available()['mem_gb'] == 60                 # reserved, not allocated yet
+    gate.used['mem_gb'] = 40
+    assert gate.available()['mem_gb'] == 60                 # allocated, subtracted once
+    assert gate.try_acquire('b', {'mem_gb': 50})
+    assert not gate.try_acquire('c', {'mem_gb': 20})
+    gate.release('a'), gate.release('b')
+    gate.used['mem_gb'] = 0
+    assert gate.available()['mem_gb'] == 100
+
+
+def test_other_processes_use_resources(monkeypatch):
+    monkeypatch.setattr(psutil, 'cpu_percent', lambda interval=None: 0.0)
+    gate            =   FakeGate()
+    assert gate.try_acquire('a', {'scratch_gb': 100})
+    gate.used['scratch_gb'] = 950                           # e.g. another reduction on the same disk
+    assert gate.available()['scratch_gb'] == 50
+    assert not gate.acquire('b', {'scratch_gb': 60}, timeout=0.05)
@@ -0,0 +1,84 @@
+import pandas as pd
+import pytest
+import typer
+
+import alfrd
+from alfrd import Pipeline, REGISTERED_STEPS, execute_step, run_over_rows, _run_row
+from alfrd.journal import RunJournal
+from alfrd.plugins import register
+
+
+@pytest.fixture
+def steps():
+    saved           =   dict(REGISTERED_STEPS)
+    REGISTERED_STEPS.clear()
+
+    @register("mark the row")
+    def mark(lf, primary_value):
+        lf.put_value('done' if primary_value != 'b.ms' else 'failed', 'STATUS')
+
+    @register("fail")
+    def explode(primary_value):
+        raise RuntimeError(primary_value)
+
+    yield
+    REGISTERED_STEPS.clear()
+    REGISTERED_STEPS.update(saved)
+    Pipeline.journal    =   None
+    Pipeline.reset()
+
+
+def test_run_row(steps):
+    row             =   {'FILE_NAME': 'a.ms', 'STATUS': ''}
+    assert _run_row('proj', ['mark'], {}, row, 'FILE_NAME') == ('a.ms', True, [('a.ms', 'STATUS', 'done')])
+    primary_value, success, _ = _run_row('proj', ['explode'], {}, row, 'FILE_NAME')
+    assert primary_value == 'a.ms' and not success
+
+
+def test_over_rows_csv(steps, tmp_path, monkeypatch):
+    monkeypatch.setattr(alfrd, 'PROJ_DIR', tmp_path)
+    (tmp_path / 'proj').mkdir()
+    path            =   tmp_path / 'rows.csv'
+    pd.DataFrame({'FILE_NAME': ['a.ms', 'b.ms', 'c.ms'], 'STATUS': ['', '', 'old']}).to_csv(path, index=False)
+    run_over_rows('proj', ['mark'], str(path), where='STATUS != "old"', workers=2)
+    assert pd.read_csv(path).STATUS.tolist() == ['done', 'failed', 'old']
+    assert not (tmp_path / 'rows.csv.delta').exists()               # compacted for the other tools
+
+
+def test_journaled_steps(steps, tmp_path):
+    journal         =   RunJournal.create('proj', ['mark', 'explode'], runs_dir=tmp_path)
+    Pipeline.journal    =   journal
+    Pipeline.prev_step_success, Pipeline.validation_success = True, True
+    Pipeline.update_params({'lf': alfrd.lib.LogFrame(df=pd.DataFrame({'FILE_NAME': ['a.ms']}), primary_value='a.ms'),
+                            'primary_value': 'a.ms'})
+    assert execute_step(Pipeline, 'mark', 'proj')
+    with pytest.raises(typer.Exit):
+        execute_step(Pipeline, 'explode', 'proj')
+    state           =   journal.state()
+    assert state['finished'] == ['mark'] and state['params']['primary_value'] == 'a.ms'
+
+
+def test_run_restores_stdout(steps, tmp_path, monkeypatch):
+    import sys
+    from typer.testing import CliRunner
+    from alfrd import plugins
+    from alfrd.logsink import LOG_SINK
+
+    monkeypatch.setattr(alfrd, 'PROJ_DIR', tmp_path)
+    monkeypatch.setattr(plugins, 'MANIFEST_CACHE', tmp_path / 'manifest.json')
+    (tmp_path / 'proj').mkdir()
+    (tmp_path / 'proj' / 'plugin.py').write_text('''
+from alfrd.plugins import register
+
+@register("say hello")
+def hello(primary_value):
+    print("hello", primary_value)
+''')
+    path            =   tmp_path / 'rows.csv'
+    pd.DataFrame({'FILE_NAME': ['a.ms']}).to_csv(path, index=False)
+    stdout          =   sys.stdout
+    result          =   CliRunner().invoke(alfrd.alfrd_cli, ['run', 'hello', 'proj', '--over-rows', str(path), '--workers', '1',
+                                                         '--log-dir', str(tmp_path / 'logs')])
+    assert result.exit_code == 0, result.output
+    assert not LOG_SINK.installed and sys.stdout is stdout
+    assert list((tmp_path / 'logs').glob('hello_a.ms*'))
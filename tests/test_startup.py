@@ -0,0 +1,10 @@
+from alfrd.startup import check_startup, import_times, HEAVY_MODULES
+
+
+def test_no_heavy_imports():
+    heavy           =   [name for name in import_times() if name.split('.')[0] in HEAVY_MODULES or name in HEAVY_MODULES]
+    assert heavy == []
+
+
+def test_startup_budget():
+    assert check_startup(max_import_ms=300, max_help_ms=1500, runs=3) == []
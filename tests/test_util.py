@@ -0,0 +1,43 @@
+from pathlib import Path
+
+from alfrd.util import WDIndex, dir_for_project
+
+
+def make_template(tmp_path):
+    ifolder         =   tmp_path / 'input_template'
+    ifolder.mkdir()
+    (ifolder / 'params.json').write_text('{}')
+    return f"{ifolder}/"
+
+
+def test_dir_for_project_fresh_tdir(tmp_path):
+    fitsfile        =   tmp_path / 'data' / 'BA123' / 'BA123.fits'
+    fitsfile.parent.mkdir(parents=True)
+    fitsfile.write_text('')
+    tdir            =   f"{tmp_path}/reductions/"           # does not exist yet
+    wd_ifolder, _   =   dir_for_project(str(fitsfile), tdir=tdir, ifolder=make_template(tmp_path), link='copy')
+    assert Path(wd_ifolder, 'params.json').exists()
+    assert Path(tdir, 'BA123', 'wd', 'raw', 'BA123.fits').is_symlink()
+    assert dir_for_project(str(fitsfile), tdir=tdir, create=False)[0] == Path(tdir, 'BA123', 'wd', 'input_template')
+
+
+def test_wdindex_missing_tdir(tmp_path):
+    index           =   WDIndex(tmp_path / 'missing')
+    assert index.lookup('BA123', 'BA123.fits') is None
+    assert not (tmp_path / 'missing').exists()
+
+
+def test_lazy_glob_is_a_list(tmp_path):
+    import pickle
+    from alfrd.util import LazyGlob, read_inputfile, resolve_lazy
+
+    for name in ('a.ms', 'b.ms'): (tmp_path / name).mkdir()
+    (tmp_path / 'run.inp').write_text(f"ms_files = {tmp_path}/*.ms\nnchan = 64\n")
+    params, _, _    =   read_inputfile(tmp_path, '.inp', lazy=True)
+    files           =   params['ms_files']
+    assert isinstance(files, LazyGlob) and isinstance(files, list)
+    assert sorted(files) == [f"{tmp_path}/a.ms", f"{tmp_path}/b.ms"]
+    assert len(files) == 2 and files[0] in files
+    assert sorted(pickle.loads(pickle.dumps(files))) == sorted(files)
+    assert type(resolve_lazy(files)) is list
+    assert params['nchan'] == 64
@@ -0,0 +1,87 @@
+import os, shutil, time
+
+import pytest
+
+from alfrd import watch
+from alfrd.watch import DirWatcher, FileTailer
+
+
+@pytest.fixture(params=['poll', 'auto'])
+def backend(request):
+    return request.param
+
+
+def test_new_files(tmp_path, backend):
+    w               =   DirWatcher(tmp_path, 'casa*.log', backend=backend)
+    (tmp_path / 'casa1.log').write_text('')
+    (tmp_path / 'other.txt').write_text('')
+    assert w.poll() == [tmp_path / 'casa1.log']
+    assert w.latest() == tmp_path / 'casa1.log'
+
+
+def test_directory_recreated(tmp_path, backend):
+    wd              =   tmp_path / 'wd'
+    wd.mkdir()
+    (wd / 'casa1.log').write_text('')
+    w               =   DirWatcher(wd, 'casa*.log', backend=backend)
+    assert w.latest() == wd / 'casa1.log'
+    shutil.rmtree(wd)
+    assert w.latest() == type(wd)('')
+    wd.mkdir()
+    (wd / 'casa2.log').write_text('')
+    assert w.latest() == wd / 'casa2.log'
+    (wd / 'casa3.log').write_text('')
+    assert w.poll() == [wd / 'casa3.log']
+
+
+@pytest.mark.skipif(watch._inotify() is None, reason="needs inotify")
+def test_latest_by_current_ctime(tmp_path):
+    (tmp_path / 'casa1.log').write_text('')
+    time.sleep(0.01)
+    (tmp_path / 'casa2.log').write_text('')
+    w               =   DirWatcher(tmp_path, 'casa*.log', backend='inotify')
+    assert w.latest() == tmp_path / 'casa2.log'
+    time.sleep(0.01)
+    with open(tmp_path / 'casa1.log', 'a') as f:
+        f.write('rewritten\n')
+    assert w.latest() == tmp_path / 'casa1.log'
+
+
+def test_latest_polling_stats_only_the_newest(tmp_path, monkeypatch):
+    for k in range(20): (tmp_path / f"casa{k}.log").write_text('')
+    w               =   DirWatcher(tmp_path, 'casa*.log', backend='poll')
+    w.latest()
+    time.sleep(2.1)                                         # the directory mtime is old enough to be trusted
+    w.latest()
+    stats           =   []
+    stat            =   os.stat
+    monkeypatch.setattr(os, 'stat', lambda path, *args, **kwargs: stats.append(path) or stat(path, *args, **kwargs))
+    newest          =   w.latest()
+    assert stats == [tmp_path, newest]
+    os.remove(newest)
+    assert w.latest() != newest
+
+
+def test_watchers_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(watch, 'MAX_WATCHERS', 2)
+    monkeypatch.setattr(watch, '_WATCHERS', type(watch._WATCHERS)())
+    first           =   watch.watcher(tmp_path, 'a*')
+    watch.watcher(tmp_path, 'b*')
+    watch.watcher(tmp_path, 'c*')
+    assert len(watch._WATCHERS) == 2
+    assert first._fd is None
+    (tmp_path / 'a1').write_text('')
+    assert first.latest() == tmp_path / 'a1'               # an evicted watcher still works by polling
+
+
+def test_tailer(tmp_path):
+    log             =   tmp_path / 'casa.log'
+    log.write_text('start\npart')
+    tailer          =   FileTailer(log)
+    assert tailer.lines() == ['start']
+    with open(log, 'a') as f:
+        f.write('ial\nFinished\n')
+    assert tailer.lines() == ['partial', 'Finished']
+    os.replace(tmp_path / 'casa.log', tmp_path / 'old.log')
+    log.write_text('again\n')
+    assert tailer.wait_for('again', timeout=1, interval=0.01) == 'again'